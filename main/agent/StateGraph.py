@@ -425,6 +425,11 @@ from langgraph.graph import StateGraph, START, END
 from langgraph.graph.message import add_messages
 
 import os
+import sys
+import httpx
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from metrics import MetricsRecorder, http_event_hooks, invoke_with_metrics
 
 # --- 配置 ---
 # 你可以通过环境变量设置，或直接写在这里
@@ -439,8 +444,12 @@ llm = ChatOpenAI(
     model=MODEL_NAME,
     temperature=0.3,
     timeout=30,
-    max_retries=3
+    max_retries=3,
+    # 事件钩子统计每次调用实际发出的 HTTP 请求(重试次数、请求体字节数)
+    http_client=httpx.Client(event_hooks=http_event_hooks())
 )
+# 模型调用指标,环境变量 LLM_METRICS_DIR 指定时逐条写入并在退出时写出汇总(summary.json / metrics.prom)
+metrics = MetricsRecorder()
 
 
 class State(TypedDict):
@@ -451,7 +460,7 @@ graph_builder = StateGraph(State)
 
 
 def chatbot(state: State):
-    response = llm.invoke(state["messages"])
+    response = invoke_with_metrics(llm, state["messages"], metrics)
     return {"messages": [response]}
 
 
@@ -487,6 +496,8 @@ while True:
         print("User: " + user_input)
         stream_graph_updates(user_input)
         break
+print(metrics.describe())
+metrics.write_summary()
 
 
 
@@ -8,11 +8,21 @@ import json
 import argparse
 import logging
 from pathlib import Path
-from typing import List, Dict
+from typing import List, Dict, Optional
 import time
 import asyncio
 import aiohttp
 import pandas as pd
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from backend_pool import load_backends
+from stream_validator import IncrementalJSONValidator
+from llm_client import LLMClient, DEFAULT_BASE_URL, DEFAULT_MAX_RETRIES
+from metrics import MetricsRecorder, DEFAULT_METRICS_DIR
+from scheduler import SlidingWindow
+from rate_limiter import all_rate_limiters, configure_rate_limit
+from checkpoint import RunCheckpoint
 
 # --- 设置日志 ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -46,21 +56,27 @@ You MUST provide your response in a valid JSON object format, with no other text
 - "quality_score": A single integer score from 1 to 10, where 1 is "Completely incorrect/unusable" and 10 is "Perfect, human-quality translation".
 """
 
+# 流式校验:quality_score 只能是 1-10 的整数
+SCORE_ENUMS = {"quality_score": {str(score) for score in range(1, 11)}}
+
 class GeminiEvaluator:
     """使用Gemini API评估语料的处理器"""
-    def __init__(self, api_key: str, base_url: str = None, model: str = "gemini-2.5-flash-preview-05-20-nothinking"): # type: ignore
+    def __init__(self, api_key: str, base_url: str = None, model: str = "gemini-2.5-flash-preview-05-20-nothinking", # type: ignore
+                 client: Optional[LLMClient] = None, stream_response: bool = False):
         self.api_key = api_key
-        self.base_url = base_url or "https://one-api.modelbest.co/v1"
+        self.base_url = base_url or DEFAULT_BASE_URL
         self.model = model
-        self.session = None
+        # 共享连接池的客户端,未传入时自建
+        self.client = client or LLMClient(api_key, self.base_url)
+        # 流式接收响应,边接收边校验 json,输出无效时提前中止并重新请求
+        self.stream_response = stream_response
 
     async def __aenter__(self):
-        self.session = aiohttp.ClientSession()
+        await self.client.__aenter__()
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        if self.session:
-            await self.session.close()
+        await self.client.__aexit__(exc_type, exc_val, exc_tb)
 
     async def evaluate_pair(self, source_text: str, target_text: str) -> dict:
         """评估单个源-目标文本对"""
@@ -70,34 +86,46 @@ class GeminiEvaluator:
         prompt = EVALUATION_PROMPT_TEMPLATE.format(source_text=source_text, target_text=target_text)
         
         try:
-            headers = {"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json"}
             payload = {
                 "model": self.model,
                 "messages": [{"role": "user", "content": prompt}],
                 "temperature": 0.1,
                 "response_format": {"type": "json_object"} # 尝试强制模型输出JSON
             }
-            
-            async with self.session.post(f"{self.base_url}/chat/completions", headers=headers, json=payload, timeout=120) as response: # type: ignore
-                if response.status == 200:
-                    response_json = await response.json()
-                    content = response_json['choices'][0]['message']['content']
-                    try:
-                        # 解析模型返回的JSON字符串
-                        evaluation_data = json.loads(content)
-                        logger.info(f"成功评估并打分: {evaluation_data.get('quality_score')}/10")
-                        return evaluation_data
-                    except json.JSONDecodeError:
-                        logger.error(f"无法解析模型返回的JSON: {content}")
-                        return {"error": "Failed to parse JSON response", "raw_response": content}
-                else:
-                    error_text = await response.text()
-                    logger.error(f"API请求失败: {response.status} - {error_text}")
-                    return {"error": f"API Error {response.status}", "details": error_text}
+            stream_kwargs = {}
+            if self.stream_response:
+                payload["stream"] = True
+                payload["stream_options"] = {"include_usage": True}
+                stream_kwargs = {"stream": True, "validator": lambda: IncrementalJSONValidator(SCORE_ENUMS)}
+
+            status, response_json = await self.client.post_chat(payload, timeout=120, **stream_kwargs)
+            if status == 200:
+                content = response_json['choices'][0]['message']['content'] # type: ignore
+                try:
+                    # 解析模型返回的JSON字符串
+                    evaluation_data = json.loads(content)
+                    logger.info(f"成功评估并打分: {evaluation_data.get('quality_score')}/10")
+                    return evaluation_data
+                except json.JSONDecodeError:
+                    logger.error(f"无法解析模型返回的JSON: {content}")
+                    return {"error": "Failed to parse JSON response", "raw_response": content}
+            else:
+                logger.error(f"API请求失败: {status} - {response_json}")
+                return {"error": f"API Error {status}", "details": response_json}
         except Exception as e:
             logger.error(f"评估时发生异常: {e}")
             return {"error": "Exception during evaluation", "details": str(e)}
 
+def iter_batches(rows, batch_size: int):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
 def get_jsonl_files(folder_path: str) -> List[Path]:
     folder = Path(folder_path)
     if not folder.is_dir():
@@ -106,35 +134,57 @@ def get_jsonl_files(folder_path: str) -> List[Path]:
     logger.info(f"在 '{folder_path}' 中找到 {len(files)} 个 .jsonl 文件。")
     return files
 
-async def process_file(evaluator: GeminiEvaluator, input_path: Path, output_path: Path, batch_size: int, delay: float):
+async def process_file(evaluator: GeminiEvaluator, input_path: Path, output_path: Path, batch_size: int,
+                       window: Optional[SlidingWindow] = None, checkpoint_mode: str = "fresh"):
+    """
+    window 不为空时用滑动窗口保持固定在途请求数并按输入顺序写出，否则按批 gather；请求节奏由自适应限速器控制。
+    checkpoint_mode 为 resume / errors 时在已有输出上续跑（见 checkpoint.py），每条结果写出即 flush。
+    """
     logger.info(f"--- 📂 开始处理文件: {input_path.name} ---")
     
     try:
         # 使用pandas逐块读取，更稳健
         chunk_iterator = pd.read_json(input_path, lines=True, chunksize=batch_size)
+        checkpoint = RunCheckpoint(output_path, ("gemini_evaluation",), checkpoint_mode)
+        if checkpoint_mode != "fresh":
+            # 续跑时先过滤掉已完成的记录，再重新按 batch_size 分块
+            rows = checkpoint.pending(row for chunk in chunk_iterator for row in chunk.to_dict('records'))
+            chunk_iterator = (pd.DataFrame(batch) for batch in iter_batches(rows, batch_size))
         
-        with open(output_path, 'w', encoding='utf-8') as f_out:
-            for i, chunk in enumerate(chunk_iterator):
-                logger.info(f"  - 正在处理批次 {i+1} (共 {len(chunk)} 行)...")
+        with checkpoint.open() as f_out:
+            if window is not None:
+                rows = (row for chunk in chunk_iterator for row in chunk.to_dict('records'))
+                done = 0
+                async for original_data, evaluation_result in window.map(
+                        rows, lambda row: evaluator.evaluate_pair(row.get("source_text", ""), row.get("target_text", ""))):
+                    original_data["gemini_evaluation"] = evaluation_result
+                    f_out.write(json.dumps(original_data, ensure_ascii=False) + '\n')
+                    done += 1
+                    if done % batch_size == 0:
+                        logger.info(f"  - 已完成 {done} 行，在途 {window.in_flight}/{window.concurrency}，"
+                                    f"当前速率 {evaluator.client.describe_rates(evaluator.model)}")
+            else:
+                for i, chunk in enumerate(chunk_iterator):
+                    logger.info(f"  - 正在处理批次 {i+1} (共 {len(chunk)} 行)...")
                 
-                tasks = []
-                for _, row in chunk.iterrows():
-                    source = row.get("source_text", "")
-                    target = row.get("target_text", "")
-                    tasks.append(evaluator.evaluate_pair(source, target))
+                    tasks = []
+                    for _, row in chunk.iterrows():
+                        source = row.get("source_text", "")
+                        target = row.get("target_text", "")
+                        tasks.append(evaluator.evaluate_pair(source, target))
                 
-                evaluations = await asyncio.gather(*tasks)
+                    evaluations = await asyncio.gather(*tasks)
                 
-                # 合并原始数据和评估结果并写入文件
-                for index, original_data in chunk.to_dict('index').items():
-                    evaluation_result = evaluations[index % batch_size]
-                    # 将评估结果合并到新字段 "gemini_evaluation" 中
-                    original_data["gemini_evaluation"] = evaluation_result
-                    f_out.write(json.dumps(original_data, ensure_ascii=False) + '\n')
+                    # 合并原始数据和评估结果并写入文件
+                    for evaluation_result, original_data in zip(evaluations, chunk.to_dict('records')):
+                        # 将评估结果合并到新字段 "gemini_evaluation" 中
+                        original_data["gemini_evaluation"] = evaluation_result
+                        f_out.write(json.dumps(original_data, ensure_ascii=False) + '\n')
                 
-                logger.info(f"  - 批次 {i+1} 处理完成并已写入。")
-                await asyncio.sleep(delay)
+                    logger.info(f"  - 批次 {i+1} 处理完成并已写入。")
 
+        if checkpoint_mode != "fresh":
+            logger.info(checkpoint.summary())
         logger.info(f"--- ✅ 文件处理完成: {output_path.name} ---")
 
     except Exception as e:
@@ -149,7 +199,17 @@ async def main():
     parser.add_argument('-u', '--base-url', help='API基础URL (例如 OpenAI 兼容接口)')
     parser.add_argument('-m', '--model', default='gemini-2.5-flash-preview-05-20-nothinking', help='要使用的模型名称')
     parser.add_argument('-b', '--batch-size', type=int, default=10, help='并发处理的批大小')
-    parser.add_argument('-d', '--delay', type=float, default=1.0, help='每批请求间的延迟(秒)')
+    parser.add_argument('-d', '--delay', type=float, help=argparse.SUPPRESS)  # 已废弃，由自适应限速器取代
+    parser.add_argument('-c', '--concurrency', type=int, help='滑动窗口在途请求数，默认等于批大小；0 表示按批 gather')
+    parser.add_argument('--rps', type=float, help='该模型的初始请求速率(次/秒)，随后按 AIMD 自适应调整；默认取 LLM_RATE_LIMITS 或 5')
+    parser.add_argument('--max-rps', type=float, help='自适应速率上限(次/秒)')
+    parser.add_argument('--max-concurrency', type=int, help='该模型同时在途请求数上限')
+    parser.add_argument('--max-retries', type=int, default=DEFAULT_MAX_RETRIES, help='超时、连接错误、429/5xx 的最大重试次数（4xx 不重试）；0 表示不重试')
+    parser.add_argument('--backends', help='多后端列表（json 字符串或文件路径，见 backend_pool.py），按近期耗时与错误率选择后端；默认取 LLM_BACKENDS')
+    parser.add_argument('--metrics-dir', default=DEFAULT_METRICS_DIR, help='每次模型调用的指标（requests.jsonl）与运行汇总（summary.json / metrics.prom）的输出目录；默认取 LLM_METRICS_DIR，未设置时不写出')
+    parser.add_argument('--stream-response', action='store_true', help='流式接收响应，边接收边校验 json，输出无效时提前中止并重新请求；统计首 token 与得到合法 JSON 的耗时')
+    parser.add_argument('--resume', action='store_true', help='断点续跑：跳过输出中已完成且未出错的记录，追加处理其余记录')
+    parser.add_argument('--retry-errors', action='store_true', help='只重跑输出中结果为 {"error": ...} 的记录')
     args = parser.parse_args()
 
     api_key = args.api_key or os.getenv('GEMINI_API_KEY')
@@ -157,25 +217,48 @@ async def main():
         logger.error("❌ 必须提供API密钥! 请通过 --api-key 参数或 GEMINI_API_KEY 环境变量设置。")
         return
 
+    if args.delay is not None:
+        logger.warning("--delay 已废弃，请求节奏由自适应限速器控制，请改用 --rps / --max-rps。")
+    configure_rate_limit(args.model, rps=args.rps, max_rps=args.max_rps, concurrency=args.max_concurrency)
+    try:
+        backends = load_backends(args.backends, api_key) if args.backends else None
+    except ValueError as e:
+        logger.error(f"❌ {e}")
+        return
+
     # 创建输出文件夹
     output_dir = Path(args.output_folder)
     output_dir.mkdir(parents=True, exist_ok=True)
     
+    metrics = MetricsRecorder(args.metrics_dir)
     start_time = time.time()
     try:
         jsonl_files = get_jsonl_files(args.input_folder)
         if not jsonl_files:
             return
 
-        async with GeminiEvaluator(api_key, args.base_url, args.model) as evaluator:
+        checkpoint_mode = "errors" if args.retry_errors else "resume" if args.resume else "fresh"
+        concurrency = args.batch_size if args.concurrency is None else args.concurrency
+        window = SlidingWindow(concurrency) if concurrency > 0 else None
+        client = LLMClient(api_key, args.base_url, max_retries=args.max_retries, backends=backends,
+                           metrics=metrics)
+        async with GeminiEvaluator(api_key, args.base_url, args.model, client=client,
+                                   stream_response=args.stream_response) as evaluator:
             for input_file in jsonl_files:
                 # 定义输出文件名
                 output_file = output_dir / f"{input_file.stem}_evaluated.jsonl"
-                await process_file(evaluator, input_file, output_file, args.batch_size, args.delay)
+                await process_file(evaluator, input_file, output_file, args.batch_size, window, checkpoint_mode)
+            evaluator.client.log_pool_stats()
+            for limiter in all_rate_limiters().values():
+                logger.info(limiter.describe())
+            if window is not None:
+                logger.info(window.summary("行"))
 
     except Exception as e:
         logger.error(f"程序执行期间发生未捕获的错误: {e}")
     finally:
+        metrics.write_summary()
+        metrics.close()
         end_time = time.time()
         logger.info(f"🚀 全部任务完成，总耗时: {end_time - start_time:.2f} 秒。")
 
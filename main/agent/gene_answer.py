@@ -5,23 +5,47 @@
 """
 import os
 import json
-import base64
 import argparse
 import logging
 from pathlib import Path
-from typing import List, Dict
+from typing import List, Dict, Optional
 import time
 import asyncio
 import aiohttp
 import pandas as pd
+import sys
+import base64
+from collections import Counter
 from PIL import Image
-import io
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from image_codec import DEFAULT_MAX_SIZE, DEFAULT_QUALITY, encode_pil_image
+from image_codec import encode_image, encode_path_stats, image_available, estimate_image_tokens, get_profile, MODEL_PROFILES, PreEncoder, pull_next
+from request_body import build_streaming_body, load_image_payload, ImagePayload, IMAGE_PLACEHOLDER
+from image_screen import ImageScreener
+from scheduler import SlidingWindow
+from llm_client import LLMClient, DEFAULT_BASE_URL, DEFAULT_MAX_RETRIES
+from backend_pool import load_backends
+from stream_validator import IncrementalJSONValidator, enum_schema
+from rate_limiter import all_rate_limiters, configure_rate_limit
+from resilience import CircuitOpenError
+from hedging import Hedger
+from metrics import MetricsRecorder, DEFAULT_METRICS_DIR
+from response_cache import ResponseCache, DEFAULT_CACHE_MODE, request_digest
+from single_flight import SingleFlight, is_deterministic
+from checkpoint import RunCheckpoint
+from frame_dedup import FrameDeduplicator, DEFAULT_HASH_THRESHOLD
+from two_pass import (COARSE_PROMPT_TEMPLATE, build_fine_prompt, coarse_regions, crop_box, fit_size,
+                      merge_results)
 
 
 # --- 设置日志 ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# 允许以逗号给出多个备选项的键(流式校验用)
+MULTI_VALUE_KEYS = ("上衣颜色", "下装颜色")
+
 # --- Prompt 模板 ---
 EVALUATION_PROMPT_TEMPLATE = """
 {source_text}
@@ -125,54 +149,120 @@ EVALUATION_PROMPT_TEMPLATE = """
 
 """
 
+# 预筛给出昼夜先验时从 prompt 中去掉的片段(模版与示例中的 是否为黑夜)
+NIGHT_PROMPT_FRAGMENTS = ('"是否为黑夜":"是，否，unknown",\n', '"是否为黑夜": "否",\n', '"是否为黑夜": "不确定",\n')
+
+
+def drop_night_field(prompt: str) -> str:
+    for fragment in NIGHT_PROMPT_FRAGMENTS:
+        prompt = prompt.replace(fragment, "")
+    return prompt
+
+
+def apply_night_prior(result, night_prior: Optional[str]):
+    """把预筛得到的 是否为黑夜 写回结果(保持其在首位)"""
+    if night_prior is None or not isinstance(result, dict) or "error" in result:
+        return result
+    return {"是否为黑夜": night_prior, **{k: v for k, v in result.items() if k != "是否为黑夜"}}
+
+
+# 多图打包时追加在模版之后的说明,{count} 为本次请求的图片数
+PACKED_PROMPT_SUFFIX = """
+多图说明:
+- 本次共有 {count} 张图片,每张图片前有"图片N"编号及该图片的说明文字,各图片相互独立,分别按上述模版作答。
+- 输出一个长度为 {count} 的 json 数组,第 N 项为图片N 的结果,每项结构与模版相同,并额外加入字段 "图片编号": N。
+- 只输出该 json 数组,不要给出解释或说明
+"""
+
+
 class GeminiEvaluator:
     """图文评估处理器"""
-    def __init__(self, api_key: str, base_url: str = None, model: str = "gemini-2.5-flash-preview-05-20-nothinking"): # type: ignore
+    def __init__(self, api_key: str, base_url: str = None, model: str = "gemini-2.5-flash-preview-05-20-nothinking", # type: ignore
+                 encode_kwargs: Optional[dict] = None, stream_body: bool = False, two_pass: bool = False,
+                 coarse_size: tuple = (768, 512), crop_size: int = 768, pack_size: int = 1,
+                 client: Optional[LLMClient] = None, response_cache: Optional[ResponseCache] = None,
+                 temperature: float = 0.3, coalesce: bool = True, stream_response: bool = False):
         self.api_key = api_key
-        self.base_url = base_url or "https://one-api.modelbest.co/v1"
+        self.base_url = base_url or DEFAULT_BASE_URL
         self.model = model
-        self.session = None
+        self.encode_kwargs = encode_kwargs or {}  # 同步编码时透传给 encode_image
+        self.stream_body = stream_body  # 图片 Base64 分块写入请求体,不构造完整 JSON
+        self.image_tokens = 0  # 按 profile 估算的图像 tokens 累计
+        self.image_count = 0
+        self.two_pass = two_pass  # 由粗到细两阶段识别
+        self.coarse_size = coarse_size  # 第一阶段全图尺寸
+        self.crop_size = crop_size  # 第二阶段局部图长边上限
+        self.two_pass_stats = Counter()
+        self.pack_size = pack_size  # 每次请求打包的图片数,1 表示不打包
+        self.pack_stats = Counter()
+        self.usage = Counter()  # 接口返回的 usage 累计(prompt_tokens / completion_tokens 等)
+        # 两阶段节省统计使用的计费参数,未指定 profile 时按模型名推断,默认按 Gemini
+        self.billing_profile = self.encode_kwargs.get("profile") or get_profile("auto", model) or MODEL_PROFILES["gemini"]
+        # 共享连接池的客户端,未传入时自建
+        self.client = client or LLMClient(api_key, self.base_url)
+        # 模型响应缓存,为 None 时每次都请求接口
+        self.cache = response_cache
+        self.temperature = temperature
+        # 相同的确定性请求同时在途时只发一次(temperature > 0 时自动不合并)
+        self.single_flight = SingleFlight() if coalesce else None
+        # 流式接收响应,边接收边校验 json 结构与备选项,输出无效时提前中止并重新请求
+        self.stream_response = stream_response
 
     async def __aenter__(self):
-        self.session = aiohttp.ClientSession()
+        await self.client.__aenter__()
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        if self.session:
-            await self.session.close()
+        await self.client.__aexit__(exc_type, exc_val, exc_tb)
 
-    
-    def encode_image(self, image_path: str, max_size: tuple = (2400, 1600)) -> str:
-        """更接近 GPT-4o 网页端的图像编码器:压缩图像并转为 Base64"""
-        try:
-            with Image.open(image_path) as img:
-                img = img.convert("RGB")  # 确保无 alpha 通道
-
-                # 如果图像大于设定尺寸则缩放
-                if img.size[0] > max_size[0] or img.size[1] > max_size[1]:
-                    img.thumbnail(max_size, Image.Resampling.LANCZOS)
-
-                buffer = io.BytesIO()
-                img.save(buffer, format="JPEG", quality=85)  # 控制质量以减少体积
-                buffer.seek(0)
-
-                encoded = base64.b64encode(buffer.read()).decode("utf-8")
-
-                logger.debug(f"图像编码完成,base64 长度:{len(encoded)} 字符")
-                return encoded
-
-        except Exception as e:
-            logger.error(f"图片处理失败: {e}")
-            raise
 
     
-    async def evaluate_pair(self, source_text: str, image_path: str):
-        """评估图文输入对,增强为类似 ChatGPT 网页版风格"""
-        if not source_text or not image_path or not os.path.exists(image_path):
+    async def evaluate_pair(self, source_text: str, image_path: str, image_base64: Optional[str] = None,
+                            two_pass: Optional[bool] = None, night_prior: Optional[str] = None,
+                            sample_index: Optional[int] = None):
+        """
+        评估图文输入对,增强为类似 ChatGPT 网页版风格;image_base64 为预编码结果,缺省时在此同步编码。
+        night_prior 为预筛得到的 是否为黑夜,给出时不再让模型判断该项。
+        sample_index 为该记录在相同请求中的采样序号(见 checkpoint.py),用作响应缓存键,续跑时与完整运行一致。
+        """
+        if not source_text or not image_path or not image_available(image_path):
             return {"error": "Source text 或图片路径为空/无效"}
+        # 两阶段需要裁剪原图,仅分片中存在的图片仍走单次请求
+        if (self.two_pass if two_pass is None else two_pass) and os.path.exists(image_path):
+            return await self.evaluate_pair_two_pass(source_text, image_path, night_prior, sample_index)
+
+        image = None
+        if self.stream_body:
+            if image_base64 is not None:
+                image = ImagePayload(b64=image_base64)
+            else:
+                image = await asyncio.to_thread(load_image_payload, image_path, **self.encode_kwargs)
+            image_url = IMAGE_PLACEHOLDER
+        else:
+            if image_base64 is None:
+                image_base64 = await asyncio.to_thread(encode_image, image_path, **self.encode_kwargs)
+            image_url = f"data:image/jpeg;base64,{image_base64}"
+
+        profile = self.encode_kwargs.get("profile")
+        if profile is not None:
+            tokens = estimate_image_tokens(image_path, profile)
+            self.image_tokens += tokens
+            self.image_count += 1
+            logger.info(f"预计图像 tokens: {tokens} ({profile.name})")
 
-        image_base64 = self.encode_image(image_path)
-
+        user_prompt = EVALUATION_PROMPT_TEMPLATE.format(source_text=source_text)
+        if night_prior is not None:
+            user_prompt = drop_night_field(user_prompt)
+        result = await self._chat(user_prompt, image_url, image, image_path, sample_index=sample_index)
+        return apply_night_prior(result, night_prior)
+
+    async def _chat(self, user_prompt: str, image_url: str, image: Optional[ImagePayload] = None, image_path: str = "",
+                    user_content: Optional[list] = None, sample_index: Optional[int] = None):
+        """
+        发送一条图文请求并解析 json 输出;image 不为空时流式写出请求体。
+        user_content 给出时直接作为 user 消息内容(多图打包),忽略 user_prompt 与 image_url。
+        sample_index 为响应缓存的采样序号,缺省时按本次运行内的出现次数编号。
+        """
         # ✅ 新增:更接近 ChatGPT 的 system prompt
         system_prompt = (
  "You are a multimodal assistant that can precisely understand and interpret images along with instructions."
@@ -181,58 +271,229 @@ class GeminiEvaluator:
     " Respond only with a valid JSON object when asked to output in that format."
         )
 
-        user_prompt = EVALUATION_PROMPT_TEMPLATE.format(source_text=source_text)
-
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
-
         payload = {
             "model": self.model,
-            "temperature": 0.3,
+            "temperature": self.temperature,
             "top_p": 1.0,
             "frequency_penalty": 0,
             "presence_penalty": 0,
             "messages": [
                 {"role": "system", "content": system_prompt},
-                {"role": "user", "content": [
+                {"role": "user", "content": user_content or [
                     {"type": "text", "text": user_prompt},
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}}
+                    {"type": "image_url", "image_url": {"url": image_url}}
                 ]}
             ]
         }
 
-        try:
-            async with self.session.post(f"{self.base_url}/chat/completions", headers=headers, json=payload, timeout=300) as response: # type: ignore
-                if response.status == 200:
-                    result = await response.json()
-                    content = result['choices'][0]['message']['content']
-                    print(image_path)
-                    print(f"模型输出: {content}")
-
-                    # ✅ 更健壮的 JSON 清洗逻辑
-                    if content.strip().startswith("```json"):
-                        content = content.strip()[7:]
-                        content = content.strip("`").strip()
+        stream_kwargs = {}
+        if self.stream_response:
+            payload["stream"] = True
+            payload["stream_options"] = {"include_usage": True}
+            # 备选项取自本次 prompt 中的 json 模版(单图、打包、两阶段各自不同)
+            prompt_text = user_prompt if user_content is None else "".join(
+                part.get("text", "") for part in user_content if part.get("type") == "text")
+            enums = enum_schema(prompt_text)
+            stream_kwargs = {"stream": True, "validator": lambda: IncrementalJSONValidator(enums, MULTI_VALUE_KEYS)}
+
+        request_kwargs = {"payload": payload}
+        if image is not None:
+            # 流式请求体只能读取一次,传入构造函数以便重试时重新生成;模型名取所选后端的别名
+            request_kwargs = {"data": lambda model: build_streaming_body(dict(payload, model=model), image)}
+
+        coalesce = self.single_flight is not None and is_deterministic(payload)
+        digest = None
+        if coalesce or (self.cache is not None and self.cache.enabled):
+            digest = request_digest(self.model, payload["messages"], payload, images=[image] if image is not None else ())
+        cache_key = self.cache.key_for_digest(digest, payload, sample_index) if self.cache is not None and digest else None
 
-                    try:
-                        evaluation_data = json.loads(content)
-                        logger.info("图文任务成功。")
-                        return evaluation_data
-                    except json.JSONDecodeError:
-                        logger.warning("输出非标准 JSON,原始输出已返回。")
-                        return {"error": "无法解析模型输出", "raw_response": content}
+        try:
+            cached = self.cache.get(cache_key) if cache_key else None
+            shared = False
+            if cached is not None:
+                result = json.loads(cached)
+            else:
+                async def send():
+                    return await self.client.post_chat(timeout=300, model=self.model, **request_kwargs, **stream_kwargs)
+
+                if coalesce:
+                    (status, result), shared = await self.single_flight.do(digest, send)  # type: ignore
                 else:
-                    error_text = await response.text()
-                    return {"error": f"API Error {response.status}", "details": error_text}
+                    status, result = await send()
+                if status != 200:
+                    return {"error": f"API Error {status}", "details": result}
+                # 合并得到的结果不重复计入用量
+                if not shared:
+                    self.usage["requests"] += 1
+                    for key, value in (result.get("usage") or {}).items():  # type: ignore
+                        if isinstance(value, int):
+                            self.usage[key] += value
+
+            content = result['choices'][0]['message']['content']  # type: ignore
+            print(image_path)
+            print(f"模型输出: {content}")
+
+            # ✅ 更健壮的 JSON 清洗逻辑
+            if content.strip().startswith("```json"):
+                content = content.strip()[7:]
+                content = content.strip("`").strip()
+
+            try:
+                evaluation_data = json.loads(content)
+                logger.info("图文任务成功。")
+                # 只缓存能解析的输出,解析失败的请求重跑时仍会重新请求
+                if cache_key and cached is None and not shared:
+                    self.cache.put(cache_key, json.dumps(result, ensure_ascii=False), self.model)  # type: ignore
+                return evaluation_data
+            except json.JSONDecodeError:
+                logger.warning("输出非标准 JSON,原始输出已返回。")
+                return {"error": "无法解析模型输出", "raw_response": content}
         except asyncio.TimeoutError:
             return {"error": "请求超时", "details": "Request timeout"}
         except aiohttp.ClientError as e:
             return {"error": "网络连接失败", "details": str(e)}
-
-
-
+        except CircuitOpenError as e:
+            return {"error": "接口持续不可用(熔断)", "details": str(e)}
+
+
+
+
+    async def evaluate_packed(self, items: List[tuple]) -> List[dict]:
+        """
+        多图打包:items 为 (source_text, image_path, image_base64, night_prior, sample_index) 列表,一次请求识别全部图片。
+        打包请求以第一张图片的采样序号作为缓存序号:内容完全相同的两个包,其第一条记录的序号必然不同。
+        模型返回 json 数组,按 "图片编号"(缺失时按顺序)拆回各条;解析失败的槽位单独回退为单图请求。
+        """
+        if len(items) == 1:
+            source_text, image_path, image_base64, night_prior, sample_index = items[0]
+            return [await self.evaluate_pair(source_text, image_path, image_base64, night_prior=night_prior,
+                                             sample_index=sample_index)]
+
+        user_content = [{"type": "text", "text": EVALUATION_PROMPT_TEMPLATE.format(source_text="")
+                         + PACKED_PROMPT_SUFFIX.format(count=len(items))}]
+        valid = []  # 有效槽位在 items 中的下标
+        for index, (source_text, image_path, image_base64, _, _) in enumerate(items):
+            if not source_text or not image_path or not image_available(image_path):
+                continue
+            if image_base64 is None:
+                image_base64 = await asyncio.to_thread(encode_image, image_path, **self.encode_kwargs)
+            valid.append(index)
+            user_content.append({"type": "text", "text": f"图片{len(valid)}: {source_text}"})
+            user_content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}})
+
+        slots: Dict[int, dict] = {}
+        if valid:
+            packed = await self._chat("", "", image_path=", ".join(items[i][1] for i in valid), user_content=user_content,
+                                      sample_index=items[valid[0]][4])
+            if isinstance(packed, list):
+                for position, entry in enumerate(packed):
+                    if not isinstance(entry, dict):
+                        continue
+                    number = entry.pop("图片编号", position + 1)
+                    try:
+                        number = int(number)
+                    except (TypeError, ValueError):
+                        number = position + 1
+                    if 1 <= number <= len(valid) and number not in slots:
+                        slots[number] = entry
+            self.pack_stats["requests"] += 1
+            self.pack_stats["images"] += len(valid)
+
+        results = []
+        fallbacks = []
+        for index, (source_text, image_path, image_base64, night_prior, _) in enumerate(items):
+            number = valid.index(index) + 1 if index in valid else None
+            if number in slots:
+                results.append(apply_night_prior(slots[number], night_prior))
+            else:
+                # 无效输入由 evaluate_pair 返回错误,解析失败的槽位单独重试
+                results.append(None)
+                fallbacks.append(index)
+        self.pack_stats["fallbacks"] += sum(1 for i in fallbacks if i in valid)
+        if fallbacks:
+            singles = await asyncio.gather(*[
+                self.evaluate_pair(items[i][0], items[i][1], items[i][2], night_prior=items[i][3], sample_index=items[i][4])
+                for i in fallbacks])
+            for i, result in zip(fallbacks, singles):
+                results[i] = result
+        return results
+
+    def _crop_regions(self, image_path: str, coarse: dict, quality: int):
+        """
+        按第一阶段的区域框裁剪原图并编码(在线程中调用)。
+        返回 (原图尺寸, 第一阶段发送尺寸, [(区域, 局部图尺寸, base64)]);任一区域框无效时局部图列表为 None。
+        """
+        with Image.open(image_path) as img:
+            size = img.size
+            coarse_dims = fit_size(size, self.coarse_size)
+            crops = []
+            for region in coarse_regions(coarse):
+                box = crop_box(region.get("框"), size)
+                if box is None:
+                    logger.warning(f"区域 {region['位置']} 的框无效,回退单次请求: {image_path}")
+                    return size, coarse_dims, None
+                crop = img.crop(box)
+                crop_dims = fit_size(crop.size, (self.crop_size, self.crop_size))
+                crop_b64 = base64.b64encode(encode_pil_image(crop, (self.crop_size, self.crop_size), quality)).decode("utf-8")
+                crops.append((region, crop_dims, crop_b64))
+        return size, coarse_dims, crops
+
+    async def evaluate_pair_two_pass(self, source_text: str, image_path: str, night_prior: Optional[str] = None,
+                                     sample_index: Optional[int] = None):
+        """
+        由粗到细两阶段识别:低分辨率全图定位有人/物品的区域,再对这些区域裁剪高分辨率局部图识别细节。
+        结果结构与单次请求一致;第一阶段或任一局部请求失败时回退为单次全图请求。
+        """
+        quality = self.encode_kwargs.get("quality", DEFAULT_QUALITY)
+        # 解码、缩放与裁剪都在线程中进行,不阻塞其他在途请求
+        coarse_b64 = await asyncio.to_thread(encode_image, image_path, max_size=self.coarse_size, quality=quality,
+                                             fast_resize=self.encode_kwargs.get("fast_resize", False))
+        coarse_prompt = COARSE_PROMPT_TEMPLATE.format(source_text=source_text)
+        if night_prior is not None:
+            coarse_prompt = drop_night_field(coarse_prompt)
+        coarse = await self._chat(coarse_prompt, f"data:image/jpeg;base64,{coarse_b64}", image_path=image_path,
+                                  sample_index=sample_index)
+        if not isinstance(coarse, dict) or "error" in coarse:
+            logger.warning(f"第一阶段失败,回退单次请求: {image_path}")
+            self.two_pass_stats["fallbacks"] += 1
+            return await self.evaluate_pair(source_text, image_path, two_pass=False, night_prior=night_prior,
+                                              sample_index=sample_index)
+
+        size, coarse_dims, crops = await asyncio.to_thread(self._crop_regions, image_path, coarse, quality)
+        if crops is None:
+            self.two_pass_stats["fallbacks"] += 1
+            return await self.evaluate_pair(source_text, image_path, two_pass=False, night_prior=night_prior,
+                                            sample_index=sample_index)
+
+        fine_outputs = await asyncio.gather(*[
+            self._chat(build_fine_prompt(source_text, region), f"data:image/jpeg;base64,{crop_b64}", image_path=image_path,
+                       sample_index=sample_index)
+            for region, _, crop_b64 in crops
+        ])
+        if any(not isinstance(fine, dict) or "error" in fine for fine in fine_outputs):
+            logger.warning(f"第二阶段局部请求失败,回退单次请求: {image_path}")
+            self.two_pass_stats["fallbacks"] += 1
+            return await self.evaluate_pair(source_text, image_path, two_pass=False, night_prior=night_prior,
+                                              sample_index=sample_index)
+
+        # 与单次请求相比的像素与图像 tokens
+        profile = self.billing_profile
+        full_dims = profile.plan(size) if self.encode_kwargs.get("profile") else fit_size(size, DEFAULT_MAX_SIZE)
+        sent = [coarse_dims] + [dims for _, dims, _ in crops]
+        full_pixels, sent_pixels = full_dims[0] * full_dims[1], sum(w * h for w, h in sent)
+        full_tokens, sent_tokens = profile.tokens(full_dims), sum(profile.tokens(dims) for dims in sent)
+        stats = self.two_pass_stats
+        stats["images"] += 1
+        stats["regions"] += len(crops)
+        stats["full_pixels"] += full_pixels
+        stats["sent_pixels"] += sent_pixels
+        stats["full_tokens"] += full_tokens
+        stats["sent_tokens"] += sent_tokens
+        logger.info(f"两阶段: {len(crops)} 个区域,像素 {full_pixels} → {sent_pixels} (节省 {full_pixels - sent_pixels}),"
+                    f"图像 tokens {full_tokens} → {sent_tokens} (节省 {full_tokens - sent_tokens}, {profile.name})")
+
+        merged = merge_results(coarse, list(zip([region for region, _, _ in crops], fine_outputs)))
+        return apply_night_prior(merged, night_prior)
 
     # async def evaluate_pair(self, source_text: str, image_path: str):
     #     """评估图文输入对"""
@@ -315,36 +576,172 @@ def get_jsonl_files(folder_path: str) -> List[Path]:
 
 
 
-async def process_file(evaluator: GeminiEvaluator, input_path: Path, output_path: Path, batch_size: int, delay: float):
+def read_rows(input_path: Path, batch_size: int):
+    """逐行读取 jsonl(内部仍按 batch_size 分块读取)"""
+    for chunk in pd.read_json(input_path, lines=True, chunksize=batch_size):
+        yield from chunk.to_dict('records')
+
+
+async def iter_rows(rows):
+    """不预编码时逐行产出 (row, None),在请求内同步编码;上游的读取与过滤在线程中进行,不阻塞在途请求"""
+    rows = iter(rows)
+    end = object()
+    while True:
+        original_data = await pull_next(rows, end)
+        if original_data is end:
+            return
+        yield original_data, None
+
+
+async def screen_rows(encoded_rows, batch_size: int, screener: Optional[ImageScreener] = None):
+    """按 batch_size 攒行做向量化预筛,逐行产出 (original_data, image_base64, image_path, screen)"""
+    batch = []
+
+    async def flush():
+        image_paths = [original_data.get("image_path", "") for original_data, _ in batch]
+        if screener is not None:
+            screens = await asyncio.to_thread(screener.screen_batch, image_paths)
+        else:
+            screens = [None] * len(batch)
+        return [(original_data, image_base64, image_path, screen)
+                for (original_data, image_base64), image_path, screen in zip(batch, image_paths, screens)]
+
+    async for original_data, image_base64 in encoded_rows:
+        batch.append((original_data, image_base64))
+        if len(batch) >= batch_size:
+            for row in await flush():
+                yield row
+            batch = []
+    if batch:
+        for row in await flush():
+            yield row
+
+
+async def group_rows(rows, size: int):
+    """把行按 size 分组(多图打包时一组即一次请求,否则每组一行)"""
+    group = []
+    async for row in rows:
+        group.append(row)
+        if len(group) >= size:
+            yield group
+            group = []
+    if group:
+        yield group
+
+
+async def evaluate_group(evaluator: GeminiEvaluator, group: list, checkpoint: Optional[RunCheckpoint] = None) -> list:
+    """
+    评估一组行,返回与 group 等长的结果;预筛判定不可用的帧直接标记抛弃,不发送请求。
+    checkpoint 给出各行的采样序号(响应缓存键),续跑时与完整运行一致。
+    """
+    evaluations = [None] * len(group)
+    pending = []
+    for index, (original_data, image_base64, image_path, screen) in enumerate(group):
+        if screen is not None and not screen["可用"]:
+            evaluations[index] = {"是否抛弃": "抛弃", "预筛": screen}
+            continue
+        night_prior = screen["是否为黑夜"] if screen is not None else None
+        sample_index = checkpoint.sample_index(original_data) if checkpoint is not None else None
+        pending.append((index, (original_data.get("source_text", ""), image_path, image_base64, night_prior,
+                                sample_index)))
+
+    if evaluator.pack_size > 1 and pending:
+        results = await evaluator.evaluate_packed([item for _, item in pending])
+    else:
+        results = await asyncio.gather(*[
+            evaluator.evaluate_pair(source, image_path, image_base64, night_prior=night_prior, sample_index=sample_index)
+            for _, (source, image_path, image_base64, night_prior, sample_index) in pending])
+    for (index, _), result in zip(pending, results):
+        evaluations[index] = result
+    return evaluations
+
+
+def write_result(f_out, original_data: dict, evaluation_result, deduper: Optional[FrameDeduplicator] = None,
+                 checkpoint: Optional[RunCheckpoint] = None):
+    if checkpoint is not None:
+        checkpoint.release(original_data)
+    original_data["gemini_response"] = evaluation_result
+    f_out.write(json.dumps(original_data, ensure_ascii=False) + '\n')
+    if deduper is not None:
+        for member in deduper.pop_members(original_data):
+            if checkpoint is not None:
+                checkpoint.release(member)
+            member["gemini_response"] = evaluation_result
+            member["近重复代表"] = original_data.get("image_path", "")
+            f_out.write(json.dumps(member, ensure_ascii=False) + '\n')
+
+
+async def process_file(evaluator: GeminiEvaluator, input_path: Path, output_path: Path, batch_size: int,
+                       pre_encoder: Optional[PreEncoder] = None, screener: Optional[ImageScreener] = None,
+                       deduper: Optional[FrameDeduplicator] = None, window: Optional[SlidingWindow] = None,
+                       checkpoint_mode: str = "fresh"):
+    """
+    window 不为空时用滑动窗口调度:始终保持 window.concurrency 个请求在途,按输入顺序写出;
+    否则按批 gather。请求节奏统一由 LLMClient 中按模型共享的自适应限速器控制。
+    checkpoint_mode 为 resume / errors 时在已有输出上续跑(见 checkpoint.py),每条结果写出即 flush。
+    """
     logger.info(f"--- 处理文件: {input_path.name} ---")
 
     try:
-        chunk_iterator = pd.read_json(input_path, lines=True, chunksize=batch_size)
-
-        with open(output_path, 'w', encoding='utf-8') as f_out:
-            for i, chunk in enumerate(chunk_iterator):
-                logger.info(f"  - 批次 {i+1} 中的 {len(chunk)} 行数据...")
+        checkpoint = RunCheckpoint(output_path, ("gemini_response", "近重复代表"), checkpoint_mode,
+                                   sample_fields=("source_text", "image_path"))
+        rows = checkpoint.pending(read_rows(input_path, batch_size))
+        # 近重复帧只保留每簇代表帧,其余帧在写出时复用代表帧结果
+        if deduper is not None:
+            rows = deduper.representatives(rows)
+        # 有预编码器时,编码在进程池中提前进行,与下面的 HTTP 请求重叠
+        if pre_encoder is not None:
+            encoded_rows = pre_encoder.map(rows)
+        else:
+            encoded_rows = iter_rows(rows)
+        screened = screen_rows(encoded_rows, batch_size, screener)
+
+        with checkpoint.open() as f_out:
+            if window is not None:
+                done = 0
+                async for group, evaluations in window.map(group_rows(screened, evaluator.pack_size),
+                                                           lambda group: evaluate_group(evaluator, group, checkpoint)):
+                    for (original_data, *_), evaluation_result in zip(group, evaluations):
+                        write_result(f_out, original_data, evaluation_result, deduper, checkpoint)
+                    done += len(group)
+                    if done // batch_size != (done - len(group)) // batch_size:
+                        logger.info(f"  - 已完成 {done} 行,在途 {window.in_flight}/{window.concurrency},"
+                                    f"当前速率 {evaluator.client.describe_rates(evaluator.model)}")
+            else:
+                batch = []
+                i = 0
+                async for row in screened:
+                    batch.append(row)
+                    if len(batch) < batch_size:
+                        continue
+                    await run_batch(evaluator, batch, i, f_out, deduper, checkpoint)
+                    batch = []
+                    i += 1
+
+                if batch:
+                    await run_batch(evaluator, batch, i, f_out, deduper, checkpoint)
+
+        if checkpoint_mode != "fresh":
+            logger.info(checkpoint.summary())
+        logger.info(f"--- 完成文件处理: {output_path.name} ---")
 
-                tasks = []
-                for _, row in chunk.iterrows():
-                    source = row.get("source_text", "")
-                    image_path = row.get("image_path", "")
-                    tasks.append(evaluator.evaluate_pair(source, image_path))
+    except Exception as e:
+        logger.error(f"文件 {input_path.name} 出错: {e}", exc_info=True)
 
-                evaluations = await asyncio.gather(*tasks)
 
-                for index, original_data in chunk.to_dict('index').items():
-                    evaluation_result = evaluations[index % batch_size]
-                    original_data["gemini_response"] = evaluation_result
-                    f_out.write(json.dumps(original_data, ensure_ascii=False) + '\n')
+async def run_batch(evaluator: GeminiEvaluator, batch: list, i: int, f_out, deduper: Optional[FrameDeduplicator] = None,
+                    checkpoint: Optional[RunCheckpoint] = None):
+    logger.info(f"  - 批次 {i+1} 中的 {len(batch)} 行数据...")
 
-                logger.info(f"  - 批次 {i+1} 完成 ✅")
-                await asyncio.sleep(delay)
+    size = evaluator.pack_size
+    groups = [batch[k:k + size] for k in range(0, len(batch), size)]
+    group_results = await asyncio.gather(*[evaluate_group(evaluator, group, checkpoint) for group in groups])
 
-        logger.info(f"--- 完成文件处理: {output_path.name} ---")
+    for group, evaluations in zip(groups, group_results):
+        for (original_data, *_), evaluation_result in zip(group, evaluations):
+            write_result(f_out, original_data, evaluation_result, deduper, checkpoint)
 
-    except Exception as e:
-        logger.error(f"文件 {input_path.name} 出错: {e}", exc_info=True)
+    logger.info(f"  - 批次 {i+1} 完成 ✅")
 
 
 
@@ -362,8 +759,48 @@ async def main():
     parser.add_argument('-u', '--base-url', help='API Base URL')
     parser.add_argument('-m', '--model', default='gemini-2.5-flash-preview-05-20-nothinking', help='使用的模型名称')
     parser.add_argument('-b', '--batch-size', type=int, default=5, help='每批处理数量')
-    parser.add_argument('-d', '--delay', type=float, default=1.0, help='批次之间的延迟秒数')
+    parser.add_argument('-d', '--delay', type=float, help=argparse.SUPPRESS)  # 已废弃,由自适应限速器取代
+    parser.add_argument('-c', '--concurrency', type=int, help='滑动窗口在途请求数,默认等于批大小;0 表示按批 gather')
+    parser.add_argument('--rps', type=float, help='该模型的初始请求速率(次/秒),随后按 AIMD 自适应调整;默认取 LLM_RATE_LIMITS 或 5')
+    parser.add_argument('--max-rps', type=float, help='自适应速率上限(次/秒)')
+    parser.add_argument('--max-concurrency', type=int, help='该模型同时在途请求数上限')
+    parser.add_argument('--max-retries', type=int, default=DEFAULT_MAX_RETRIES, help='超时、连接错误、429/5xx 的最大重试次数(4xx 不重试);0 表示不重试')
+    parser.add_argument('--backends', help='多后端列表(json 字符串或文件路径,见 backend_pool.py),按近期耗时与错误率选择后端;默认取 LLM_BACKENDS')
+    parser.add_argument('--hedge-percentile', type=float, help='请求耗时超过最近成功请求的该百分位(如 95)时发出对冲请求,先返回者胜出;默认不对冲')
+    parser.add_argument('--hedge-max-extra', type=float, default=0.1, help='对冲请求数占请求总数的上限(额外负载上限)')
+    parser.add_argument('--metrics-dir', default=DEFAULT_METRICS_DIR, help='每次模型调用的指标(requests.jsonl)与运行汇总(summary.json / metrics.prom)的输出目录;默认取 LLM_METRICS_DIR,未设置时不写出')
+    parser.add_argument('--temperature', type=float, default=0.3, help='采样温度;为 0 时相同的在途请求自动合并')
+    parser.add_argument('--stream-response', action='store_true', help='流式接收响应,边接收边校验 json 结构与备选项,输出无效时提前中止并重新请求;统计首 token 与得到合法 JSON 的耗时')
+    parser.add_argument('--no-coalesce', action='store_true', help='不合并相同的在途请求')
+    parser.add_argument('--resume', action='store_true', help='断点续跑:跳过输出中已完成且未出错的记录,追加处理其余记录')
+    parser.add_argument('--retry-errors', action='store_true', help='只重跑输出中结果为 {"error": ...} 的记录')
+    parser.add_argument('--no-cache', action='store_true', help='不使用模型响应缓存(既不读也不写)')
+    parser.add_argument('--refresh-cache', action='store_true', help='忽略已缓存的响应,重新请求并覆盖缓存')
+    parser.add_argument('--cache-max-mb', type=int, help='响应缓存大小上限(MB),超出时按最近访问淘汰;默认取 RESPONSE_CACHE_MAX_MB 或 512')
+    parser.add_argument('-w', '--encode-workers', type=int, default=os.cpu_count(), help='图片预编码进程数,0 表示在请求内同步编码')
+    parser.add_argument('--encode-lookahead', type=int, default=16, help='预编码最多领先 HTTP 阶段的条数')
+    parser.add_argument('--fast-resize', action='store_true', help='JPEG 使用 draft 模式直接解码到接近目标尺寸')
+    parser.add_argument('--passthrough', action='store_true', help='已满足尺寸与字节预算的基线 JPEG 直接透传原始字节')
+    parser.add_argument('--passthrough-max-mb', type=float, default=4.0, help='透传允许的最大文件大小(MB)')
+    parser.add_argument('--stream-body', action='store_true', help='流式写出请求体,图片 Base64 分块编码,降低在途请求内存')
+    parser.add_argument('--two-pass', action='store_true', help='由粗到细两阶段识别:低分辨率定位区域,再裁剪有人/物品的区域高分辨率识别')
+    parser.add_argument('--coarse-size', type=int, nargs=2, default=[768, 512], help='两阶段第一阶段全图最大尺寸 宽 高')
+    parser.add_argument('--crop-size', type=int, default=768, help='两阶段第二阶段局部图长边上限')
+    parser.add_argument('--prescreen', action='store_true', help='调用模型前本地预筛:跳过过暗/过曝/模糊的帧')
+    parser.add_argument('--night-prior', action='store_true', help='预筛时给出高置信度的昼夜先验,并从 prompt 中去掉 是否为黑夜(需同时指定 --prescreen)')
+    parser.add_argument('--blur-threshold', type=float, default=15.0, help='预筛模糊判定的拉普拉斯方差阈值(256px 缩略图)')
+    parser.add_argument('--dedup', action='store_true', help='连续近重复帧只请求代表帧,结果分发给同簇其他帧;同一图片的重复行不合并,须与 --temperature 0 一起使用')
+    parser.add_argument('--dedup-threshold', type=int, default=DEFAULT_HASH_THRESHOLD, help='近重复判定的 pHash 汉明距离阈值(0-64)')
+    parser.add_argument('--pack-size', type=int, default=1, help='每次请求打包的图片数 K(在批次内分组,批次大小宜为 K 的倍数)')
+    parser.add_argument('--shard-dir', help='图片分片目录(由 pack_image_shards.py 生成),命中时不再读取原图')
+    parser.add_argument('--image-profile', choices=['auto'] + list(MODEL_PROFILES), help='按模型瓦片计费自适应图片尺寸,auto 表示根据模型名推断')
+    parser.add_argument('--min-short-side', type=int, help='自适应尺寸时短边下限(像素)')
+    parser.add_argument('--max-tiles', type=int, help='自适应尺寸时最多瓦片数')
+    parser.add_argument('--token-budget', type=int, help='自适应尺寸时单张图片的 token 上限')
     args = parser.parse_args()
+    if args.dedup and args.temperature > 0:
+        # 近重复帧共用代表帧的回答,temperature > 0 时各行应为独立采样
+        parser.error(f"--dedup 需要同时指定 --temperature 0(当前 {args.temperature}),否则各行不再是独立采样")
 
     api_key = args.api_key or os.getenv('GEMINI_API_KEY')
     if not api_key:
@@ -373,20 +810,113 @@ async def main():
     output_dir = Path(args.output_folder)
     output_dir.mkdir(parents=True, exist_ok=True)
 
+    if args.delay is not None:
+        logger.warning("--delay 已废弃,请求节奏由自适应限速器控制,请改用 --rps / --max-rps。")
+    configure_rate_limit(args.model, rps=args.rps, max_rps=args.max_rps, concurrency=args.max_concurrency)
+    try:
+        backends = load_backends(args.backends, api_key) if args.backends else None
+    except ValueError as e:
+        logger.error(f"❌ {e}")
+        return
+
+    if args.shard_dir:
+        # 通过环境变量传递,进程池中的编码进程同样会读取分片
+        os.environ["IMAGE_SHARD_DIR"] = args.shard_dir
+
+    profile = get_profile(args.image_profile, args.model, min_short_side=args.min_short_side,
+                          max_tiles=args.max_tiles, token_budget=args.token_budget)
+    encode_kwargs = {
+        "fast_resize": args.fast_resize,
+        "passthrough": args.passthrough,
+        "passthrough_max_bytes": int(args.passthrough_max_mb * 1024 * 1024),
+        "profile": profile,
+    }
+    pre_encoder = None
+    if args.encode_workers > 0 and not args.two_pass:
+        pre_encoder = PreEncoder(workers=args.encode_workers, lookahead=args.encode_lookahead, **encode_kwargs)
+
+    if args.pack_size > 1 and (args.two_pass or args.stream_body):
+        logger.warning("多图打包与 --two-pass / --stream-body 不兼容,已关闭打包。")
+        args.pack_size = 1
+
+    if args.night_prior and not args.prescreen:
+        logger.warning("--night-prior 需要与 --prescreen 一起使用,已忽略。")
+    screener = ImageScreener(blur_var=args.blur_threshold, night_prior=args.night_prior) if args.prescreen else None
+    deduper = FrameDeduplicator(threshold=args.dedup_threshold) if args.dedup else None
+    concurrency = args.batch_size if args.concurrency is None else args.concurrency
+    window = SlidingWindow(concurrency) if concurrency > 0 else None
+
+    checkpoint_mode = "errors" if args.retry_errors else "resume" if args.resume else "fresh"
+    cache_mode = "bypass" if args.no_cache else "refresh" if args.refresh_cache else DEFAULT_CACHE_MODE
+    response_cache = ResponseCache(cache_mode, **({"max_bytes": args.cache_max_mb * 1024 * 1024} if args.cache_max_mb else {}))
+
+    # 未启用对冲时 hedger 只统计耗时分布,作为对照
+    hedger = Hedger(percentile=args.hedge_percentile or None, max_extra=args.hedge_max_extra)
+    metrics = MetricsRecorder(args.metrics_dir)
+
     start_time = time.time()
     try:
         files = get_jsonl_files(args.input_folder)
         if not files:
             return
 
-        async with GeminiEvaluator(api_key, args.base_url, args.model) as evaluator:
+        async with GeminiEvaluator(api_key, args.base_url, args.model, encode_kwargs, args.stream_body,
+                                   args.two_pass, tuple(args.coarse_size), args.crop_size, args.pack_size,
+                                   client=LLMClient(api_key, args.base_url, max_retries=args.max_retries,
+                                                    hedger=hedger, backends=backends, metrics=metrics),
+                                   response_cache=response_cache, temperature=args.temperature,
+                                   coalesce=not args.no_coalesce, stream_response=args.stream_response) as evaluator:
             for input_file in files:
                 output_file = output_dir / f"{input_file.stem}_evaluated.jsonl"
-                await process_file(evaluator, input_file, output_file, args.batch_size, args.delay)
+                await process_file(evaluator, input_file, output_file, args.batch_size, pre_encoder, screener, deduper, window,
+                                   checkpoint_mode)
+
+            if evaluator.image_count:
+                logger.info(f"预计图像 tokens 合计 {evaluator.image_tokens},"
+                            f"平均每次请求 {evaluator.image_tokens / evaluator.image_count:.0f}")
+
+            if evaluator.pack_stats["requests"]:
+                logger.info(f"多图打包: {evaluator.pack_stats['requests']} 次请求识别 {evaluator.pack_stats['images']} 张图片,"
+                            f"单图回退 {evaluator.pack_stats['fallbacks']} 张")
+            if evaluator.usage["requests"]:
+                logger.info(f"接口用量: {dict(evaluator.usage)}")
+            evaluator.client.log_pool_stats()
+            for limiter in all_rate_limiters().values():
+                logger.info(limiter.describe())
+            if window is not None:
+                logger.info(window.summary("次请求" if args.pack_size > 1 else "行"))
+            logger.info(hedger.summary())
+            logger.info(f"响应缓存: {response_cache.stats()}")
+            if evaluator.single_flight is not None:
+                if args.temperature == 0:
+                    logger.info(evaluator.single_flight.summary())
+                else:
+                    logger.info(f"请求合并: temperature={args.temperature} 为采样模式,未合并")
+
+            stats = evaluator.two_pass_stats
+            if stats["images"]:
+                n = stats["images"]
+                logger.info(f"两阶段统计: {n} 张图片,平均 {stats['regions'] / n:.1f} 个区域,回退 {stats['fallbacks']} 次;"
+                            f"平均每张节省像素 {(stats['full_pixels'] - stats['sent_pixels']) / n:.0f} "
+                            f"({1 - stats['sent_pixels'] / stats['full_pixels']:.1%}),"
+                            f"节省图像 tokens {(stats['full_tokens'] - stats['sent_tokens']) / n:.0f} "
+                            f"({1 - stats['sent_tokens'] / stats['full_tokens']:.1%})")
 
     except Exception as e:
         logger.error(f"主任务异常: {e}")
     finally:
+        if pre_encoder is not None:
+            pre_encoder.close()
+        if deduper is not None:
+            logger.info(deduper.summary())
+            deduper.close()
+        if screener is not None:
+            logger.info(screener.summary())
+            screener.close()
+        response_cache.close()
+        metrics.write_summary()
+        metrics.close()
+        logger.info(f"图片编码路径统计: {encode_path_stats()}")
         end_time = time.time()
         logger.info(f"🎉 所有任务完成,用时 {end_time - start_time:.2f} 秒。")
 
@@ -1,8 +1,5 @@
 import os
-import base64
-import io
 import json
-from PIL import Image
 from typing import Annotated, Union
 from langchain_openai.chat_models import ChatOpenAI
 from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
@@ -11,6 +8,18 @@ from langgraph.graph import StateGraph, START, END
 from langgraph.graph.message import add_messages
 from dotenv import load_dotenv
 import requests
+import sys
+import httpx
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from image_codec import encode_image_bytes, get_default_cache
+from remote_images import RemoteImagePrefetcher
+from frame_dedup import image_phash, hamming
+from response_cache import ResponseCache, cached_invoke
+from metrics import MetricsRecorder, http_event_hooks
+
+# 复用 keep-alive 连接的同步会话（单张图片下载时使用）
+http_session = requests.Session()
 
 
 def fill_standard_input(data, standard_template):
@@ -67,7 +76,7 @@ def fill_standard_input(data, standard_template):
     tag_map = {tag['tag_key']: tag for tag in tag_list}
 
     # --- 1. 填充全局顶层信息 ---
-    tag_map['是否抛弃']['value'] = '可用'
+    tag_map['是否抛弃']['value'] = '抛弃' if data.get('是否抛弃') == '抛弃' else '可用'  # 本地预筛判定不可用时为抛弃
     tag_map['车内人数']['value'] = data.get('人', {}).get('人数', '0')
     tag_map['车内物品数']['value'] = data.get('物品', {}).get('物品数', '0')
     tag_map['车内宠物数']['value'] = data.get('宠物', {}).get('宠物数', '0')
@@ -140,7 +149,7 @@ def chatbot(state: State):
     if not state["memory_frozen"]:
         # 还没冻结，正常传
         window = state["messages"]
-        response = llm.invoke(window)
+        response = cached_invoke(llm, window, response_cache, metrics)
 
         new_messages = state["messages"] + [response]
 
@@ -160,23 +169,13 @@ def chatbot(state: State):
         human_msg = [m for m in state["messages"] if isinstance(m, HumanMessage)][-1]
         window = [system_msg] + state["frozen_memory"] + [human_msg]
 
-        response = llm.invoke(window)
+        response = cached_invoke(llm, window, response_cache, metrics)
 
         return {"messages": state["messages"] + [response], "memory_frozen": True, "frozen_memory": state["frozen_memory"]}
 
 
 
 
-# ===== 图片转 Base64 =====
-def encode_image(image_path: str, max_size=(2400, 1600)) -> str:
-    with Image.open(image_path) as img:
-        img = img.convert("RGB")
-        if img.size[0] > max_size[0] or img.size[1] > max_size[1]:
-            img.thumbnail(max_size, Image.Resampling.LANCZOS)
-        buf = io.BytesIO()
-        img.save(buf, format="JPEG", quality=85)
-        return base64.b64encode(buf.getvalue()).decode("utf-8")
-    
 
 
 
@@ -201,24 +200,11 @@ def image_url_to_base64_with_mime(image_url, max_size=(2400, 1600)):
     """
     try:
         # 1. 从URL获取图片
-        response = requests.get(image_url, timeout=10)
+        response = http_session.get(image_url, timeout=10)
         response.raise_for_status()
 
-        # 2. 使用PIL打开图片并进行处理
-        with Image.open(io.BytesIO(response.content)) as img:
-            # 转换为RGB模式（移除Alpha通道）
-            img = img.convert("RGB")
-            # 如果图片尺寸超过最大尺寸，则进行缩放
-            if img.size[0] > max_size[0] or img.size[1] > max_size[1]:
-                img.thumbnail(max_size, Image.Resampling.LANCZOS)
-            # 将处理后的图片保存到内存缓冲区，格式为JPEG，质量为85
-            buf = io.BytesIO()
-            img.save(buf, format="JPEG", quality=85)
-            processed_image_bytes = buf.getvalue()
-
-        # 3. 对处理后的图片进行Base64编码
-        mime_type = 'image/jpeg'  # 因为我们强制保存为JPEG，所以MIME类型固定为image/jpeg
-        base64_str = base64.b64encode(processed_image_bytes).decode('utf-8')
+        # 2. 压缩缩放并进行Base64编码（共享编码模块，按内容哈希缓存）
+        base64_str = encode_image_bytes(response.content, max_size=max_size, cache=get_default_cache())
 
         return base64_str
 
@@ -226,40 +212,75 @@ def image_url_to_base64_with_mime(image_url, max_size=(2400, 1600)):
         print(f"操作失败: {e}")
         return None
 
+def get_record_image_url(record):
+    """标注单中的图片 URL 位于 order_info[1].value，结构不符时返回空串"""
+    try:
+        return record.get("order_info")[1].get("value") or ""
+    except (TypeError, IndexError, AttributeError):
+        return ""
+
+
 # ===== 批量处理 =====
-def batch_process(json_lines_path: str):
+def batch_process(json_lines_path: str, prefetch: int = 8, dedup_threshold=None):
+    """dedup_threshold 为整数时,与上一张代表帧 pHash 距离不超过该值的连续帧直接复用代表帧的识别结果"""
     # 初始状态：system + 未冻结
     state = {"messages": [SystemMessage(content=SYSTEM_PROMPT)], "memory_frozen": False, "frozen_memory": []}
     with open(json_lines_path, "r", encoding="utf-8") as f:
         data = json.load(f)
     results = []
-    for record in data:
-        try:
-            image_path = record.get("order_info")[1].get("value")
-            message_content: ContentType = [{"type": "text", "text": ""}]
-            
-            img_b64 = image_url_to_base64_with_mime(image_path)
-            message_content.append(
-                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{img_b64}"}})
+
+    # 后台并发预取后续 prefetch 张图片，并在本地镜像中按 ETag/Last-Modified 复用
+    prefetcher = RemoteImagePrefetcher(concurrency=prefetch, lookahead=prefetch)
+    images = prefetcher.iter_sync(get_record_image_url(record) for record in data)
+    rep_hash, rep_data, saved = None, None, 0
+    processed = 0
+    try:
+        # strict:预取结果少于记录数时报错,不会悄悄丢掉剩余记录
+        for record, (image_path, image_bytes) in zip(data, images, strict=True):
+            processed += 1
+            try:
+                if image_bytes is None:
+                    raise ValueError(f"图片获取失败: {image_path}")
+                frame_hash = image_phash(image_bytes) if dedup_threshold is not None else None
+                if frame_hash is not None and rep_hash is not None and hamming(frame_hash, rep_hash) <= dedup_threshold:
+                    results.append(fill_standard_input(rep_data, record))
+                    saved += 1
+                    continue
+                message_content: ContentType = [{"type": "text", "text": ""}]
+
+                img_b64 = encode_image_bytes(image_bytes, cache=get_default_cache())
+                message_content.append(
+                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{img_b64}"}})
                 
 
-            # 新增一条 HumanMessage
-            state["messages"].append(HumanMessage(content=message_content))  # type: ignore
-            # 调用图
-            state = graph.invoke(state)  # type: ignore
-            # 取最新回复
-            response_text = state["messages"][-1].content
-            response_text = response_text.replace('\n', '').replace('```json', '').replace('```', '').strip()
-            parsed_data = json.loads(response_text)
-            final_result = fill_standard_input(parsed_data, record)
-            # final_result = fill_standard_input(response_text, record)
-
-            # recordSec = record.copy()
-            # recordSec["tag_list"] = final_result
-
-            results.append(final_result)
-        except Exception as e:
-            print(f"处理出错: {e}")
+                # 新增一条 HumanMessage
+                state["messages"].append(HumanMessage(content=message_content))  # type: ignore
+                # 调用图
+                state = graph.invoke(state)  # type: ignore
+                # 取最新回复
+                response_text = state["messages"][-1].content
+                response_text = response_text.replace('\n', '').replace('```json', '').replace('```', '').strip()
+                parsed_data = json.loads(response_text)
+                rep_hash, rep_data = frame_hash, parsed_data
+                final_result = fill_standard_input(parsed_data, record)
+                # final_result = fill_standard_input(response_text, record)
+
+                # recordSec = record.copy()
+                # recordSec["tag_list"] = final_result
+
+                results.append(final_result)
+            except Exception as e:
+                print(f"处理出错: {e}")
+    except Exception:
+        # 预取中断时列出未处理的记录后重新抛出(已完成的请求在响应缓存中,重跑时不会重复请求)
+        remaining = [f"{i}: {get_record_image_url(record) or '(无图片 URL)'}"
+                     for i, record in enumerate(data[processed:], processed)]
+        print(f"图片预取中断,以下 {len(remaining)} 条记录未处理:")
+        for line in remaining:
+            print(f"  {line}")
+        raise
+    if dedup_threshold is not None:
+        print(f"近重复抑制: {len(data)} 条记录节省 API 调用 {saved} 次,阈值 {dedup_threshold}")
     return results
   
 
@@ -274,6 +295,8 @@ if __name__ == "__main__":
     SYSTEM_PROMPT = "角色: 你是一位车内识别助手。\n任务: 严格按照json 格式,给出答案结果,答案均只能从备选项中选取并只选取一个,不要给出备选项中未出现的答案。以下为带有所有备选项的模版:\n{{\n    \"人\": {{\n        \"人数\": \"0,1,2,3,4,5,6\",\n        \"具体信息\": [\n            {{\n                \"性别\": \"男,女,unknown\",\n                \"位置\": \"前排左,前排右,中排左（若有）,中排右（若有）,后排左,后排右,过道,unknown\",\n                \"配饰\": \"眼镜,围巾,帽子,耳机,手表,墨镜,口罩,耳坠（非耳钉）,靴子,unknown\",\n                \"行为\": [\n                    {{\"是否在阅读\":\"是,否\"}},\n                    {{\"是否在化妆\":\"是,否\"}},\n                    {{\"是否在吃东西\":\"是,否\"}},\n                    {{\"是否在托腮思考\":\"是,否\"}},\n                    {{\"是否在玩手机\":\"是,否\"}},\n                    {{\"是否在打电话\":\"是,否\"}},\n                    {{\"是否在吸烟\":\"是,否\"}},\n                    {{\"是否在点烟\":\"是,否\"}},\n                    {{\"是否在睡觉\":\"是,否\"}},\n                    {{\"是否在抱猫\":\"是,否\"}},\n                    {{\"是否在抱狗\":\"是,否\"}},\n                    {{\"是否头或手伸出窗外\":\"是,否\"}},\n                    {{\"是否在哭闹\":\"是,否\"}},\n                    {{\"是否未系安全带\":\"是,否\"}},\n                    {{\"是否食指指向前\":\"是,否\"}},\n                    {{\"是否食指指向上\":\"是,否\"}},\n                    {{\"是否食指指向下\":\"是,否\"}},\n                    {{\"是否食指指向左\":\"是,否\"}},\n                    {{\"是否食指指向右\":\"是,否\"}},\n                    {{\"是否手触碰车顶屏幕\":\"是,否\"}},\n                    {{\"是否在站立\":\"是,否\"}}\n                ]\n            }}\n        ]\n    }}\n}}\n背景:\n- 目标: 根据给出的图片,将json 模版中各选择题选择出最合适的答案\n输出要求:\n- 一个个分析每个选项，对于行为中的每一项问题一步步来分析，尤其需要重视行为列表中的每一个选择，确保识别图片与思考完整后再给出每一个行为列表选择的答案\n- 选择的答案必须为该问题备选项中的项,如果不是则重新从备选项中选择\n- 以图片左侧为左,右侧为右。\n- 如有多个人,按照前排左、前排右、中排左（若有）、中排右（若有）、后排左、后排右 顺序展开\n- 若有两排座位,用前排、后排代称。若有三排座位,用前排、中排、后排代称,即此时第二排只能用中排代称。\n- 只输出json ,不要给出解释或说明\n- 人的具体信息列表这里要根据其人数来确定列表中应有几项字典并自动增加。\n- 结合常识判断各行为标签的共存是否可能,如一般情况下不会有人在阅读的同时在化妆,因此如果有此情况则将其改为否\n- 年龄14岁以下认为是儿童,能在车内站立也认为是儿童\n- 两排座位之间为过道,三排座位车非前排时,同一排两座位间也为过道\n\n格式: 输出为json\n- 避免:\n  1. 不要输出任何其他内容,只输出该json模版答案替换后的版本\n  2. 不要给出未知,可能是,不明,不知晓等所有表示不确定的词语,都用unknown代替\n  3. 衣服的样式答案不要给出多种可能,给出备选项中最可能的一种,完全无法确定就给unknown\n  4. 颜色的选择不要给出深绿、蓝绿这些,严格从备选项中进行选择\n- 示例 (输出参考):\n- 好的输出:\n{{\n\"人\": {{\n\"人数\": \"2\",\n\"具体信息\": [\n{{\n\"性别\": \"男\",\n\"位置\": \"前排右\",\n\"配饰\":\"眼镜,围巾\",\n\"行为\":[\n{{\"是否在阅读\":\"是,否\"}},\n{{\"是否在化妆\":\"否\"}},\n{{\"是否在吃东西\":\"否\"}},\n{{\"是否在托腮思考\":\"否\"}},\n{{\"是否在玩手机\":\"否\"}},\n{{\"是否在打电话\":\"否\"}},\n{{\"是否在吸烟\":\"否\"}},\n{{\"是否在点烟\":\"否\"}},\n{{\"是否在睡觉\":\"否\"}},\n{{\"是否在抱猫\":\"否\"}},\n{{\"是否在抱狗\":\"否\"}},\n{{\"是否头或手伸出窗外\":\"否\"}},\n{{\"是否在哭闹\":\"否\"}},\n{{\"是否未系安全带\":\"是\"}},\n{{\"是否食指指向前\":\"否\"}},\n{{\"是否食指指向上\":\"否\"}},\n{{\"是否食指指向下\":\"否\"}},\n{{\"是否食指指向左\":\"否\"}},\n{{\"是否食指指向右\":\"否\"}},\n{{\"是否手触碰车顶屏幕\":\"否\"}},\n{{\"是否在站立\":\"否\"}}\n]\n}},\n{{\n\"性别\": \"女\",\n\"位置\": \"后排右\",\n\"配饰\":\"手表,墨镜,口罩,围巾\",\n\"行为\":[\n{{\"是否在阅读\":\"是\"}},\n{{\"是否在化妆\":\"否\"}},\n{{\"是否在吃东西\":\"否\"}},\n{{\"是否在托腮思考\":\"否\"}},\n{{\"是否在玩手机\":\"否\"}},\n{{\"是否在打电话\":\"否\"}},\n{{\"是否在吸烟\":\"否\"}},\n{{\"是否在点烟\":\"否\"}},\n{{\"是否在睡觉\":\"否\"}},\n{{\"是否在抱猫\":\"否\"}},\n{{\"是否在抱狗\":\"否\"}},\n{{\"是否头或手伸出窗外\":\"否\"}},\n{{\"是否在哭闹\":\"否\"}},\n{{\"是否未系安全带\":\"是\"}},\n{{\"是否食指指向前\":\"否\"}},\n{{\"是否食指指向上\":\"否\"}},\n{{\"是否食指指向下\":\"否\"}},\n{{\"是否食指指向左\":\"否\"}},\n{{\"是否食指指向右\":\"否\"}},\n{{\"是否手触碰车顶屏幕\":\"否\"}},\n{{\"是否在站立\":\"否\"}}\n]\n}}\n]\n}}\n}}\n\n- 避免的输出:\n{{\n\"人\": {{\n\"人数\": \"一\",\n\"具体信息\": [{{\"性别\":\"未知\",\"位置\":\"车上\",\"配饰\":\"太阳镜,高跟靴子\",\n\"行为\":[\n{{\"是否在阅读\":\"是\"}},\n{{\"是否在化妆\":\"是\"}},\n{{\"是否在吃东西\":\"不清楚\"}},\n{{\"是否在托腮思考\":\"是\"}},\n{{\"是否在玩手机\":\"否\"}},\n{{\"是否在打电话\":\"否\"}},\n{{\"是否在吸烟\":\"是\"}},\n{{\"是否在点烟\":\"是\"}},\n{{\"是否在睡觉\":\"否\"}},\n{{\"是否在抱猫\":\"否\"}},\n{{\"是否在抱狗\":\"是\"}},\n{{\"是否头或手伸出窗外\":\"不确定\"}},\n{{\"是否在哭闹\":\"是\"}},\n{{\"是否未系安全带\":\"否\"}},\n{{\"是否食指指向前\":\"否\"}},\n{{\"是否食指指向上\":\"否\"}},\n{{\"是否食指指向下\":\"是\"}},\n{{\"是否食指指向左\":\"是\"}},\n{{\"是否食指指向右\":\"否\"}},\n{{\"是否手触碰车顶屏幕\":\"否\"}},\n{{\"是否在站立\":\"是\"}}\n]\n}}]\n}}\n}}\n"
 
     MAX_MEMORY_ROUNDS = 0   # 只保留最开始 3 轮
+    DEDUP_THRESHOLD = None  # 设为整数(如 6)时启用连续近重复帧抑制
+    RESPONSE_CACHE_MODE = "use"  # 模型响应缓存: use 读写 / refresh 重新请求并覆盖 / bypass 不使用
     # OUTPUT_JSON_PATH = "./outputs/results_a11.json"
     input_files = "./outputs/test21.json" # type: ignore
 
@@ -286,8 +309,13 @@ if __name__ == "__main__":
         model="gemini-2.5-flash-nothinking",
         temperature=0.3,
         timeout=60,
-        max_retries=3
+        max_retries=3,
+        # 事件钩子统计每次调用实际发出的 HTTP 请求(重试次数、请求体字节数)
+        http_client=httpx.Client(event_hooks=http_event_hooks())
     )
+    response_cache = ResponseCache(RESPONSE_CACHE_MODE)
+    # 模型调用指标,环境变量 LLM_METRICS_DIR 指定时逐条写入并在运行结束时写出汇总(summary.json / metrics.prom)
+    metrics = MetricsRecorder()
     graph_builder = StateGraph(State)
     graph_builder.add_node("chatbot", chatbot)
     graph_builder.add_edge(START, "chatbot")
@@ -297,13 +325,16 @@ if __name__ == "__main__":
     OUTPUT_JSON_PATH = './outputs/temp.json'
     try:
         # 从文件加载完整的JSON模板
-        results = batch_process(input_files)
+        results = batch_process(input_files, dedup_threshold=DEDUP_THRESHOLD)
 
         # 以美化的格式将最终生成的完整JSON写入文件
         with open(OUTPUT_JSON_PATH, "w", encoding="utf-8") as f:
             json.dump(results, f, ensure_ascii=False, indent=4)
         
         print(f"处理成功！结果已保存至: {OUTPUT_JSON_PATH}")
+        print(f"响应缓存: {response_cache.stats()}")
+        print(metrics.describe())
+        metrics.write_summary()
 
     except FileNotFoundError as e:
         print(f"错误: 找不到文件 {e.filename}。请确保 'standardInput.json' 和 'data.json' 文件存在于脚本所在目录。")
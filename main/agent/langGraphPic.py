@@ -2,9 +2,6 @@
 
 
 import os
-import base64
-import io
-from PIL import Image
 from typing import Annotated
 from langchain_openai.chat_models import ChatOpenAI
 from langchain_core.messages import HumanMessage
@@ -12,6 +9,12 @@ from typing_extensions import TypedDict
 from langgraph.graph import StateGraph, START, END
 from langgraph.graph.message import add_messages
 from langgraph.checkpoint.memory import MemorySaver
+import sys
+import httpx
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from image_codec import encode_image, image_available
+from metrics import MetricsRecorder, http_event_hooks, invoke_with_metrics
 
 # ===== 配置 =====
 API_KEY = os.getenv("ONE_API_KEY", "")
@@ -24,8 +27,12 @@ llm = ChatOpenAI(
     model=MODEL_NAME,
     temperature=0.3,
     timeout=60,
-    max_retries=3
+    max_retries=3,
+    # 事件钩子统计每次调用实际发出的 HTTP 请求(重试次数、请求体字节数)
+    http_client=httpx.Client(event_hooks=http_event_hooks())
 )
+# 模型调用指标,环境变量 LLM_METRICS_DIR 指定时逐条写入并在退出时写出汇总(summary.json / metrics.prom)
+metrics = MetricsRecorder()
 
 memory = MemorySaver()
 
@@ -34,19 +41,10 @@ class State(TypedDict):
 
 graph_builder = StateGraph(State)
 
-# ===== 图片转 Base64 =====
-def encode_image(image_path: str, max_size=(2400, 1600)) -> str:
-    with Image.open(image_path) as img:
-        img = img.convert("RGB")
-        if img.size[0] > max_size[0] or img.size[1] > max_size[1]:
-            img.thumbnail(max_size, Image.Resampling.LANCZOS)
-        buf = io.BytesIO()
-        img.save(buf, format="JPEG", quality=85)
-        return base64.b64encode(buf.getvalue()).decode("utf-8")
 
 # ===== 对话节点 =====
 def chatbot(state: State):
-    response = llm.invoke(state["messages"])
+    response = invoke_with_metrics(llm, state["messages"], metrics)
     return {"messages": [response]}
 
 graph_builder.add_node("chatbot", chatbot)
@@ -69,7 +67,7 @@ def interactive_chat():
         if user_input.startswith("img:"):
             parts = user_input.split(" ", 1)
             img_path = parts[0][4:].strip()
-            if not os.path.exists(img_path):
+            if not image_available(img_path):
                 print("⚠️ 找不到图片文件！")
                 continue
             img_b64 = encode_image(img_path)
@@ -91,4 +89,8 @@ def interactive_chat():
             event["messages"][-1].pretty_print()
 
 if __name__ == "__main__":
-    interactive_chat()
+    try:
+        interactive_chat()
+    finally:
+        print(metrics.describe())
+        metrics.write_summary()
@@ -1,8 +1,5 @@
 import os
-import base64
-import io
 import json
-from PIL import Image
 from typing import Annotated, Union
 from langchain_openai.chat_models import ChatOpenAI
 from langchain_core.messages import HumanMessage, SystemMessage
@@ -12,6 +9,13 @@ from langgraph.graph.message import add_messages
 from langgraph.checkpoint.memory import MemorySaver
 from dotenv import load_dotenv
 from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
+import sys
+import httpx
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from image_codec import encode_image, image_available
+from response_cache import ResponseCache, cached_invoke
+from metrics import MetricsRecorder, http_event_hooks
 # ===== 配置 =====
 
 
@@ -36,8 +40,14 @@ llm = ChatOpenAI(
     model="gemini-2.5-flash-nothinking",
     temperature=0.3,
     timeout=60,
-    max_retries=3
+    max_retries=3,
+    # 事件钩子统计每次调用实际发出的 HTTP 请求(重试次数、请求体字节数)
+    http_client=httpx.Client(event_hooks=http_event_hooks())
 )
+# 模型响应缓存,模式由环境变量 RESPONSE_CACHE 指定(use 读写 / refresh 重新请求并覆盖 / bypass 不使用)
+response_cache = ResponseCache()
+# 模型调用指标,环境变量 LLM_METRICS_DIR 指定时逐条写入并在运行结束时写出汇总(summary.json / metrics.prom)
+metrics = MetricsRecorder()
 
 # ===== 有记忆功能 =====
 memory = MemorySaver()
@@ -89,21 +99,12 @@ def truncate_rounds(messages, rounds=3):
     return truncated_messages
 
 
-# ===== 图片转 Base64 =====
-def encode_image(image_path: str, max_size=(2400, 1600)) -> str:
-    with Image.open(image_path) as img:
-        img = img.convert("RGB")
-        if img.size[0] > max_size[0] or img.size[1] > max_size[1]:
-            img.thumbnail(max_size, Image.Resampling.LANCZOS)
-        buf = io.BytesIO()
-        img.save(buf, format="JPEG", quality=85)
-        return base64.b64encode(buf.getvalue()).decode("utf-8")
 
 # ===== 对话节点 =====
 def chatbot(state: State):
 
     window = truncate_rounds(state["messages"], MAX_MEMORY_ROUNDS)
-    response = llm.invoke(window)
+    response = cached_invoke(llm, window, response_cache, metrics)
     return {"messages": [response]}
 
 
@@ -128,7 +129,7 @@ def batch_process(json_lines_path: str):
     first_content: ContentType = [
         {"type": "text", "text": first_record.get("source_text", "").strip()}
     ]
-    if os.path.exists(first_record.get("image_path", "")):
+    if image_available(first_record.get("image_path", "")):
         img_b64 = encode_image(first_record["image_path"])
         first_content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{img_b64}"}})
     
@@ -173,7 +174,7 @@ def batch_process(json_lines_path: str):
             image_path = record.get("image_path", "").strip()
             
             message_content: ContentType = [{"type": "text", "text": source_text}]
-            if os.path.exists(image_path):
+            if image_available(image_path):
                 img_b64 = encode_image(image_path)
                 message_content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{img_b64}"}})
             else:
@@ -231,6 +232,9 @@ def batch_process(json_lines_path: str):
             
     # 最后保存所有结果
     save_results(results)
+    print(f"响应缓存: {response_cache.stats()}")
+    print(metrics.describe())
+    metrics.write_summary()
 
 def save_results(data):
     if not data:
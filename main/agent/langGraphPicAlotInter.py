@@ -1,8 +1,5 @@
 import os
-import base64
-import io
 import json
-from PIL import Image
 from typing import Annotated, Union
 from langchain_openai.chat_models import ChatOpenAI
 from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
@@ -10,6 +7,13 @@ from typing_extensions import TypedDict
 from langgraph.graph import StateGraph, START, END
 from langgraph.graph.message import add_messages
 from dotenv import load_dotenv
+import sys
+import httpx
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from image_codec import encode_image, image_available
+from response_cache import ResponseCache, cached_invoke
+from metrics import MetricsRecorder, http_event_hooks
 
 # ===== 配置 =====
 load_dotenv()
@@ -31,8 +35,14 @@ llm = ChatOpenAI(
     model="gemini-2.5-flash-nothinking",
     temperature=0.3,
     timeout=60,
-    max_retries=3
+    max_retries=3,
+    # 事件钩子统计每次调用实际发出的 HTTP 请求(重试次数、请求体字节数)
+    http_client=httpx.Client(event_hooks=http_event_hooks())
 )
+# 模型响应缓存,模式由环境变量 RESPONSE_CACHE 指定(use 读写 / refresh 重新请求并覆盖 / bypass 不使用)
+response_cache = ResponseCache()
+# 模型调用指标,环境变量 LLM_METRICS_DIR 指定时逐条写入并在运行结束时写出汇总(summary.json / metrics.prom)
+metrics = MetricsRecorder()
 
 
 class State(TypedDict):
@@ -48,7 +58,7 @@ def chatbot(state: State):
     if not state["memory_frozen"]:
         # 还没冻结，正常传
         window = state["messages"]
-        response = llm.invoke(window)
+        response = cached_invoke(llm, window, response_cache, metrics)
 
         new_messages = state["messages"] + [response]
 
@@ -68,7 +78,7 @@ def chatbot(state: State):
         human_msg = [m for m in state["messages"] if isinstance(m, HumanMessage)][-1]
         window = [system_msg] + state["frozen_memory"] + [human_msg]
 
-        response = llm.invoke(window)
+        response = cached_invoke(llm, window, response_cache, metrics)
 
         return {"messages": state["messages"] + [response], "memory_frozen": True, "frozen_memory": state["frozen_memory"]}
 
@@ -76,15 +86,6 @@ def chatbot(state: State):
 
 graph_builder = StateGraph(State)
 
-# ===== 图片转 Base64 =====
-def encode_image(image_path: str, max_size=(2400, 1600)) -> str:
-    with Image.open(image_path) as img:
-        img = img.convert("RGB")
-        if img.size[0] > max_size[0] or img.size[1] > max_size[1]:
-            img.thumbnail(max_size, Image.Resampling.LANCZOS)
-        buf = io.BytesIO()
-        img.save(buf, format="JPEG", quality=85)
-        return base64.b64encode(buf.getvalue()).decode("utf-8")
 
 graph_builder.add_node("chatbot", chatbot)
 graph_builder.add_edge(START, "chatbot")
@@ -108,7 +109,7 @@ def batch_process(json_lines_path: str):
             image_path = record.get("image_path", "").strip()
 
             message_content: ContentType = [{"type": "text", "text": source_text}]
-            if os.path.exists(image_path):
+            if image_available(image_path):
                 img_b64 = encode_image(image_path)
                 message_content.append(
                     {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{img_b64}"}}
@@ -145,6 +146,9 @@ def batch_process(json_lines_path: str):
             print(f"第 {idx} 条处理出错: {e}")
 
     save_results(results)
+    print(f"响应缓存: {response_cache.stats()}")
+    print(metrics.describe())
+    metrics.write_summary()
 
 
 def save_results(data):
@@ -5,17 +5,22 @@
 """
 import os
 import json
-import base64
 import argparse
 import logging
 from pathlib import Path
-from typing import List, Dict
+from typing import List, Dict, Optional
 import time
 import asyncio
 import aiohttp
 import pandas as pd
-from PIL import Image
-import io
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from image_codec import encode_image, image_available
+from llm_client import LLMClient, DEFAULT_BASE_URL, DEFAULT_MAX_RETRIES
+from metrics import MetricsRecorder, DEFAULT_METRICS_DIR
+from rate_limiter import all_rate_limiters, configure_rate_limit
+from resilience import CircuitOpenError
 
 
 # --- 设置日志 ---
@@ -31,51 +36,29 @@ EVALUATION_PROMPT_TEMPLATE = """
 
 class GeminiEvaluator:
     """图文评估处理器"""
-    def __init__(self, api_key: str, base_url: str = None, model: str = "gemini-2.5-flash-preview-05-20-nothinking"): # type: ignore
+    def __init__(self, api_key: str, base_url: str = None, model: str = "gemini-2.5-flash-preview-05-20-nothinking", # type: ignore
+                 client: Optional[LLMClient] = None):
         self.api_key = api_key
-        self.base_url = base_url or "https://one-api.modelbest.co/v1"
+        self.base_url = base_url or DEFAULT_BASE_URL
         self.model = model
-        self.session = None
+        # 共享连接池的客户端,未传入时自建
+        self.client = client or LLMClient(api_key, self.base_url)
 
     async def __aenter__(self):
-        self.session = aiohttp.ClientSession()
+        await self.client.__aenter__()
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        if self.session:
-            await self.session.close()
-
-    
-    def encode_image(self, image_path: str, max_size: tuple = (2400, 1600)) -> str:
-        """更接近 GPT-4o 网页端的图像编码器：压缩图像并转为 Base64"""
-        try:
-            with Image.open(image_path) as img:
-                img = img.convert("RGB")  # 确保无 alpha 通道
-
-                # 如果图像大于设定尺寸则缩放
-                if img.size[0] > max_size[0] or img.size[1] > max_size[1]:
-                    img.thumbnail(max_size, Image.Resampling.LANCZOS)
-
-                buffer = io.BytesIO()
-                img.save(buffer, format="JPEG", quality=85)  # 控制质量以减少体积
-                buffer.seek(0)
+        await self.client.__aexit__(exc_type, exc_val, exc_tb)
 
-                encoded = base64.b64encode(buffer.read()).decode("utf-8")
-
-                logger.debug(f"图像编码完成，base64 长度：{len(encoded)} 字符")
-                return encoded
-
-        except Exception as e:
-            logger.error(f"图片处理失败: {e}")
-            raise
 
     
     async def evaluate_pair(self, source_text: str, image_path: str):
         """评估图文输入对，增强为类似 ChatGPT 网页版风格"""
-        if not source_text or not image_path or not os.path.exists(image_path):
+        if not source_text or not image_path or not image_available(image_path):
             return {"error": "Source text 或图片路径为空/无效"}
 
-        image_base64 = self.encode_image(image_path)
+        image_base64 = encode_image(image_path)
 
         # ✅ 新增：更接近 ChatGPT 的 system prompt
         system_prompt = (
@@ -84,11 +67,6 @@ class GeminiEvaluator:
 
         user_prompt = EVALUATION_PROMPT_TEMPLATE.format(source_text=source_text)
 
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
-
         payload = {
             "model": self.model,
             "temperature": 0.3,
@@ -105,33 +83,33 @@ class GeminiEvaluator:
         }
 
         try:
-            async with self.session.post(f"{self.base_url}/chat/completions", headers=headers, json=payload, timeout=300) as response: # type: ignore
-                if response.status == 200:
-                    result = await response.json()
-                    content = result['choices'][0]['message']['content']
-                    print(image_path)
-                    print(f"模型输出: {content}")
-
-                    # ✅ 更健壮的 JSON 清洗逻辑
-                    if content.strip().startswith("```json"):
-                        content = content.strip()[7:]
-                        content = content.strip("`").strip()
-
-                    try:
-                        evaluation_data = json.loads(content)
-                        logger.info("图文任务成功。")
-                        return evaluation_data
-                    except json.JSONDecodeError:
-                        logger.warning("输出非标准 JSON，原始输出已返回。")
-                        # evaluation_data = content
-                        return {"error": "无法解析模型输出", "raw_response": content}
-                else:
-                    error_text = await response.text()
-                    return {"error": f"API Error {response.status}", "details": error_text}
+            status, result = await self.client.post_chat(payload, timeout=300)
+            if status == 200:
+                content = result['choices'][0]['message']['content'] # type: ignore
+                print(image_path)
+                print(f"模型输出: {content}")
+
+                # ✅ 更健壮的 JSON 清洗逻辑
+                if content.strip().startswith("```json"):
+                    content = content.strip()[7:]
+                    content = content.strip("`").strip()
+
+                try:
+                    evaluation_data = json.loads(content)
+                    logger.info("图文任务成功。")
+                    return evaluation_data
+                except json.JSONDecodeError:
+                    logger.warning("输出非标准 JSON，原始输出已返回。")
+                    # evaluation_data = content
+                    return {"error": "无法解析模型输出", "raw_response": content}
+            else:
+                return {"error": f"API Error {status}", "details": result}
         except asyncio.TimeoutError:
             return {"error": "请求超时", "details": "Request timeout"}
         except aiohttp.ClientError as e:
             return {"error": "网络连接失败", "details": str(e)}
+        except CircuitOpenError as e:
+            return {"error": "接口持续不可用(熔断)", "details": str(e)}
 
 
 
@@ -217,7 +195,7 @@ def get_jsonl_files(folder_path: str) -> List[Path]:
 
 
 
-async def process_file(evaluator: GeminiEvaluator, input_path: Path, output_path: Path, batch_size: int, delay: float):
+async def process_file(evaluator: GeminiEvaluator, input_path: Path, output_path: Path, batch_size: int):
     logger.info(f"--- 处理文件: {input_path.name} ---")
 
     try:
@@ -241,7 +219,6 @@ async def process_file(evaluator: GeminiEvaluator, input_path: Path, output_path
                     f_out.write(json.dumps(original_data, ensure_ascii=False) + '\n')
 
                 logger.info(f"  - 批次 {i+1} 完成 ✅")
-                await asyncio.sleep(delay)
 
         logger.info(f"--- 完成文件处理: {output_path.name} ---")
 
@@ -264,7 +241,12 @@ async def main():
     parser.add_argument('-u', '--base-url', help='API Base URL')
     parser.add_argument('-m', '--model', default='gemini-2.5-flash-preview-05-20-nothinking', help='使用的模型名称')
     parser.add_argument('-b', '--batch-size', type=int, default=5, help='每批处理数量')
-    parser.add_argument('-d', '--delay', type=float, default=1.0, help='批次之间的延迟秒数')
+    parser.add_argument('-d', '--delay', type=float, help=argparse.SUPPRESS)  # 已废弃，由自适应限速器取代
+    parser.add_argument('--rps', type=float, help='该模型的初始请求速率(次/秒)，随后按 AIMD 自适应调整；默认取 LLM_RATE_LIMITS 或 5')
+    parser.add_argument('--max-rps', type=float, help='自适应速率上限(次/秒)')
+    parser.add_argument('--max-concurrency', type=int, help='该模型同时在途请求数上限')
+    parser.add_argument('--max-retries', type=int, default=DEFAULT_MAX_RETRIES, help='超时、连接错误、429/5xx 的最大重试次数（4xx 不重试）；0 表示不重试')
+    parser.add_argument('--metrics-dir', default=DEFAULT_METRICS_DIR, help='每次模型调用的指标（requests.jsonl）与运行汇总（summary.json / metrics.prom）的输出目录；默认取 LLM_METRICS_DIR，未设置时不写出')
     args = parser.parse_args()
 
     api_key = args.api_key or os.getenv('GEMINI_API_KEY')
@@ -272,23 +254,34 @@ async def main():
         logger.error("❌ 缺少 API Key！请使用 --api-key 或设置 GEMINI_API_KEY 环境变量。")
         return
 
+    if args.delay is not None:
+        logger.warning("--delay 已废弃，请求节奏由自适应限速器控制，请改用 --rps / --max-rps。")
+    configure_rate_limit(args.model, rps=args.rps, max_rps=args.max_rps, concurrency=args.max_concurrency)
+
     output_dir = Path(args.output_folder)
     output_dir.mkdir(parents=True, exist_ok=True)
 
+    metrics = MetricsRecorder(args.metrics_dir)
     start_time = time.time()
     try:
         files = get_jsonl_files(args.input_folder)
         if not files:
             return
 
-        async with GeminiEvaluator(api_key, args.base_url, args.model) as evaluator:
+        client = LLMClient(api_key, args.base_url, max_retries=args.max_retries, metrics=metrics)
+        async with GeminiEvaluator(api_key, args.base_url, args.model, client=client) as evaluator:
             for input_file in files:
                 output_file = output_dir / f"{input_file.stem}_evaluated.jsonl"
-                await process_file(evaluator, input_file, output_file, args.batch_size, args.delay)
+                await process_file(evaluator, input_file, output_file, args.batch_size)
+            evaluator.client.log_pool_stats()
+            for limiter in all_rate_limiters().values():
+                logger.info(limiter.describe())
 
     except Exception as e:
         logger.error(f"主任务异常: {e}")
     finally:
+        metrics.write_summary()
+        metrics.close()
         end_time = time.time()
         logger.info(f"🎉 所有任务完成，用时 {end_time - start_time:.2f} 秒。")
 
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+两阶段（由粗到细）车内识别
+第一阶段：低分辨率全图，只判断黑夜、中央扶手箱、座位排数，以及有人/物品/宠物的区域及其边框；
+第二阶段：只对有内容的区域从原图裁剪高分辨率局部图，识别人的性别、年龄、衣物与区域内的物品。
+merge_results() 把两阶段结果合并为与 EVALUATION_PROMPT_TEMPLATE 相同的 json 结构，
+下游 fill_standard_input 与对比脚本无需改动。
+"""
+from typing import Dict, List, Optional, Tuple
+
+# 输出时人、物品、宠物的排列顺序
+REGION_ORDER = ["前排左", "前排右", "中排左", "中排右", "后排左", "后排右",
+                "中央扶手箱", "中央扶手箱-杯槽", "过道", "unknown"]
+PERSON_FIELDS = ["性别", "年龄", "上衣颜色", "上衣样式", "下装颜色", "下装样式"]
+
+COARSE_PROMPT_TEMPLATE = """
+{source_text}
+角色: 你是一位车内识别助手。
+任务: 这是一张低分辨率的车内全景图，只判断整体布局以及哪些区域有人、物品或宠物，不需要识别衣物等细节。严格按照json 格式输出，答案只能从备选项中选取并只选取一个：
+{{"是否为黑夜":"是，否，unknown",
+"是否有中央扶手箱":"是，否",
+"座位排数":"2，3",
+"区域":[{{"位置":"前排左，前排右，中排左（若有），中排右（若有），后排左，后排右，中央扶手箱，过道","人数":"0,1","物品数":"0,1,2,3,4","框":[ymin,xmin,ymax,xmax]}}],
+"宠物":[{{"种类":"猫，狗，unknown","位置":"前排左，前排右，中排左（若有），中排右（若有），后排左，后排右，中央扶手箱，过道，unknown"}}]}}
+输出要求:
+- 以图片左侧为左，右侧为右。
+- 若有两排座位，用前排、后排代称。若有三排座位，用前排、中排、后排代称。
+- "区域"只列出有人或有物品的区域，每个区域一项；没有人也没有物品的座位不要列出。
+- 框为该区域在图中的范围，坐标按 0-1000 归一化，顺序为 [ymin, xmin, ymax, xmax]，需完整包含区域内的人和物品。
+- 物品即为与人无连接但放在车上的物体，其不属于车本身，注意不要遗漏中央扶手箱上的物品。
+- 没有宠物时"宠物"为空列表。
+- 只输出json ,不要给出解释或说明
+"""
+
+FINE_PROMPT_TEMPLATE = """
+{source_text}
+角色: 你是一位车内识别助手。
+任务: 这是车内"{position}"区域的高分辨率局部图。{person_hint}严格按照json 格式输出，除上装颜色和下装颜色部分可以选择三个及以下的答案外，其余答案均只能从备选项中选取并只选取一个，无法归类时设置为unknown：
+{{"人":[{{"性别":"男，女，unknown","年龄":"幼儿，儿童，成年，老年，unknown","上衣颜色":"灰色，红色，蓝色，橙色，黄色，绿色，紫色，黑色，白色，棕色，粉色，金色，银色，米色，unknown","上衣样式":"夹克，T恤，衬衫，毛衣，连帽衫，polo衫，西装，大衣，羽绒服，背心，连衣裙，unknown","下装颜色":"灰色，红色，蓝色，橙色，黄色，绿色，紫色，黑色，白色，棕色，粉色，金色，银色，米色，unknown","下装样式":"休闲长裤，牛仔长裤，西装长裤，短裤，裙子，unknown"}}],
+"物品":[{{"种类":"背包，宠物包，笔记本，手机，平板，挎包（单肩包），水杯，瓶装酒水，易拉罐，保温杯，大型行李箱，大纸箱，玩偶，衣服（除外套），外套，钱包，书本，鲜花，抱枕，口罩，帽子，纸巾盒，钥匙，unknown","位置":"{item_positions}"}}]}}
+输出要求:
+- 只识别位于"{position}"的人和物品，局部图边缘露出的其他区域内容不要输出。
+- 若衣物颜色主体有三种及以下颜色，可以将其在备选项中的描述的颜色均输出,用逗号隔开如"红色，绿色，蓝色"
+- 若上装给了连衣裙，则下装样式颜色均为unknown
+- 衣物样式及颜色只看最外层的衣物
+- 物品即为与人无连接但放在车上的物体，其不属于车本身，详细检查不要遗漏；没有人或物品时对应列表为空。
+- 只输出json ,不要给出解释或说明
+"""
+
+
+def normalize_position(position: str) -> str:
+    """去掉"（若有）"等后缀，未知位置归为 unknown"""
+    position = str(position or "").replace("（若有）", "").replace("(若有)", "").strip()
+    return position if position in REGION_ORDER else "unknown"
+
+
+def region_sort_key(position: str) -> int:
+    return REGION_ORDER.index(normalize_position(position))
+
+
+def fit_size(size: Tuple[int, int], max_size: Tuple[int, int]) -> Tuple[int, int]:
+    """与 Image.thumbnail 一致：按比例缩小到 max_size 之内，不放大"""
+    w, h = size
+    scale = min(1.0, max_size[0] / w, max_size[1] / h)
+    return max(1, round(w * scale)), max(1, round(h * scale))
+
+
+def crop_box(box, size: Tuple[int, int], pad: float = 0.1) -> Optional[Tuple[int, int, int, int]]:
+    """
+    把 0-1000 归一化的 [ymin, xmin, ymax, xmax] 转为原图像素 (left, top, right, bottom)，四周外扩 pad 比例。
+    框无效时返回 None。
+    """
+    try:
+        ymin, xmin, ymax, xmax = (float(v) for v in box)
+    except (TypeError, ValueError):
+        return None
+    if ymax <= ymin or xmax <= xmin:
+        return None
+    w, h = size
+    pad_x = (xmax - xmin) * pad
+    pad_y = (ymax - ymin) * pad
+    left = max(0, int((xmin - pad_x) / 1000 * w))
+    top = max(0, int((ymin - pad_y) / 1000 * h))
+    right = min(w, int((xmax + pad_x) / 1000 * w))
+    bottom = min(h, int((ymax + pad_y) / 1000 * h))
+    if right - left < 8 or bottom - top < 8:
+        return None
+    return left, top, right, bottom
+
+
+def coarse_regions(coarse: dict) -> List[dict]:
+    """第一阶段中有人或物品的区域（位置已归一化），按 REGION_ORDER 排序"""
+    regions = []
+    for region in coarse.get("区域") or []:
+        if not isinstance(region, dict):
+            continue
+        position = normalize_position(region.get("位置"))
+        if str(region.get("人数", "0")) == "0" and str(region.get("物品数", "0")) == "0":
+            continue
+        regions.append({**region, "位置": position})
+    return sorted(regions, key=lambda r: region_sort_key(r["位置"]))
+
+
+def build_fine_prompt(source_text: str, region: dict) -> str:
+    position = region["位置"]
+    if position == "中央扶手箱":
+        item_positions = "中央扶手箱，中央扶手箱-杯槽"
+    else:
+        item_positions = position
+    if str(region.get("人数", "0")) == "0":
+        person_hint = "该区域没有人，\"人\"输出空列表。"
+    else:
+        person_hint = "该区域有一人。"
+    return FINE_PROMPT_TEMPLATE.format(source_text=source_text, position=position,
+                                       person_hint=person_hint, item_positions=item_positions)
+
+
+def merge_results(coarse: dict, fine_results: List[Tuple[dict, dict]]) -> Dict:
+    """
+    合并为完整结果。fine_results 为 (区域, 第二阶段输出) 列表；
+    人与物品取第二阶段，位置以第一阶段区域为准（扶手箱物品可细分到杯槽），宠物取第一阶段。
+    """
+    persons, items = [], []
+    for region, fine in fine_results:
+        position = region["位置"]
+        for person in fine.get("人") or []:
+            if isinstance(person, dict):
+                persons.append({**{k: person.get(k, "unknown") for k in PERSON_FIELDS[:2]},
+                                "位置": position,
+                                **{k: person.get(k, "unknown") for k in PERSON_FIELDS[2:]}})
+        for item in fine.get("物品") or []:
+            if not isinstance(item, dict):
+                continue
+            item_position = normalize_position(item.get("位置"))
+            if not (position == "中央扶手箱" and item_position == "中央扶手箱-杯槽"):
+                item_position = position
+            items.append({"种类": item.get("种类", "unknown"), "位置": item_position})
+
+    pets = [{"种类": pet.get("种类", "unknown"), "位置": normalize_position(pet.get("位置"))}
+            for pet in coarse.get("宠物") or [] if isinstance(pet, dict)]
+
+    persons.sort(key=lambda p: region_sort_key(p["位置"]))
+    items.sort(key=lambda p: region_sort_key(p["位置"]))
+    pets.sort(key=lambda p: region_sort_key(p["位置"]))
+    return {
+        "是否为黑夜": coarse.get("是否为黑夜", "unknown"),
+        "是否有中央扶手箱": coarse.get("是否有中央扶手箱", "unknown"),
+        "人": {"人数": str(len(persons)), "具体信息": persons},
+        "物品": {"物品数": str(len(items)), "具体信息": items},
+        "宠物": {"宠物数": str(len(pets)), "具体信息": pets},
+    }
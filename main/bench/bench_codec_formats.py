@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+上传图片编码格式基准测试
+对每张样例图片比较 PNG（旧实现）与 JPEG / WebP 各质量预设的输出字节数、Base64 长度和编码耗时，
+输出 Markdown 表格。
+
+用法:
+    python main/bench/bench_codec_formats.py -i path/to/cabin_photos -o main/bench/codec_formats.md
+"""
+import os
+import sys
+import time
+import base64
+import argparse
+import statistics
+from pathlib import Path
+from typing import List
+
+from PIL import Image
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from image_codec import encode_pil_image, QUALITY_PRESETS
+
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".webp"}
+
+
+def collect_images(inputs: List[str]) -> List[Path]:
+    images = []
+    for item in inputs:
+        path = Path(item)
+        if path.is_dir():
+            images.extend(p for p in sorted(path.rglob("*")) if p.suffix.lower() in IMAGE_SUFFIXES)
+        elif path.exists():
+            images.append(path)
+    return images
+
+
+def time_encode(img: Image.Image, max_dim: int, quality: int, fmt: str, repeat: int):
+    timings, data = [], b""
+    for _ in range(repeat):
+        start = time.perf_counter()
+        data = encode_pil_image(img, (max_dim, max_dim), quality, fmt=fmt)
+        timings.append(time.perf_counter() - start)
+    return data, statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='比较 PNG / JPEG / WebP 编码体积与耗时')
+    parser.add_argument('-i', '--inputs', nargs='+', required=True, help='图片文件或目录')
+    parser.add_argument('-d', '--max-dim', type=int, default=2400, help='最大边长')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='每种组合重复次数(取中位数)')
+    parser.add_argument('-o', '--output', help='可选:将 Markdown 表格写入文件')
+    args = parser.parse_args()
+
+    images = collect_images(args.inputs)
+    if not images:
+        print("❌ 没有找到图片")
+        return
+
+    variants = [("PNG", "-", 0)]
+    for fmt in ("JPEG", "WEBP"):
+        variants.extend((fmt, name, quality) for name, quality in QUALITY_PRESETS.items())
+
+    lines = [
+        f"最大边长 {args.max_dim}px,耗时为 {args.repeat} 次编码的中位数。",
+        "",
+        "| 图片 | 尺寸 | 格式 | 预设 | 字节数 | Base64 长度 | 相对 PNG | 编码耗时(ms) |",
+        "| --- | --- | --- | --- | ---: | ---: | ---: | ---: |",
+    ]
+    for path in images:
+        with Image.open(path) as img:
+            img.load()
+            png_bytes = None
+            for fmt, preset, quality in variants:
+                data, seconds = time_encode(img, args.max_dim, quality, fmt, args.repeat)
+                png_bytes = png_bytes or len(data)
+                lines.append(
+                    f"| {path.name} | {img.size[0]}x{img.size[1]} | {fmt} | {preset} | {len(data):,} | "
+                    f"{len(base64.b64encode(data)):,} | {len(data) / png_bytes:.0%} | {seconds * 1000:.1f} |"
+                )
+
+    table = "\n".join(lines)
+    print(table)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write("# 上传图片编码格式对比\n\n")
+            f.write(f"由 `python main/bench/bench_codec_formats.py -i <图片> -o {args.output}` 生成。\n\n")
+            f.write(table + "\n")
+
+
+if __name__ == "__main__":
+    main()
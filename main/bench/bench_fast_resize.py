@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+encode_image 快速缩放基准测试
+对比标准路径（全尺寸解码 + LANCZOS）与 fast_resize（JPEG draft + BILINEAR）的
+耗时、峰值内存（RSS）以及输出保真度（相对标准路径的 PSNR）。
+
+用法:
+    python main/bench/bench_fast_resize.py -c my_corpus/part1.jsonl
+    python main/bench/bench_fast_resize.py -i path/to/DJI_images
+"""
+import os
+import io
+import sys
+import json
+import base64
+import argparse
+import resource
+import time
+import multiprocessing as mp
+from pathlib import Path
+from typing import List
+
+import numpy as np
+from PIL import Image
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from image_codec import encode_image
+
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".webp"}
+
+
+def collect_images(corpus: List[str], image_dirs: List[str]) -> List[str]:
+    """从 jsonl 语料的 image_path 字段或图片目录收集去重后的图片列表"""
+    paths = []
+    for corpus_path in corpus:
+        with open(corpus_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    paths.append(json.loads(line).get("image_path", ""))
+    for image_dir in image_dirs:
+        paths.extend(str(p) for p in sorted(Path(image_dir).rglob("*")) if p.suffix.lower() in IMAGE_SUFFIXES)
+
+    seen, images = set(), []
+    for p in paths:
+        if p and p not in seen and os.path.exists(p):
+            seen.add(p)
+            images.append(p)
+    return images
+
+
+def run_mode(images: List[str], max_size: tuple, fast_resize: bool, repeat: int, queue):
+    """在独立子进程中运行，使 ru_maxrss 只反映该模式的内存峰值"""
+    outputs = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        outputs = [encode_image(p, max_size=max_size, use_cache=False, fast_resize=fast_resize) for p in images]
+    elapsed = (time.perf_counter() - start) / repeat
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put({"elapsed": elapsed, "peak_rss_mb": peak_rss_kb / 1024, "outputs": outputs})
+
+
+def measure(images: List[str], max_size: tuple, fast_resize: bool, repeat: int) -> dict:
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=run_mode, args=(images, max_size, fast_resize, repeat, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def decode(encoded: str) -> Image.Image:
+    return Image.open(io.BytesIO(base64.b64decode(encoded))).convert("RGB")
+
+
+def psnr(reference: str, candidate: str) -> float:
+    ref, cand = decode(reference), decode(candidate)
+    if cand.size != ref.size:
+        cand = cand.resize(ref.size, Image.Resampling.LANCZOS)
+    mse = np.mean((np.asarray(ref, dtype=np.float64) - np.asarray(cand, dtype=np.float64)) ** 2)
+    return float("inf") if mse == 0 else 10 * np.log10(255.0 ** 2 / mse)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='encode_image 标准路径与 fast_resize 路径对比')
+    parser.add_argument('-c', '--corpus', nargs='*', default=[], help='jsonl 语料文件(读取 image_path 字段)')
+    parser.add_argument('-i', '--image-dir', nargs='*', default=[], help='图片目录')
+    parser.add_argument('-s', '--max-size', type=int, nargs=2, default=[2400, 1600], help='目标最大尺寸 宽 高')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='每种模式重复次数')
+    parser.add_argument('-o', '--output', help='可选:将结果写入 JSON 文件')
+    args = parser.parse_args()
+
+    images = collect_images(args.corpus, args.image_dir)
+    if not images:
+        print("❌ 没有找到可用的图片,请检查 --corpus / --image-dir")
+        return
+    max_size = tuple(args.max_size)
+    print(f"共 {len(images)} 张图片,目标尺寸 {max_size[0]}x{max_size[1]},重复 {args.repeat} 次")
+
+    baseline = measure(images, max_size, False, args.repeat)
+    fast = measure(images, max_size, True, args.repeat)
+    scores = [psnr(ref, cand) for ref, cand in zip(baseline["outputs"], fast["outputs"])]
+    finite = [s for s in scores if s != float("inf")]
+
+    report = {
+        "images": len(images),
+        "max_size": list(max_size),
+        "baseline": {"seconds": baseline["elapsed"], "peak_rss_mb": baseline["peak_rss_mb"]},
+        "fast_resize": {"seconds": fast["elapsed"], "peak_rss_mb": fast["peak_rss_mb"]},
+        "speedup": baseline["elapsed"] / fast["elapsed"] if fast["elapsed"] else None,
+        "psnr_db": {
+            "mean": float(np.mean(finite)) if finite else float("inf"),
+            "min": float(np.min(finite)) if finite else float("inf"),
+        },
+    }
+
+    print(f"{'模式':<12}{'耗时(s)':>10}{'每张(ms)':>10}{'峰值RSS(MB)':>14}")
+    for name in ("baseline", "fast_resize"):
+        r = report[name]
+        print(f"{name:<12}{r['seconds']:>10.3f}{r['seconds'] / len(images) * 1000:>10.1f}{r['peak_rss_mb']:>14.1f}")
+    print(f"加速比: {report['speedup']:.2f}x,PSNR 均值 {report['psnr_db']['mean']:.2f} dB,最小 {report['psnr_db']['min']:.2f} dB")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
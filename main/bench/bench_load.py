@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+评估脚本压测
+启动本地假模型服务（mock_llm_server.py，耗时分布、429/5xx 注入、流式等参数与其相同），
+在不同并发下以子进程运行各评估脚本，报告吞吐（行/秒、请求/秒）与服务端耗时 p50/p95/p99、注入的错误数与结果错误数，
+以及脚本自身记录的调用指标（LLM_METRICS_DIR，见 main/utils/metrics.py）：含重试的客户端耗时 p50/p95/p99 与 tokens 合计。
+
+支持的脚本:
+    gene_answer            -b / -c 设为并发数
+    curl_gemini_for_para   -b / -c 设为并发数
+    langGraphPicAlot       顺序处理，只在并发 1 下运行一次（读取工作目录下 my_corpus/a3.jsonl）
+    langGraphPicAlotInter  同上
+inCabinAgentForWebPIc.py 需要标注平台的 standardInput 记录与远程图片地址，不在此压测。
+各次运行使用独立的临时工作目录，响应缓存设为 bypass；图片编码缓存照常使用，因此测得的是请求阶段的吞吐。
+行/秒按子进程总用时计算（含 Python 启动与导入），行数较少时偏低。
+
+用法:
+    python main/bench/bench_load.py --image path/to/cabin.jpg -n 64 --concurrency 1,4,8,16 \\
+        --latency-median 1.5 --error-429 0.03 -o main/bench/load_report.md --json load_report.json
+"""
+import os
+import sys
+import json
+import shlex
+import argparse
+import subprocess
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from mock_llm_server import build_parser as build_mock_parser
+
+AGENT_DIR = Path(os.path.dirname(os.path.abspath(__file__))).parent / "agent"
+MOCK_SERVER = Path(os.path.dirname(os.path.abspath(__file__))) / "mock_llm_server.py"
+
+TARGETS = {
+    "gene_answer": {"script": "gene_answer.py", "concurrent": True, "kind": "image", "field": "gemini_response"},
+    "curl_gemini_for_para": {"script": "curl_gemini_for_para.py", "concurrent": True, "kind": "text",
+                             "field": "gemini_evaluation"},
+    "langGraphPicAlot": {"script": "langGraphPicAlot.py", "concurrent": False, "kind": "image",
+                         "output": "results_a3.json"},
+    "langGraphPicAlotInter": {"script": "langGraphPicAlotInter.py", "concurrent": False, "kind": "image",
+                              "output": "outputs/results_a3.json"},
+}
+
+
+def http_json(url: str, method: str = "GET") -> dict:
+    request = urllib.request.Request(url, method=method, data=b"" if method == "POST" else None)
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.loads(response.read())
+
+
+def start_mock(args, mock_parser: argparse.ArgumentParser) -> subprocess.Popen:
+    command = [sys.executable, str(MOCK_SERVER)]
+    for action in mock_parser._actions:
+        if action.dest != "help":
+            command += [action.option_strings[0], str(getattr(args, action.dest))]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            http_json(f"http://{args.host}:{args.port}/stats")
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("假模型服务启动失败")
+
+
+def write_inputs(workdir: Path, kind: str, rows: int, image: str) -> Path:
+    """在工作目录下生成输入语料，返回语料所在目录"""
+    input_dir = workdir / "in"
+    input_dir.mkdir(parents=True)
+    with open(input_dir / "corpus.jsonl", "w", encoding="utf-8") as f:
+        for i in range(rows):
+            if kind == "text":
+                row = {"id": i, "source_text": f"Please fasten your seat belt, passenger {i}.",
+                       "target_text": f"ກະລຸນາຮັດສາຍແອວນິລະໄພ, ຜູ້ໂດຍສານ {i}."}
+            else:
+                row = {"id": i, "source_text": f"第 {i} 张车内图片", "image_path": os.path.abspath(image)}
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    return input_dir
+
+
+def build_command(target: str, spec: dict, workdir: Path, input_dir: Path, concurrency: int, args) -> list:
+    script = str(AGENT_DIR / spec["script"])
+    if not spec["concurrent"]:
+        # LangGraph 脚本的输入输出路径写死为相对路径
+        (workdir / "my_corpus").mkdir()
+        (workdir / "outputs").mkdir()
+        os.replace(input_dir / "corpus.jsonl", workdir / "my_corpus" / "a3.jsonl")
+        return [sys.executable, script]
+    command = [sys.executable, script, "-i", str(input_dir), "-o", str(workdir / "out"), "-k", "mock",
+               "-u", args.base_url, "-b", str(concurrency), "-c", str(concurrency)]
+    if args.stream:
+        command.append("--stream-response")
+    extra = args.gene_answer_args if target == "gene_answer" else args.para_args if target == "curl_gemini_for_para" else ""
+    return command + shlex.split(extra or "")
+
+
+def count_results(target: str, spec: dict, workdir: Path, rows: int) -> tuple:
+    """返回 (成功行数, 出错行数)"""
+    if spec["concurrent"]:
+        ok = errors = 0
+        for path in (workdir / "out").glob("*.jsonl"):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    result = json.loads(line).get(spec["field"])
+                    if isinstance(result, dict) and "error" in result:
+                        errors += 1
+                    else:
+                        ok += 1
+        return ok, errors
+    output = workdir / spec["output"]
+    if not output.exists():
+        return 0, rows
+    with open(output, "r", encoding="utf-8") as f:
+        done = len(json.load(f))
+    return done, rows - done
+
+
+def load_client_metrics(path: Path) -> dict:
+    """脚本写出的调用指标汇总；脚本未写出（如启动失败）时返回空字典"""
+    if not path.exists():
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def run_one(target: str, concurrency: int, args, env: dict) -> dict:
+    spec = TARGETS[target]
+    with tempfile.TemporaryDirectory(prefix=f"bench_{target}_") as tmp:
+        workdir = Path(tmp)
+        input_dir = write_inputs(workdir, spec["kind"], args.num_rows, args.image)
+        command = build_command(target, spec, workdir, input_dir, concurrency, args)
+        http_json(f"http://{args.host}:{args.port}/reset", "POST")
+        env = dict(env, LLM_METRICS_DIR=str(workdir / "metrics"))
+        start = time.perf_counter()
+        try:
+            completed = subprocess.run(command, cwd=workdir, env=env, capture_output=True, text=True,
+                                       timeout=args.timeout)
+            returncode, stderr = completed.returncode, completed.stderr
+        except subprocess.TimeoutExpired as e:
+            returncode, stderr = "timeout", str(e.stderr or "")
+        elapsed = time.perf_counter() - start
+        server = http_json(f"http://{args.host}:{args.port}/stats")
+        ok, errors = count_results(target, spec, workdir, args.num_rows)
+        client = load_client_metrics(workdir / "metrics" / "summary.json")
+
+    status = server["status"]
+    result = {
+        "target": target,
+        "concurrency": concurrency,
+        "rows": args.num_rows,
+        "ok": ok,
+        "errors": errors,
+        "elapsed": elapsed,
+        "rows_per_s": ok / elapsed if elapsed else 0.0,
+        "requests": server["requests"],
+        "requests_per_s": server["requests"] / elapsed if elapsed else 0.0,
+        "status_429": status.get("429", 0),
+        "status_5xx": sum(v for k, v in status.items() if k.startswith("5")),
+        "server_latency": server["latency"],
+        "peak_in_flight": server["peak_in_flight"],
+        "client_latency": client.get("latency", {}),
+        "client_retries": client.get("totals", {}).get("retries"),
+        "prompt_tokens": client.get("totals", {}).get("prompt_tokens"),
+        "completion_tokens": client.get("totals", {}).get("completion_tokens"),
+        "returncode": returncode,
+    }
+    if returncode != 0:
+        result["stderr_tail"] = stderr[-2000:]
+    return result
+
+
+def format_report(results: list, args) -> str:
+    def seconds(value):
+        return f"{value:.2f}" if value is not None else "-"
+
+    def count(value):
+        return value if value is not None else "-"
+
+    lines = [
+        "# 评估脚本压测报告",
+        "",
+        f"由 `python main/bench/bench_load.py` 生成。每次 {args.num_rows} 行;假模型服务耗时中位数 {args.latency_median}s,"
+        f"sigma {args.latency_sigma},长尾 {args.tail_prob:.0%} × {args.tail_factor};注入 429 {args.error_429:.0%}、"
+        f"5xx {args.error_5xx:.0%};服务端并发上限 {args.capacity or '不限'};{'流式' if args.stream else '非流式'}。",
+        "",
+        "| 脚本 | 并发 | 成功行 | 出错行 | 用时(s) | 行/s | 请求数 | 请求/s | 429 | 5xx | 服务端 p50 | p95 | p99 | "
+        "客户端 p50 | p95 | p99 | 重试 | prompt tokens | completion tokens | 峰值在途 | 退出码 |",
+        "| --- | ---: | ---: | ---: | ---: | ---: | ---: | ---: | ---: | ---: | ---: | ---: | ---: | ---: | ---: | ---: | "
+        "---: | ---: | ---: | ---: | --- |",
+    ]
+    for r in results:
+        latency = r["server_latency"]
+        client = r["client_latency"]
+        lines.append(
+            f"| {r['target']} | {r['concurrency']} | {r['ok']} | {r['errors']} | {r['elapsed']:.1f} | "
+            f"{r['rows_per_s']:.2f} | {r['requests']} | {r['requests_per_s']:.2f} | {r['status_429']} | "
+            f"{r['status_5xx']} | {seconds(latency['p50'])} | {seconds(latency['p95'])} | {seconds(latency['p99'])} | "
+            f"{seconds(client.get('p50'))} | {seconds(client.get('p95'))} | {seconds(client.get('p99'))} | "
+            f"{count(r['client_retries'])} | {count(r['prompt_tokens'])} | {count(r['completion_tokens'])} | "
+            f"{r['peak_in_flight']} | {r['returncode']} |")
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    mock_parser = build_mock_parser(add_help=False)
+    parser = argparse.ArgumentParser(description='评估脚本在本地假模型服务上的压测', parents=[mock_parser])
+    parser.add_argument('--image', required=True, help='输入语料使用的车内图片')
+    parser.add_argument('-n', '--num-rows', type=int, default=64, help='每次运行的记录数')
+    parser.add_argument('--targets', default=",".join(TARGETS), help=f'逗号分隔的脚本名,可选 {", ".join(TARGETS)}')
+    parser.add_argument('--concurrency', default="1,4,8,16", help='逗号分隔的并发数')
+    parser.add_argument('--stream', action='store_true', help='以 --stream-response 运行支持流式的脚本')
+    parser.add_argument('--rps', type=float, help='客户端限速器的初始与最大速率(通过 LLM_RATE_LIMITS 传入);默认使用脚本自身的限速配置')
+    parser.add_argument('--gene-answer-args', default="", help='追加给 gene_answer.py 的参数,如 "--two-pass --hedge-percentile 95"')
+    parser.add_argument('--para-args', default="", help='追加给 curl_gemini_for_para.py 的参数')
+    parser.add_argument('--timeout', type=float, default=1800, help='单次运行的超时秒数')
+    parser.add_argument('-o', '--output', help='Markdown 报告路径,缺省时打印')
+    parser.add_argument('--json', help='JSON 报告路径')
+    args = parser.parse_args()
+    args.base_url = f"http://{args.host}:{args.port}/v1"
+
+    targets = [t.strip() for t in args.targets.split(",") if t.strip()]
+    unknown = [t for t in targets if t not in TARGETS]
+    if unknown:
+        parser.error(f"未知的脚本: {', '.join(unknown)}")
+    levels = [int(c) for c in args.concurrency.split(",") if c.strip()]
+
+    env = dict(os.environ, GEMINI_API_KEY="mock", API_KEY="mock", BASE_URL=args.base_url, RESPONSE_CACHE="bypass")
+    if args.rps:
+        env["LLM_RATE_LIMITS"] = json.dumps({"": {"rps": args.rps, "max_rps": args.rps}})
+
+    mock = start_mock(args, mock_parser)
+    results = []
+    try:
+        for target in targets:
+            for concurrency in (levels if TARGETS[target]["concurrent"] else [1]):
+                result = run_one(target, concurrency, args, env)
+                results.append(result)
+                print(f"{target} 并发 {concurrency}: {result['ok']}/{result['rows']} 行,{result['elapsed']:.1f} 秒,"
+                      f"{result['rows_per_s']:.2f} 行/秒,退出码 {result['returncode']}", flush=True)
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    report = format_report(results, args)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report)
+    else:
+        print("\n" + report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
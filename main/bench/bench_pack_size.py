@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+多图打包 K=1..8 对比
+对同一批记录依次以每次请求 K 张图片调用 GeminiEvaluator.evaluate_packed，
+报告吞吐（张/秒）、每张图片的 prompt / completion tokens（取接口返回的 usage）以及单图回退数。
+需要可用的 API（与 gene_answer.py 相同的 -k / -u / -m 参数）。
+
+用法:
+    python main/bench/bench_pack_size.py -c my_corpus/part1.jsonl -n 48 --max-pack 8
+"""
+import os
+import sys
+import json
+import argparse
+import asyncio
+import logging
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "agent"))
+
+
+def load_items(corpus_path: str, limit: int):
+    items = []
+    with open(corpus_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            items.append((row.get("source_text", ""), row.get("image_path", ""), None, None, None))
+            if len(items) >= limit:
+                break
+    return items
+
+
+async def run_pack(gene_answer, args, items, pack_size: int) -> dict:
+    semaphore = asyncio.Semaphore(args.concurrency)
+    async with gene_answer.GeminiEvaluator(args.api_key, args.base_url, args.model, pack_size=pack_size) as evaluator:
+        async def run_group(group):
+            async with semaphore:
+                return await evaluator.evaluate_packed(group)
+
+        groups = [items[k:k + pack_size] for k in range(0, len(items), pack_size)]
+        start = time.perf_counter()
+        results = await asyncio.gather(*[run_group(group) for group in groups])
+        elapsed = time.perf_counter() - start
+
+    n = len(items)
+    errors = sum(1 for group in results for r in group if isinstance(r, dict) and "error" in r)
+    return {
+        "K": pack_size,
+        "requests": evaluator.usage["requests"],
+        "images_per_s": n / elapsed,
+        "prompt_tokens_per_image": evaluator.usage["prompt_tokens"] / n,
+        "completion_tokens_per_image": evaluator.usage["completion_tokens"] / n,
+        "fallbacks": evaluator.pack_stats["fallbacks"],
+        "errors": errors,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='多图打包 K=1..N 吞吐与 tokens 对比')
+    parser.add_argument('-c', '--corpus', required=True, help='.jsonl 语料文件')
+    parser.add_argument('-n', '--num-images', type=int, default=48, help='参与测试的记录数')
+    parser.add_argument('-k', '--api-key', default=os.getenv('GEMINI_API_KEY'), help='API 密钥')
+    parser.add_argument('-u', '--base-url', help='API Base URL')
+    parser.add_argument('-m', '--model', default='gemini-2.5-flash-preview-05-20-nothinking', help='使用的模型名称')
+    parser.add_argument('--max-pack', type=int, default=8, help='测试的最大 K')
+    parser.add_argument('--concurrency', type=int, default=4, help='同时在途的请求数')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    import gene_answer
+
+    items = load_items(args.corpus, args.num_images)
+    rows = []
+    for pack_size in range(1, args.max_pack + 1):
+        rows.append(await run_pack(gene_answer, args, items, pack_size))
+
+    print(f"\n{len(items)} 张图片,并发 {args.concurrency},模型 {args.model}\n")
+    print("| K | 请求数 | 吞吐(张/s) | prompt tokens/张 | completion tokens/张 | 单图回退 | 错误 |")
+    print("|---|---|---|---|---|---|---|")
+    for r in rows:
+        print(f"| {r['K']} | {r['requests']} | {r['images_per_s']:.2f} | {r['prompt_tokens_per_image']:.0f} | "
+              f"{r['completion_tokens_per_image']:.0f} | {r['fallbacks']} | {r['errors']} |")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
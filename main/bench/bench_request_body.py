@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+请求体构造内存对比
+在本地启动一个 OpenAI 兼容的假服务（独立进程，读取并校验请求体后返回固定回答），
+分别以 json=payload（旧方式）与 --stream-body 流式方式并发调用 GeminiEvaluator.evaluate_pair，
+每种方式在独立子进程中运行，报告 tracemalloc 峰值与进程峰值 RSS。
+
+用法:
+    python main/bench/bench_request_body.py -i path/to/image.jpg -n 32
+"""
+import os
+import sys
+import json
+import base64
+import argparse
+import asyncio
+import resource
+import time
+import tracemalloc
+import multiprocessing as mp
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "agent"))
+
+FAKE_CONTENT = json.dumps({"是否为黑夜": "否"}, ensure_ascii=False)
+
+
+def run_server(port: int, ready):
+    from aiohttp import web
+
+    async def completions(request):
+        body = json.loads(await request.read())
+        url = body["messages"][1]["content"][1]["image_url"]["url"]
+        base64.b64decode(url.split(",", 1)[1], validate=True)  # 校验图片数据完整
+        return web.json_response({"choices": [{"message": {"content": FAKE_CONTENT}}]})
+
+    app = web.Application(client_max_size=256 * 1024 * 1024)
+    app.router.add_post("/v1/chat/completions", completions)
+
+    async def main():
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+def run_client(image_path: str, concurrency: int, stream_body: bool, port: int, queue):
+    import logging
+    logging.disable(logging.INFO)
+    import gene_answer
+
+    async def main():
+        encode_kwargs = {"use_cache": False}
+        async with gene_answer.GeminiEvaluator("test-key", f"http://127.0.0.1:{port}/v1", "mock",
+                                               encode_kwargs, stream_body) as evaluator:
+            # 预热连接与模块,避免计入峰值
+            await evaluator.evaluate_pair("warmup", image_path)
+            tracemalloc.start()
+            start = time.perf_counter()
+            results = await asyncio.gather(*[evaluator.evaluate_pair("bench", image_path) for _ in range(concurrency)])
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        errors = sum(1 for r in results if "error" in r)
+        return elapsed, peak, errors
+
+    sys.stdout = open(os.devnull, "w")  # evaluate_pair 会打印模型输出
+    elapsed, peak, errors = asyncio.run(main())
+    queue.put({
+        "elapsed": elapsed,
+        "tracemalloc_peak_mb": peak / 1024 / 1024,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "errors": errors,
+    })
+
+
+def measure(image_path: str, concurrency: int, stream_body: bool, port: int) -> dict:
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=run_client, args=(image_path, concurrency, stream_body, port, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='对比 json= 与流式请求体的内存占用')
+    parser.add_argument('-i', '--image', required=True, help='测试图片')
+    parser.add_argument('-n', '--concurrency', type=int, default=32, help='同时在途的请求数')
+    parser.add_argument('-p', '--port', type=int, default=18089, help='本地假服务端口')
+    args = parser.parse_args()
+
+    ctx = mp.get_context("spawn")
+    ready = ctx.Event()
+    server = ctx.Process(target=run_server, args=(args.port, ready), daemon=True)
+    server.start()
+    ready.wait(30)
+
+    try:
+        print(f"并发 {args.concurrency},图片 {args.image}")
+        print(f"{'方式':<10}{'耗时(s)':>10}{'tracemalloc峰值(MB)':>22}{'峰值RSS(MB)':>14}{'错误':>6}")
+        for name, stream_body in (("json", False), ("stream", True)):
+            r = measure(args.image, args.concurrency, stream_body, args.port)
+            print(f"{name:<10}{r['elapsed']:>10.2f}{r['tracemalloc_peak_mb']:>22.1f}{r['peak_rss_mb']:>14.1f}{r['errors']:>6}")
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
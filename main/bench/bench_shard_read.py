@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+分片读取与散文件读取对比
+- 冷启动：从构造读取器到取得第一张图片的耗时
+- 单张读取延迟：遍历语料中每条记录取得 Base64 的 p50 / p95 / 均值
+散文件路径为每条记录 os.path.exists + encode_image（与各评估脚本一致，可选关闭编码缓存）。
+注意：结果受操作系统页缓存影响，测冷数据前需自行清空缓存或在新挂载的网络盘上运行。
+
+用法:
+    python main/bench/bench_shard_read.py -c my_corpus/part1.jsonl -s shards/part1
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from image_codec import encode_image
+from image_shard import ShardReader
+
+
+def load_records(corpus_files):
+    paths = []
+    for corpus_path in corpus_files:
+        with open(corpus_path, "r", encoding="utf-8") as f:
+            paths.extend(json.loads(line).get("image_path", "") for line in f if line.strip())
+    return paths
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def summarize(name, cold_start, latencies):
+    if not latencies:
+        print(f"{name:<16}{'无数据':>12}")
+        return
+    print(f"{name:<16}{cold_start * 1000:>12.2f}{statistics.mean(latencies) * 1000:>12.3f}"
+          f"{percentile(latencies, 0.5) * 1000:>12.3f}{percentile(latencies, 0.95) * 1000:>12.3f}")
+
+
+def bench_loose(paths, use_cache: bool):
+    start = time.perf_counter()
+    latencies = []
+    cold_start = None
+    for image_path in paths:
+        t0 = time.perf_counter()
+        if os.path.exists(image_path):
+            encode_image(image_path, use_cache=use_cache)
+        latencies.append(time.perf_counter() - t0)
+        if cold_start is None:
+            cold_start = time.perf_counter() - start
+    return cold_start or 0.0, latencies
+
+
+def bench_shard(paths, shard_dir):
+    start = time.perf_counter()
+    reader = ShardReader(shard_dir)
+    latencies = []
+    cold_start = None
+    for image_path in paths:
+        t0 = time.perf_counter()
+        reader.get_base64(image_path)
+        latencies.append(time.perf_counter() - t0)
+        if cold_start is None:
+            cold_start = time.perf_counter() - start
+    reader.close()
+    return cold_start or 0.0, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='对比分片 mmap 读取与散文件读取')
+    parser.add_argument('-c', '--corpus', nargs='+', required=True, help='.jsonl 语料文件')
+    parser.add_argument('-s', '--shard-dir', required=True, help='pack_image_shards.py 生成的分片目录')
+    parser.add_argument('--no-loose-cache', action='store_true', help='散文件路径不使用编码缓存(完整解码+编码)')
+    args = parser.parse_args()
+
+    paths = load_records(args.corpus)
+    print(f"共 {len(paths)} 条记录")
+    print(f"{'方式':<16}{'冷启动(ms)':>12}{'均值(ms)':>12}{'p50(ms)':>12}{'p95(ms)':>12}")
+    summarize("loose", *bench_loose(paths, use_cache=not args.no_loose_cache))
+    summarize("shard(mmap)", *bench_shard(paths, args.shard_dir))
+
+
+if __name__ == "__main__":
+    main()
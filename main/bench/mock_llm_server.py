@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+本地 OpenAI 兼容的假视觉模型服务（/v1/chat/completions）
+用于在不消耗真实额度、不受代理抖动影响的情况下测量评估脚本的吞吐：
+- 耗时服从对数正态分布（中位数 --latency-median，离散度 --latency-sigma），并以 --tail-prob 的概率放大 --tail-factor 倍模拟长尾；
+- 按比例注入 429（带 Retry-After）与 5xx，--capacity 限制服务端同时处理的请求数，超出时返回 429；
+- 支持 stream: true（SSE 分块输出，首块在耗时的 --ttft-ratio 处到达），可在 stream_options.include_usage 时附带 usage；
+- 回答按 prompt 类型生成：车内识别模版（单图 / 多图打包 / 两阶段粗细两步）的取值从 prompt 的备选项中随机选取，
+  译文评估返回 quality_score 等字段（response_format 为 json_object 时不加代码块标记），其余 prompt 返回一段简短文本；--invalid-rate 比例的回答故意无效（前置解释文字或越界取值）。
+GET /stats 返回本轮统计（请求数、各状态码次数、服务端耗时 p50/p95/p99、峰值并发、客户端中途断开次数），POST /reset 清零。
+
+用法:
+    python main/bench/mock_llm_server.py --port 18080 --latency-median 1.5 --error-429 0.03 --error-5xx 0.01
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import asyncio
+import argparse
+from collections import Counter
+
+from aiohttp import web
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from hedging import LatencyTracker
+from stream_validator import enum_schema
+
+PROSE_PREFIX = "好的，下面是我对这张图片的分析：\n"
+FALLBACK_TEXT = "图片中是一辆汽车的车内场景，前排坐着一位乘客。"
+SEAT_POSITIONS = ["前排左", "前排右", "后排左", "后排右"]
+
+
+class MockState:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.status = Counter()
+        self.latency = LatencyTracker(window=100000)
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.disconnects = 0
+        self.started = time.monotonic()
+
+    def summary(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        requests = sum(self.status.values())
+        return {
+            "requests": requests,
+            "status": {str(k): v for k, v in sorted(self.status.items())},
+            "latency": self.latency.percentiles(),
+            "peak_in_flight": self.peak_in_flight,
+            "disconnects": self.disconnects,
+            "elapsed": elapsed,
+            "requests_per_s": requests / elapsed if elapsed else 0.0,
+        }
+
+
+def pick(schema: dict, key: str, default: str = "unknown") -> str:
+    options = [v for v in schema.get(key, ()) if v != "unknown" and "（" not in v]
+    return random.choice(options) if options else default
+
+
+def cabin_answer(schema: dict) -> dict:
+    seats = random.sample(SEAT_POSITIONS, random.randint(0, 2))
+    people = [{
+        "性别": pick(schema, "性别"), "年龄": pick(schema, "年龄"), "位置": seat,
+        "上衣颜色": pick(schema, "上衣颜色"), "上衣样式": pick(schema, "上衣样式"),
+        "下装颜色": pick(schema, "下装颜色"), "下装样式": pick(schema, "下装样式"),
+    } for seat in sorted(seats, key=SEAT_POSITIONS.index)]
+    items = [{"种类": pick(schema, "种类"), "位置": random.choice(["中央扶手箱", "中央扶手箱-杯槽", "前排右"])}
+             for _ in range(random.randint(0, 2))]
+    return {
+        "是否为黑夜": random.choice(["是", "否"]),
+        "是否有中央扶手箱": "是",
+        "人": {"人数": str(len(people)), "具体信息": people},
+        "物品": {"物品数": str(len(items)), "具体信息": items},
+        "宠物": {"宠物数": "0", "具体信息": []},
+    }
+
+
+def coarse_answer() -> dict:
+    regions = [{"位置": seat, "人数": "1", "物品数": "0", "框": [200, 100 + 400 * (i % 2), 900, 500 + 400 * (i % 2)]}
+               for i, seat in enumerate(random.sample(SEAT_POSITIONS, random.randint(1, 2)))]
+    regions.append({"位置": "中央扶手箱", "人数": "0", "物品数": "1", "框": [600, 400, 900, 600]})
+    return {"是否为黑夜": "否", "是否有中央扶手箱": "是", "座位排数": "2", "区域": regions, "宠物": []}
+
+
+def fine_answer(schema: dict, prompt: str) -> dict:
+    people = []
+    if "没有人" not in prompt:
+        people.append({key: pick(schema, key) for key in ("性别", "年龄", "上衣颜色", "上衣样式", "下装颜色", "下装样式")})
+    return {"人": people, "物品": [{"种类": pick(schema, "种类"), "位置": pick(schema, "位置")}]}
+
+
+def translation_answer() -> dict:
+    return {
+        "evaluation_summary": "译文整体准确流畅。",
+        "accuracy_critique": "意思完整传达，无明显漏译。",
+        "fluency_critique": "语法正确，表达自然。",
+        "mt_suspicion_critique": "未见明显机器翻译痕迹。",
+        "quality_score": random.randint(6, 10),
+    }
+
+
+def make_answer(messages: list, invalid_rate: float, json_mode: bool = False) -> str:
+    """按 prompt 类型生成回答文本；json_mode（response_format 为 json_object）时不加代码块标记"""
+    texts, images = [], 0
+    for message in messages:
+        content = message.get("content")
+        for part in ([{"type": "text", "text": content}] if isinstance(content, str) else content or []):
+            if part.get("type") == "image_url":
+                images += 1
+            else:
+                texts.append(str(part.get("text", "")))
+    prompt = "\n".join(texts)
+    schema = enum_schema(prompt)
+
+    if "quality_score" in prompt:
+        answer = translation_answer()
+    elif "座位排数" in prompt:
+        answer = coarse_answer()
+    elif "高分辨率局部图" in prompt:
+        answer = fine_answer(schema, prompt)
+    elif "是否有中央扶手箱" in prompt:
+        answer = cabin_answer(schema)
+        if images > 1:
+            answer = [dict(cabin_answer(schema), 图片编号=i + 1) for i in range(images)]
+    else:
+        return FALLBACK_TEXT
+
+    text = json.dumps(answer, ensure_ascii=False)
+    if random.random() < invalid_rate:
+        if random.random() < 0.5:
+            return PROSE_PREFIX + text
+        return text.replace('"是否有中央扶手箱": "是"', '"是否有中央扶手箱": "不确定"').replace(
+            '"quality_score": ', '"quality_score": 1')
+    return text if json_mode else "```json\n" + text + "\n```"
+
+
+def estimate_usage(body: dict, content: str) -> dict:
+    """粗略估算 usage：文本按 2 字符 / token，每张图片按 258 tokens"""
+    raw = json.dumps(body.get("messages", []), ensure_ascii=False)
+    images = raw.count('"image_url"')
+    prompt_tokens = sum(len(part) for part in raw.split("data:image")[::2]) // 2 + 258 * images
+    completion_tokens = max(1, len(content) // 2)
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens}
+
+
+def build_app(args) -> web.Application:
+    state = MockState()
+
+    def sample_latency() -> float:
+        latency = args.latency_median * math.exp(args.latency_sigma * random.gauss(0, 1))
+        if random.random() < args.tail_prob:
+            latency *= args.tail_factor
+        return latency
+
+    async def completions(request: web.Request):
+        start = time.monotonic()
+        body = await request.json()
+        state.in_flight += 1
+        state.peak_in_flight = max(state.peak_in_flight, state.in_flight)
+        status = 200
+        try:
+            if args.capacity and state.in_flight > args.capacity:
+                status = 429
+                return web.Response(status=429, text="server at capacity",
+                                    headers={"Retry-After": str(args.retry_after)})
+            r = random.random()
+            if r < args.error_429:
+                status = 429
+                await asyncio.sleep(0.05)
+                return web.Response(status=429, text="rate limited", headers={"Retry-After": str(args.retry_after)})
+            if r < args.error_429 + args.error_5xx:
+                status = random.choice([500, 502, 503])
+                await asyncio.sleep(0.05)
+                return web.Response(status=status, text="upstream error")
+
+            json_mode = (body.get("response_format") or {}).get("type") == "json_object"
+            content = make_answer(body.get("messages", []), args.invalid_rate, json_mode)
+            usage = estimate_usage(body, content)
+            latency = sample_latency()
+            model = body.get("model", "mock")
+            if not body.get("stream"):
+                await asyncio.sleep(latency)
+                return web.json_response({"id": "mock", "object": "chat.completion", "model": model,
+                                          "choices": [{"index": 0, "finish_reason": "stop",
+                                                       "message": {"role": "assistant", "content": content}}],
+                                          "usage": usage})
+            return await stream_response(request, body, content, usage, latency, model)
+        except (ConnectionResetError, asyncio.CancelledError):
+            state.disconnects += 1
+            status = 499
+            raise
+        finally:
+            state.in_flight -= 1
+            state.status[status] += 1
+            state.latency.add(time.monotonic() - start)
+
+    async def stream_response(request, body, content, usage, latency, model):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        chunks = [content[i:i + args.chunk_chars] for i in range(0, len(content), args.chunk_chars)] or [""]
+        await asyncio.sleep(latency * args.ttft_ratio)
+        interval = latency * (1 - args.ttft_ratio) / len(chunks)
+        for i, chunk in enumerate(chunks):
+            if i:
+                await asyncio.sleep(interval)
+            delta = {"content": chunk} if i else {"role": "assistant", "content": chunk}
+            event = {"id": "mock", "object": "chat.completion.chunk", "model": model,
+                     "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+            await response.write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+        final = {"id": "mock", "object": "chat.completion.chunk", "model": model,
+                 "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+        await response.write(f"data: {json.dumps(final)}\n\n".encode("utf-8"))
+        if (body.get("stream_options") or {}).get("include_usage"):
+            await response.write(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode("utf-8"))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def stats(request):
+        return web.json_response(state.summary())
+
+    async def reset(request):
+        state.reset()
+        return web.json_response({"ok": True})
+
+    app = web.Application(client_max_size=256 * 1024 * 1024)
+    app.router.add_post("/v1/chat/completions", completions)
+    app.router.add_get("/stats", stats)
+    app.router.add_post("/reset", reset)
+    return app
+
+
+def build_parser(add_help: bool = True) -> argparse.ArgumentParser:
+    """add_help=False 时可作为压测脚本的 parents 复用这些参数"""
+    parser = argparse.ArgumentParser(description='本地 OpenAI 兼容的假视觉模型服务', add_help=add_help)
+    parser.add_argument('--host', default='127.0.0.1', help='监听地址')
+    parser.add_argument('--port', type=int, default=18080, help='监听端口')
+    parser.add_argument('--latency-median', type=float, default=1.5, help='耗时中位数(秒)')
+    parser.add_argument('--latency-sigma', type=float, default=0.4, help='对数正态分布的 sigma')
+    parser.add_argument('--tail-prob', type=float, default=0.02, help='长尾请求的比例')
+    parser.add_argument('--tail-factor', type=float, default=5.0, help='长尾请求的耗时倍数')
+    parser.add_argument('--error-429', type=float, default=0.0, help='返回 429 的比例')
+    parser.add_argument('--error-5xx', type=float, default=0.0, help='返回 500/502/503 的比例')
+    parser.add_argument('--retry-after', type=float, default=1.0, help='429 响应的 Retry-After 秒数')
+    parser.add_argument('--capacity', type=int, default=0, help='服务端同时处理的请求数上限,超出时返回 429;0 表示不限')
+    parser.add_argument('--invalid-rate', type=float, default=0.0, help='故意返回无效回答(前置解释文字或越界取值)的比例')
+    parser.add_argument('--ttft-ratio', type=float, default=0.3, help='流式响应首块到达时间占总耗时的比例')
+    parser.add_argument('--chunk-chars', type=int, default=8, help='流式响应每块的字符数')
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    print(f"假模型服务: http://{args.host}:{args.port}/v1", flush=True)
+    web.run_app(build_app(args), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
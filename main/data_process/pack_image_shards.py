@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+将语料引用的图片打包为分片文件
+读取一个或多个 .jsonl 语料的 image_path，去重后按指定参数缩放编码，写入 mmap 可读的分片目录。
+
+用法:
+    python main/data_process/pack_image_shards.py -c my_corpus/part1.jsonl -o shards/part1
+    IMAGE_SHARD_DIR=shards/part1 python main/agent/gene_answer.py ...
+"""
+import os
+import sys
+import json
+import argparse
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from image_codec import encode_image
+from image_shard import ShardWriter, encode_variant
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def collect_image_paths(corpus_files, image_key: str = "image_path"):
+    """按出现顺序收集去重后的图片路径"""
+    paths = []
+    seen = set()
+    for corpus_path in corpus_files:
+        with open(corpus_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                image_path = json.loads(line).get(image_key, "")
+                if image_path and image_path not in seen:
+                    seen.add(image_path)
+                    paths.append(image_path)
+    return paths
+
+
+def encode_one(image_path: str, max_size: tuple, quality: int, fast_resize: bool):
+    try:
+        return image_path, encode_image(image_path, max_size=max_size, quality=quality, fast_resize=fast_resize)
+    except Exception as e:
+        logger.error(f"编码失败 {image_path}: {e}")
+        return image_path, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='将语料图片预编码并打包为分片')
+    parser.add_argument('-c', '--corpus', nargs='+', required=True, help='.jsonl 语料文件')
+    parser.add_argument('-o', '--output-dir', required=True, help='分片输出目录')
+    parser.add_argument('-s', '--max-size', type=int, nargs=2, default=[2400, 1600], help='最大尺寸 宽 高')
+    parser.add_argument('-q', '--quality', type=int, default=85, help='JPEG 质量')
+    parser.add_argument('--fast-resize', action='store_true', help='使用 JPEG draft 快速缩放')
+    parser.add_argument('--shard-mb', type=int, default=1024, help='单个分片最大大小(MB)')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='编码进程数')
+    args = parser.parse_args()
+
+    max_size = tuple(args.max_size)
+    paths = collect_image_paths(args.corpus)
+    missing = [p for p in paths if not os.path.exists(p)]
+    for p in missing:
+        logger.warning(f"图片不存在,跳过: {p}")
+    paths = [p for p in paths if os.path.exists(p)]
+    logger.info(f"共 {len(paths)} 张图片待打包")
+
+    start_time = time.time()
+    writer = ShardWriter(args.output_dir, encode_variant(max_size, args.quality, args.fast_resize),
+                         shard_bytes=args.shard_mb * 1024 * 1024)
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        jobs = pool.map(encode_one, paths, [max_size] * len(paths), [args.quality] * len(paths),
+                        [args.fast_resize] * len(paths), chunksize=4)
+        for image_path, encoded in jobs:
+            if encoded is not None:
+                writer.add(image_path, encoded.encode("ascii"))
+    writer.close()
+    logger.info(f"打包完成,用时 {time.time() - start_time:.2f} 秒。")
+
+
+if __name__ == "__main__":
+    main()
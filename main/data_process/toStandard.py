@@ -57,7 +57,7 @@ def fill_standard_input(data, standard_template):
     tag_map = {tag['tag_key']: tag for tag in tag_list}
 
     # --- 1. 填充全局顶层信息 ---
-    tag_map['是否抛弃']['value'] = '可用'
+    tag_map['是否抛弃']['value'] = '抛弃' if data.get('是否抛弃') == '抛弃' else '可用'  # 本地预筛判定不可用时为抛弃
     tag_map['车内人数']['value'] = data.get('人', {}).get('人数', '0')
     tag_map['车内物品数']['value'] = data.get('物品', {}).get('物品数', '0')
     tag_map['车内宠物数']['value'] = data.get('宠物', {}).get('宠物数', '0')
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+多后端负载均衡
+LLMClient 可持有一组等价的后端（base_url, key, 模型别名），每次请求（含重试与对冲）选择当前得分最低的后端：
+    得分 = 近期耗时 × (1 + 在途请求数) × (1 + 4 × 近期错误率) + 限速暂停剩余秒数
+- 近期耗时为成功请求耗时的指数滑动平均，尚无样本的后端按 initial_latency 计；
+- 近期错误率为暂时性失败（超时、连接错误、408/429/5xx）的指数滑动平均，并随距上次请求的时间衰减，
+  被冷落的后端会逐渐重新获得流量；
+- 每个后端有独立的并发上限、熔断器与限速器，一个变慢或被限流的 key 只会让流量转向其他后端，不会拖慢整个语料运行。
+所有后端都不可用（并发已满或熔断中）时等待，等待超过 max_wait 秒抛出 CircuitOpenError。
+
+后端列表通过环境变量 LLM_BACKENDS 或命令行 --backends 配置（json 字符串或 json 文件路径），例如:
+    [{"name": "one-api-a", "base_url": "https://one-api.modelbest.co/v1", "api_key_env": "API_KEY", "concurrency": 16},
+     {"name": "one-api-b", "base_url": "https://one-api.modelbest.co/v1", "api_key_env": "API_KEY_B", "concurrency": 8},
+     {"name": "ark", "base_url": "https://ark.cn-beijing.volces.com/api/v3", "api_key_env": "ARK_API_KEY",
+      "model": "doubao-seed-1-6-vision-250815", "concurrency": 8, "rps": 2}]
+model 为该后端使用的模型名（别名），省略时沿用请求中的模型名；省略 api_key / api_key_env 时使用客户端的 key。
+rps / max_rps / min_rps 为该后端限速器的初始参数（见 rate_limiter.py）。
+"""
+import os
+import json
+import math
+import time
+import asyncio
+import logging
+from typing import List, Optional, Tuple
+
+from rate_limiter import AIMDRateLimiter, configure_rate_limit, get_rate_limiter
+from resilience import CircuitBreaker, CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+LIMIT_KEYS = ("rps", "min_rps", "max_rps")
+
+
+class Backend:
+    def __init__(self, name: str, base_url: str, api_key: str, model: Optional[str] = None,
+                 concurrency: Optional[int] = None, limits: Optional[dict] = None):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.model = model
+        self.concurrency = concurrency
+        self.limits = {k: v for k, v in (limits or {}).items() if v is not None}
+        self.breaker: Optional[CircuitBreaker] = None
+        self.latency: Optional[float] = None  # 成功请求耗时的滑动平均（秒）
+        self.error_rate = 0.0
+        self.last_update = time.monotonic()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self._limiters = {}
+
+    @property
+    def label(self) -> str:
+        return self.name or self.base_url
+
+    def headers(self) -> dict:
+        return {"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json"}
+
+    def rate_limiter(self, model: str, requested: Optional[str] = None) -> AIMDRateLimiter:
+        """
+        单后端时与原来一样按模型共享限速器；多后端时按 模型@后端 各自限速。
+        requested 为请求中的模型名（后端使用别名时与 model 不同），命令行为它给出的 --rps 等参数作为默认值，
+        后端自身配置的 rps / min_rps / max_rps 优先。
+        """
+        limiter = self._limiters.get(model)
+        if limiter is None:
+            key = f"{model}@{self.name}" if self.name else model
+            if self.limits:
+                configure_rate_limit(key, **self.limits)
+            limiter = self._limiters[model] = get_rate_limiter(key, parent=requested or model)
+        return limiter
+
+    def recent_error_rate(self, now: float, decay: float) -> float:
+        return self.error_rate * math.exp(-(now - self.last_update) / decay)
+
+    def describe(self) -> str:
+        latency = f"{self.latency:.2f}s" if self.latency is not None else "-"
+        cap = self.concurrency or "不限"
+        opens = self.breaker.opens if self.breaker else 0
+        return (f"[后端 {self.label}] 请求 {self.requests} 次,暂时性失败 {self.errors} 次,近期耗时 {latency},"
+                f"近期错误率 {self.error_rate:.2f},峰值在途 {self.peak_in_flight}/{cap},熔断 {opens} 次")
+
+
+class BackendPool:
+    def __init__(self, backends: List[Backend], breaker_failures: int = 5, breaker_reset: float = 30.0,
+                 latency_alpha: float = 0.2, error_alpha: float = 0.1, error_decay: float = 60.0,
+                 initial_latency: float = 1.0, max_wait: float = 900.0):
+        if not backends:
+            raise ValueError("后端列表为空")
+        self.backends = backends
+        self.latency_alpha = latency_alpha
+        self.error_alpha = error_alpha
+        self.error_decay = error_decay
+        self.initial_latency = initial_latency
+        self.max_wait = max_wait
+        for backend in backends:
+            if breaker_failures > 0:
+                backend.breaker = CircuitBreaker(backend.label, breaker_failures, breaker_reset, max_wait=max_wait)
+        self._changed: Optional[asyncio.Event] = None
+
+    def _available(self, backend: Backend, now: float) -> bool:
+        if backend.concurrency and backend.in_flight >= backend.concurrency:
+            return False
+        breaker = backend.breaker
+        if breaker is None or breaker.state == "closed":
+            return True
+        return breaker.state == "open" and now >= breaker.open_until
+
+    def score(self, backend: Backend, now: float) -> float:
+        latency = backend.latency if backend.latency is not None else self.initial_latency
+        error_rate = backend.recent_error_rate(now, self.error_decay)
+        score = latency * (1 + backend.in_flight) * (1 + 4 * error_rate)
+        for limiter in backend._limiters.values():
+            score += max(0.0, limiter.paused_until - now)
+        return score
+
+    def _pick(self) -> Optional[Tuple[Backend, bool]]:
+        now = time.monotonic()
+        candidates = [b for b in self.backends if self._available(b, now)]
+        if not candidates:
+            return None
+        backend = min(candidates, key=lambda b: self.score(b, now))
+        is_probe = bool(backend.breaker.try_acquire()) if backend.breaker else False
+        backend.in_flight += 1
+        backend.peak_in_flight = max(backend.peak_in_flight, backend.in_flight)
+        backend.requests += 1
+        return backend, is_probe
+
+    def _next_wakeup(self, now: float) -> Optional[float]:
+        """最早到期的熔断时间；并发已满的后端在 release 时唤醒等待者"""
+        times = [b.breaker.open_until for b in self.backends
+                 if b.breaker is not None and b.breaker.state == "open" and b.breaker.open_until > now]
+        return min(times) if times else None
+
+    async def acquire(self) -> Tuple[Backend, bool]:
+        """
+        选择一个后端并占用其并发名额。返回 (backend, is_probe)，is_probe 为 True 表示本次请求是该后端熔断后的探测请求。
+        结束后须调用 release()。
+        """
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            picked = self._pick()
+            if picked is not None:
+                return picked
+            now = time.monotonic()
+            if now >= deadline:
+                raise CircuitOpenError(f"所有后端均不可用,等待超过 {self.max_wait:.0f} 秒")
+            wakeup = self._next_wakeup(now)
+            timeout = min(deadline, wakeup) - now if wakeup is not None else deadline - now
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def release(self, backend: Backend, ok: Optional[bool], latency: Optional[float] = None):
+        """
+        ok 为 False 表示暂时性失败，True 表示端点可用（200 与其余 4xx），None 表示请求被取消、不计入统计；
+        latency 为成功请求的耗时。
+        """
+        backend.in_flight -= 1
+        if ok is not None:
+            now = time.monotonic()
+            backend.error_rate = backend.recent_error_rate(now, self.error_decay)
+            backend.error_rate += self.error_alpha * ((0.0 if ok else 1.0) - backend.error_rate)
+            backend.last_update = now
+            if not ok:
+                backend.errors += 1
+        if latency is not None:
+            if backend.latency is None:
+                backend.latency = latency
+            else:
+                backend.latency += self.latency_alpha * (latency - backend.latency)
+        if self._changed is not None:
+            self._changed.set()
+
+    @property
+    def breaker_opens(self) -> int:
+        return sum(b.breaker.opens for b in self.backends if b.breaker is not None)
+
+    def describe(self) -> List[str]:
+        return [backend.describe() for backend in self.backends]
+
+
+def load_backends(spec: Optional[str] = None, api_key: str = "") -> List[Backend]:
+    """
+    解析后端列表：spec 为 json 字符串或 json 文件路径，省略时读取环境变量 LLM_BACKENDS；未配置时返回空列表。
+    api_key 为未单独指定 key 的后端使用的默认 key。
+    """
+    raw = spec if spec is not None else os.getenv("LLM_BACKENDS", "")
+    if not raw:
+        return []
+    try:
+        if os.path.exists(raw):
+            with open(raw, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        else:
+            entries = json.loads(raw)
+    except (OSError, json.JSONDecodeError) as e:
+        raise ValueError(f"后端列表解析失败: {e}") from e
+
+    backends = []
+    for i, entry in enumerate(entries):
+        if "base_url" not in entry:
+            raise ValueError(f"第 {i + 1} 个后端缺少 base_url")
+        key = entry.get("api_key") or (os.getenv(entry["api_key_env"], "") if entry.get("api_key_env") else api_key)
+        if not key:
+            raise ValueError(f"第 {i + 1} 个后端缺少 api key")
+        backends.append(Backend(
+            name=entry.get("name") or f"backend{i + 1}",
+            base_url=entry["base_url"],
+            api_key=key,
+            model=entry.get("model"),
+            concurrency=entry.get("concurrency"),
+            limits={k: entry.get(k) for k in LIMIT_KEYS},
+        ))
+    return backends
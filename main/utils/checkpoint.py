@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+语料批处理的断点续跑
+输出 jsonl 逐行追加并立即 flush（每条记录一次 write，崩溃时至多留下最后一行不完整的记录），
+重启时扫描已有输出，按记录键判断哪些记录已经完成，只处理剩余部分。
+
+记录键：输入记录本身（去掉脚本写入的结果字段 result_fields）的哈希。语料中完全相同的记录（如同一图片重复三次做多数投票）
+按出现次数区分：已有输出中某键完成了 d 条，则输入中该键的前 d 次出现视为已完成。
+
+模式：
+    fresh   覆盖输出文件，从头处理（默认，与原行为一致）
+    resume  跳过已完成且结果不是 {"error": ...} 的记录，处理其余记录（含出错记录）
+    errors  只重跑已有输出中结果为 {"error": ...} 的记录
+resume / errors 模式会先把将要重跑的出错行与不完整的行从输出中去掉（写临时文件后原子替换），再追加新结果，
+因此续跑后的输出行顺序与输入不同。
+
+采样序号：请求内容相同（sample_fields 取值相同，省略时按记录键）的记录按在输入中的出现次数编号 0, 1, 2...，
+跳过的记录同样计数，因此续跑 / 只重跑出错记录时各记录的序号与完整运行一致。
+脚本以 sample_index(row) 作为响应缓存的采样序号（见 response_cache.py），续跑时同一图片的多次采样不会复用彼此的回答。
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_MODES = ("fresh", "resume", "errors")
+
+
+def is_error_result(result) -> bool:
+    return isinstance(result, dict) and "error" in result
+
+
+def record_key(row: dict, result_fields: Sequence[str]) -> str:
+    values = {k: v for k, v in row.items() if k not in result_fields}
+    return hashlib.sha1(json.dumps(values, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class CheckpointWriter:
+    """逐行追加写出：每条记录一次 write 并 flush，至少每 fsync_interval 秒 fsync 一次"""
+    def __init__(self, path: Path, mode: str = "a", fsync_interval: float = 5.0):
+        self.f = open(path, mode, encoding="utf-8")
+        self.fsync_interval = fsync_interval
+        self._last_sync = time.monotonic()
+
+    def write(self, line: str):
+        self.f.write(line)
+        self.f.flush()
+        now = time.monotonic()
+        if now - self._last_sync >= self.fsync_interval:
+            os.fsync(self.f.fileno())
+            self._last_sync = now
+
+    def close(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class RunCheckpoint:
+    def __init__(self, output_path: Path, result_fields: Sequence[str], mode: str = "fresh",
+                 sample_fields: Optional[Sequence[str]] = None):
+        """
+        result_fields 为脚本写入输出的字段，第一个为评估结果（据此判断是否出错）；
+        sample_fields 为决定请求内容的输入字段（如 source_text、image_path），用于计算采样序号。
+        """
+        if mode not in CHECKPOINT_MODES:
+            raise ValueError(f"未知的续跑模式: {mode}")
+        self.output_path = Path(output_path)
+        self.result_fields = tuple(result_fields)
+        self.mode = mode
+        self.done = Counter()  # 各键已完成的记录数
+        self.errors = Counter()  # 各键出错的记录数
+        self.skipped = 0
+        self.queued = 0
+        self.sample_fields = tuple(sample_fields) if sample_fields else None
+        self._seen = Counter()
+        self._samples = Counter()
+        self._sample_index: Dict[int, int] = {}  # id(已产出的记录) -> 采样序号
+        if mode != "fresh":
+            self._scan()
+
+    def _scan(self):
+        """扫描已有输出；去掉出错行与不完整的行后原子替换原文件"""
+        if not self.output_path.exists():
+            return
+        kept, dropped = [], 0
+        with open(self.output_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError:
+                    dropped += 1  # 崩溃时写了一半的行
+                    continue
+                key = record_key(row, self.result_fields)
+                if is_error_result(row.get(self.result_fields[0])):
+                    self.errors[key] += 1
+                    dropped += 1
+                    continue
+                self.done[key] += 1
+                kept.append(line if line.endswith("\n") else line + "\n")
+
+        if dropped:
+            tmp_path = self.output_path.with_name(self.output_path.name + ".tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.writelines(kept)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.output_path)
+        logger.info(f"断点续跑({self.mode}): {self.output_path.name} 已完成 {sum(self.done.values())} 条，"
+                    f"出错 {sum(self.errors.values())} 条，去除出错/不完整行 {dropped} 行")
+
+    def pending(self, rows: Iterable[dict]) -> Iterator[dict]:
+        """过滤输入记录，只产出需要处理的记录；所有记录（含跳过的）都计入采样序号"""
+        for row in rows:
+            sample = self._sample_key(row)
+            sample_index = self._samples[sample]
+            self._samples[sample] += 1
+            if self.mode == "fresh":
+                todo = True
+            else:
+                key = record_key(row, self.result_fields)
+                index = self._seen[key]
+                self._seen[key] += 1
+                done = self.done[key]
+                if self.mode == "resume":
+                    todo = index >= done
+                else:
+                    todo = done <= index < done + self.errors[key]
+            if todo:
+                self.queued += 1
+                self._sample_index[id(row)] = sample_index
+                yield row
+            else:
+                self.skipped += 1
+
+    def _sample_key(self, row: dict) -> str:
+        if self.sample_fields is None:
+            return record_key(row, self.result_fields)
+        values = [row.get(field) for field in self.sample_fields]
+        return json.dumps(values, ensure_ascii=False, default=str)
+
+    def sample_index(self, row: dict) -> Optional[int]:
+        """pending() 产出的记录在请求内容相同的记录中的出现序号"""
+        return self._sample_index.get(id(row))
+
+    def release(self, row: dict):
+        """记录写出后调用，释放其采样序号"""
+        self._sample_index.pop(id(row), None)
+
+    def open(self) -> CheckpointWriter:
+        return CheckpointWriter(self.output_path, "w" if self.mode == "fresh" else "a")
+
+    def summary(self) -> str:
+        return f"断点续跑({self.mode}): 跳过 {self.skipped} 条，处理 {self.queued} 条"
@@ -1,9 +1,8 @@
 import streamlit as st
 from openai import OpenAI
 import time
-import base64
-from io import BytesIO
 from PIL import Image
+from image_codec import encode_data_url, IMAGE_FORMATS, QUALITY_PRESETS
 
 # --- 1. 页面和模型配置 ---
 
@@ -106,13 +105,9 @@ if "uploaded_image" not in st.session_state:
 
 # --- 3. 辅助函数 ---
 
-def image_to_base64(image):
-    """将图片转换为base64编码"""
-    buffered = BytesIO()
-    # 确保图片是RGB模式，以兼容JPG等格式
-    image.convert("RGB").save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode()
-    return img_str
+def image_to_data_url(image, image_format="JPEG", max_dim=2400, quality=85):
+    """将图片压缩缩放后转换为 data URL（共享编码模块，默认 JPEG，避免无损 PNG 的体积膨胀）"""
+    return encode_data_url(image, fmt=image_format, max_dim=max_dim, quality=quality)
 
 
 # --- 4. 侧边栏UI ---
@@ -151,6 +146,12 @@ with st.sidebar:
     temperature = st.slider("Temperature", min_value=0.0, max_value=2.0, value=0.7, step=0.1)
     max_tokens = st.slider("最大输出长度", min_value=100, max_value=4000, value=1000, step=100)
 
+    # 图片编码设置
+    st.header("图片设置")
+    image_format = st.selectbox("图片格式", [f for f in IMAGE_FORMATS if f != "PNG"])
+    quality_preset = st.selectbox("压缩质量", list(QUALITY_PRESETS), index=1)
+    max_dim = st.slider("最大边长(像素)", min_value=512, max_value=4096, value=2400, step=128)
+
     # 清空对话
     if st.button("清空对话历史"):
         st.session_state.messages = []
@@ -203,8 +204,7 @@ if user_input:
     # 如果有图片，构建多模态消息
     if st.session_state.uploaded_image is not None:
         image = st.session_state.uploaded_image
-        image_base64 = image_to_base64(image)
-        image_url = f"data:image/png;base64,{image_base64}"
+        image_url = image_to_data_url(image, image_format, max_dim, QUALITY_PRESETS[quality_preset])
         
         user_message["content"] = [ # type: ignore
             {"type": "text", "text": user_input},
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+连续帧近重复抑制
+同一次采集的 DJI 连拍帧大量近似相同。按输入顺序计算感知哈希（pHash），
+与当前簇代表帧的汉明距离不超过阈值的相邻帧归入同一簇，只把代表帧发送给模型，结果再分发给簇内其他帧。
+簇总是输入中连续的一段，因此按"代表帧 + 成员"写出即可保持原有顺序。
+同一簇内的图片路径互不相同：语料中同一图片有意重复出现（如重复三次做多数投票）时每次都单独请求，
+近重复抑制只合并不同的相邻帧。采样温度 > 0 时各行本应是独立采样，调用方不应启用近重复抑制。
+"""
+import io
+import os
+import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Union
+
+import numpy as np
+from PIL import Image
+
+from image_codec import apply_draft
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HASH_THRESHOLD = 6  # 64 位 pHash 的汉明距离
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)[:, None]
+    x = np.arange(n)[None, :]
+    return np.cos(np.pi * (2 * x + 1) * k / (2 * n))
+
+
+_DCT_SIZE = 32
+_DCT = _dct_matrix(_DCT_SIZE)
+
+
+def image_phash(src: Union[str, bytes], hash_size: int = 8) -> Optional[int]:
+    """
+    计算 pHash：灰度缩放到 32x32，二维 DCT 取左上 hash_size x hash_size 低频系数，与中位数比较得到位串。
+    src 为路径或图片字节，读取失败返回 None。
+    """
+    try:
+        with Image.open(io.BytesIO(src) if isinstance(src, bytes) else src) as img:
+            apply_draft(img, (_DCT_SIZE * 4, _DCT_SIZE * 4))
+            gray = np.asarray(img.convert("L").resize((_DCT_SIZE, _DCT_SIZE), Image.Resampling.BILINEAR),
+                              dtype=np.float64)
+    except (OSError, ValueError) as e:
+        logger.warning(f"感知哈希计算失败: {e}")
+        return None
+    low = (_DCT @ gray @ _DCT.T)[:hash_size, :hash_size].flatten()
+    bits = low > np.median(low[1:])  # 直流分量不参与中位数
+    return int("".join("1" if b else "0" for b in bits), 2)
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class FrameDeduplicator:
+    """
+    representatives() 接收行的迭代器，产出每簇的代表行；簇内其余行通过 pop_members(代表行) 取回。
+    threshold 为归入同簇的最大汉明距离，chunk 为每次并行计算哈希的行数。
+    """
+    def __init__(self, threshold: int = DEFAULT_HASH_THRESHOLD, image_key: str = "image_path",
+                 chunk: int = 32, workers: int = 4):
+        self.threshold = threshold
+        self.image_key = image_key
+        self.chunk = chunk
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.members: Dict[int, List[dict]] = {}
+        self.stats = Counter()
+
+    def _hash_row(self, row: dict) -> Optional[int]:
+        image_path = row.get(self.image_key, "")
+        if not image_path or not os.path.exists(image_path):
+            return None
+        return image_phash(image_path)
+
+    def _hashed(self, rows: Iterable[dict]) -> Iterator[tuple]:
+        """按 chunk 分块并行计算哈希，保持输入顺序"""
+        buffer = []
+        for row in rows:
+            buffer.append(row)
+            if len(buffer) >= self.chunk:
+                yield from zip(buffer, self.pool.map(self._hash_row, buffer))
+                buffer = []
+        if buffer:
+            yield from zip(buffer, self.pool.map(self._hash_row, buffer))
+
+    def representatives(self, rows: Iterable[dict]) -> Iterator[dict]:
+        rep, rep_hash, members, paths = None, None, [], set()
+        for row, h in self._hashed(rows):
+            self.stats["images"] += 1
+            path = row.get(self.image_key, "")
+            if (rep is not None and h is not None and rep_hash is not None and path not in paths
+                    and hamming(h, rep_hash) <= self.threshold):
+                members.append(row)
+                paths.add(path)
+                continue
+            if rep is not None:
+                self.members[id(rep)] = members
+                yield rep
+            rep, rep_hash, members, paths = row, h, [], {path}
+            self.stats["clusters"] += 1
+        if rep is not None:
+            self.members[id(rep)] = members
+            yield rep
+
+    def pop_members(self, rep: dict) -> List[dict]:
+        return self.members.pop(id(rep), [])
+
+    def summary(self) -> str:
+        s = self.stats
+        saved = s["images"] - s["clusters"]
+        rate = saved / s["images"] if s["images"] else 0.0
+        return f"近重复抑制: {s['images']} 帧归为 {s['clusters']} 簇,节省 API 调用 {saved} 次 ({rate:.1%}),阈值 {self.threshold}"
+
+    def close(self):
+        self.pool.shutdown()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+对冲请求（hedged requests）
+请求耗时超过最近成功请求耗时的第 percentile 百分位时，再发一个相同的请求，先成功返回者胜出，另一个被取消。
+- 百分位在最近 window 个成功请求上实时计算，样本不足 min_samples 时不对冲；
+- 对冲请求数不超过主请求数的 max_extra（额外负载上限），对冲延迟不低于 min_delay 秒；
+- 统计单次请求耗时（每个完成的请求，含被对冲的）与对冲后端到端耗时的 p50/p95/p99 作对比。
+percentile 为 None 时只统计耗时、不对冲，可作为同一语料上的对照基线。
+注意：被取消的慢请求不会计入单次请求耗时，因此对冲时“单次”分布的尾部略有低估，准确基线以不对冲的运行为准。
+"""
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyTracker:
+    """最近 window 个样本的滑动百分位"""
+    def __init__(self, window: int = 500):
+        self.samples: Deque[float] = deque(maxlen=window)
+        self.count = 0
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+        self.count += 1
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, max(0, int(round(q / 100 * (len(ordered) - 1)))))
+        return ordered[index]
+
+    def percentiles(self) -> Dict[str, Optional[float]]:
+        return {f"p{q}": self.percentile(q) for q in (50, 95, 99)}
+
+
+def format_percentiles(tracker: LatencyTracker) -> str:
+    values = tracker.percentiles()
+    return " / ".join(f"{k} {v:.2f}s" if v is not None else f"{k} -" for k, v in values.items())
+
+
+class Hedger:
+    def __init__(self, percentile: Optional[float] = 95.0, max_extra: float = 0.1, min_samples: int = 20,
+                 min_delay: float = 0.5, window: int = 500):
+        self.percentile = percentile
+        self.max_extra = max_extra
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.attempt_latency = LatencyTracker(window)  # 单次请求耗时
+        self.effective_latency = LatencyTracker(window * 4)  # 对冲后端到端耗时
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.skipped = 0  # 超过百分位但受额外负载上限限制未对冲的次数
+
+    def hedge_delay(self) -> Optional[float]:
+        if self.percentile is None or len(self.attempt_latency.samples) < self.min_samples:
+            return None
+        return max(self.min_delay, self.attempt_latency.percentile(self.percentile))  # type: ignore
+
+    async def _timed(self, call: Callable[[], Awaitable[Tuple]]) -> Tuple:
+        start = time.perf_counter()
+        result = await call()
+        if result[0] == 200:
+            self.attempt_latency.add(time.perf_counter() - start)
+        return result
+
+    async def run(self, call: Callable[[], Awaitable[Tuple]]) -> Tuple:
+        """call() 每次调用发出一个新请求并返回 (status, ...)；返回先成功的结果，都失败时返回 / 抛出最后完成者的结果"""
+        start = time.perf_counter()
+        self.requests += 1
+        delay = self.hedge_delay()
+        primary = asyncio.ensure_future(self._timed(call))
+        tasks = {primary}
+        try:
+            if delay is not None:
+                await asyncio.wait(tasks, timeout=delay)
+                if not primary.done():
+                    if self.hedged < self.max_extra * self.requests:
+                        self.hedged += 1
+                        tasks.add(asyncio.ensure_future(self._timed(call)))
+                    else:
+                        self.skipped += 1
+
+            while True:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    tasks.discard(task)
+                    failed = task.exception() is not None or task.result()[0] != 200
+                    if failed and tasks:
+                        continue  # 另一个请求仍在途,等待它的结果
+                    if not failed:
+                        self.effective_latency.add(time.perf_counter() - start)
+                        if task is not primary:
+                            self.hedge_wins += 1
+                    return task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def summary(self) -> str:
+        if self.percentile is None:
+            return f"请求耗时(未对冲): {format_percentiles(self.effective_latency)}"
+        return (f"对冲请求: {self.requests} 次请求中对冲 {self.hedged} 次(上限 {self.max_extra:.0%}),"
+                f"对冲胜出 {self.hedge_wins} 次,受上限跳过 {self.skipped} 次;"
+                f"单次请求耗时 {format_percentiles(self.attempt_latency)};"
+                f"对冲后耗时 {format_percentiles(self.effective_latency)}")
@@ -0,0 +1,513 @@
+#!/usr/bin/env python3
+"""
+共享图像编码模块
+统一各评估脚本中的 encode_image（打开 → RGB → LANCZOS 缩放 → JPEG → Base64），
+并提供按文件内容哈希 + 编码参数寻址的持久化缓存。
+"""
+import os
+import io
+import asyncio
+import base64
+import hashlib
+import logging
+import math
+import sqlite3
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterator, Iterable, Iterator, Optional, Tuple, Union
+from PIL import Image
+from image_shard import encode_variant, get_default_shard_reader
+
+logger = logging.getLogger(__name__)
+
+# ===== 默认配置 =====
+DEFAULT_MAX_SIZE = (2400, 1600)
+DEFAULT_QUALITY = 85
+DEFAULT_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", ".cache/image_codec")
+DEFAULT_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_MB", "1024")) * 1024 * 1024
+DEFAULT_PASSTHROUGH_MAX_BYTES = 4 * 1024 * 1024
+EXIF_ORIENTATION = 0x0112
+
+# 支持的输出格式及其 MIME 类型
+IMAGE_FORMATS = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+# 有损格式的质量预设（尚未在车内样例上校准，见 main/bench/codec_formats.md）
+QUALITY_PRESETS = {"高清": 92, "标准": 85, "省流": 70}
+
+# 各编码路径的计数：shard（分片包）、passthrough（原样透传）、cache_hit（缓存命中）、reencode（解码重编码）
+ENCODE_PATHS = Counter()
+
+
+def encode_path_stats() -> dict:
+    return dict(ENCODE_PATHS)
+
+
+class ImageCache:
+    """
+    编码结果的持久化缓存（SQLite）。
+
+    - files 表：路径 + 文件大小 + mtime → 内容哈希，文件未变化时只需一次 stat
+    - entries 表：内容哈希 + 编码参数 → Base64 结果（流式请求体为原始 JPEG 字节，键带 :raw），按最近访问时间做 LRU 淘汰
+
+    每个线程使用各自的连接，可在 asyncio.to_thread 中调用。
+    """
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.db_path = os.path.join(cache_dir, "images.sqlite3")
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+
+    def _connect(self) -> sqlite3.Connection:
+        # 进程池中 fork 出的子进程不能复用父进程的连接，sqlite3 连接也不能跨线程使用
+        local = self._local
+        if getattr(local, "conn", None) is None or local.pid != os.getpid():
+            os.makedirs(self.cache_dir, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest TEXT)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, data TEXT, nbytes INTEGER, last_access REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_access ON entries(last_access)")
+            conn.commit()
+            local.conn = conn
+            local.pid = os.getpid()
+        return local.conn
+
+    def file_digest(self, image_path: str) -> str:
+        """返回文件内容哈希，size 与 mtime 未变化时直接复用上次结果"""
+        st = os.stat(image_path)
+        path = os.path.abspath(image_path)
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT digest FROM files WHERE path = ? AND size = ? AND mtime_ns = ?",
+            (path, st.st_size, st.st_mtime_ns),
+        ).fetchone()
+        if row:
+            return row[0]
+
+        with open(image_path, "rb") as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        conn.execute(
+            "INSERT OR REPLACE INTO files (path, size, mtime_ns, digest) VALUES (?, ?, ?, ?)",
+            (path, st.st_size, st.st_mtime_ns, digest),
+        )
+        conn.commit()
+        return digest
+
+    def get(self, key: str) -> Optional[str]:
+        return self.get_first(key)
+
+    def get_first(self, *keys: str) -> Union[str, bytes, None]:
+        """按顺序查找，返回第一个命中的结果（只计一次命中或未命中）"""
+        conn = self._connect()
+        for key in keys:
+            row = conn.execute("SELECT data FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+                conn.commit()
+                self.hits += 1
+                return row[0]
+        self.misses += 1
+        return None
+
+    def put(self, key: str, data: Union[str, bytes]):
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO entries (key, data, nbytes, last_access) VALUES (?, ?, ?, ?)",
+            (key, data, len(data), time.time()),
+        )
+        conn.commit()
+        self._evict(conn)
+
+    def _evict(self, conn: sqlite3.Connection):
+        """总大小超过上限时，按最近访问时间从旧到新淘汰"""
+        total = conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = 0
+        for key, nbytes in conn.execute("SELECT key, nbytes FROM entries ORDER BY last_access ASC").fetchall():
+            if total <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= nbytes
+            evicted += 1
+        conn.commit()
+        logger.debug(f"图像缓存淘汰 {evicted} 条，当前 {total} 字节")
+
+    def stats(self) -> dict:
+        conn = self._connect()
+        count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM entries").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": count, "bytes": total}
+
+    def close(self):
+        """关闭当前线程的连接"""
+        local = self._local
+        if getattr(local, "conn", None) is not None and local.pid == os.getpid():
+            local.conn.close()
+        local.conn = None
+
+
+_default_cache = None
+
+
+def get_default_cache() -> ImageCache:
+    """进程内共享的默认缓存实例"""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = ImageCache()
+    return _default_cache
+
+
+def make_cache_key(digest: str, max_size: tuple, quality: int, fast_resize: bool = False) -> str:
+    key = f"{digest}:{max_size[0]}x{max_size[1]}:q{quality}"
+    if fast_resize:
+        key += ":fast"
+    return key
+
+
+def apply_draft(img: Image.Image, max_size: tuple) -> bool:
+    """
+    JPEG 在 DCT 域按 1/2、1/4、1/8 缩小解码，得到不小于目标尺寸的最小图像。
+    必须在 load()/convert() 之前调用；返回是否实际缩小了解码尺寸。
+    """
+    if img.format != "JPEG":
+        return False
+    scale = min(max_size[0] / img.size[0], max_size[1] / img.size[1])
+    if scale >= 1:
+        return False
+    target = (int(img.size[0] * scale + 0.5), int(img.size[1] * scale + 0.5))
+    result = img.draft("RGB", target)
+    return result is not None and result[1] != (0, 0, img.size[0], img.size[1])
+
+
+def encode_pil_image(img: Image.Image, max_size: tuple = DEFAULT_MAX_SIZE, quality: int = DEFAULT_QUALITY,
+                     fast_resize: bool = False, fmt: str = "JPEG") -> bytes:
+    """
+    将已打开的 PIL 图像缩放并压缩为 fmt 格式（默认 JPEG）的字节。
+    fast_resize=True 时先用 JPEG draft 直接解码到接近目标尺寸，再用 BILINEAR 做最后一步缩放。
+    """
+    if fast_resize:
+        apply_draft(img, max_size)
+
+    img = img.convert("RGB")  # 确保无 alpha 通道
+
+    # 如果图像大于设定尺寸则缩放
+    if img.size[0] > max_size[0] or img.size[1] > max_size[1]:
+        resample = Image.Resampling.BILINEAR if fast_resize else Image.Resampling.LANCZOS
+        img.thumbnail(max_size, resample)
+
+    buffer = io.BytesIO()
+    if fmt == "PNG":
+        img.save(buffer, format="PNG")
+    else:
+        img.save(buffer, format=fmt, quality=quality)  # 控制质量以减少体积
+    return buffer.getvalue()
+
+
+def encode_data_url(img: Image.Image, fmt: str = "JPEG", max_dim: int = max(DEFAULT_MAX_SIZE),
+                    quality: int = DEFAULT_QUALITY) -> str:
+    """将 PIL 图像编码为 data URL（用于直接放入对话消息），长边不超过 max_dim"""
+    data = encode_pil_image(img, (max_dim, max_dim), quality, fmt=fmt)
+    return f"data:{IMAGE_FORMATS[fmt]};base64,{base64.b64encode(data).decode('utf-8')}"
+
+
+# ===== 按模型计费瓦片自适应尺寸 =====
+class ImageProfile:
+    """
+    视觉模型的图像计费参数：按 tile_size 切片，每片 tokens_per_tile，另加 base_tokens。
+    plan() 在保证短边不低于 min_short_side 的前提下选择瓦片数最少的输出尺寸，
+    同一瓦片数下取最大尺寸（填满瓦片），max_tiles / token_budget 作为上限。
+    """
+    def __init__(self, name: str, tile_size: int, tokens_per_tile: int, base_tokens: int = 0,
+                 max_tiles: Optional[int] = None, token_budget: Optional[int] = None,
+                 min_short_side: int = 768, max_size: tuple = DEFAULT_MAX_SIZE):
+        self.name = name
+        self.tile_size = tile_size
+        self.tokens_per_tile = tokens_per_tile
+        self.base_tokens = base_tokens
+        self.max_tiles = max_tiles
+        self.token_budget = token_budget
+        self.min_short_side = min_short_side
+        self.max_size = max_size
+
+    def tiles(self, size: tuple) -> int:
+        return math.ceil(size[0] / self.tile_size) * math.ceil(size[1] / self.tile_size)
+
+    def tokens(self, size: tuple) -> int:
+        return self.base_tokens + self.tiles(size) * self.tokens_per_tile
+
+    def _within_limits(self, size: tuple) -> bool:
+        if self.max_tiles is not None and self.tiles(size) > self.max_tiles:
+            return False
+        return self.token_budget is None or self.tokens(size) <= self.token_budget
+
+    def plan(self, size: tuple) -> tuple:
+        """根据原图尺寸返回输出尺寸（保持宽高比，不放大）"""
+        w, h = size
+        s_max = min(1.0, self.max_size[0] / w, self.max_size[1] / h)
+        floor = min(self.min_short_side, min(w, h) * s_max)
+        s_floor = floor / min(w, h)
+
+        # 候选缩放比例：短边下限、上限，以及宽/高恰好落在瓦片边界上的比例
+        scales = {s_floor, s_max}
+        t = self.tile_size
+        scales.update(c * t / w for c in range(1, math.ceil(w * s_max / t) + 1))
+        scales.update(r * t / h for r in range(1, math.ceil(h * s_max / t) + 1))
+
+        candidates = []
+        for scale in scales:
+            if scale < s_floor or scale > s_max:
+                continue
+            dims = (max(1, int(w * scale + 1e-6)), max(1, int(h * scale + 1e-6)))
+            candidates.append((self.tiles(dims), -scale, dims))
+        if not candidates:
+            return (max(1, int(w * s_max)), max(1, int(h * s_max)))
+
+        # 短边下限优先于瓦片/预算上限：上限无法满足时仍取瓦片最少的尺寸
+        within = [c for c in candidates if self._within_limits(c[2])]
+        if not within:
+            logger.debug(f"[{self.name}] 短边 {floor:.0f} 下无法满足瓦片/预算上限，使用最少瓦片尺寸")
+        return min(within or candidates)[2]
+
+
+# 常用模型的近似计费参数
+MODEL_PROFILES = {
+    # Gemini：768x768 为一片，每片 258 tokens
+    "gemini": ImageProfile("gemini", tile_size=768, tokens_per_tile=258),
+    # GPT-4o (detail=high)：512x512 为一片，每片 170 tokens，另加 85；服务端会把短边缩到 768
+    "gpt-4o": ImageProfile("gpt-4o", tile_size=512, tokens_per_tile=170, base_tokens=85,
+                           max_tiles=16, max_size=(2048, 2048)),
+    # 豆包视觉：28x28 像素约一个 token
+    "doubao": ImageProfile("doubao", tile_size=28, tokens_per_tile=1),
+}
+
+
+def get_profile(name: str, model: str = "", **overrides) -> Optional[ImageProfile]:
+    """按名称取 profile；name 为 auto 时根据模型名推断。overrides 覆盖 min_short_side 等字段"""
+    if not name:
+        return None
+    if name == "auto":
+        name = next((key for key in MODEL_PROFILES if key in model.lower()), "")
+        if not name and model.lower().startswith("gpt-4"):
+            name = "gpt-4o"
+        if not name:
+            return None
+    base = MODEL_PROFILES[name]
+    profile = ImageProfile(**{**vars(base), **{k: v for k, v in overrides.items() if v is not None}})
+    return profile
+
+
+def shard_image_bytes(image_path: str) -> Optional[bytes]:
+    """本地文件不存在、只打包在默认分片中的图片，返回分片中的 JPEG 字节；否则返回 None"""
+    if os.path.exists(image_path):
+        return None
+    reader = get_default_shard_reader()
+    if reader is None or image_path not in reader:
+        return None
+    return reader.get_image_bytes(image_path)
+
+
+def image_source(image_path: str, data: Optional[bytes] = None):
+    """Image.open 的参数：给出分片字节时从内存读取，否则打开原图"""
+    return image_path if data is None else io.BytesIO(data)
+
+
+def estimate_image_tokens(image_path: str, profile: ImageProfile) -> int:
+    """只读取文件头，估算该图片按 profile 编码后的图像 tokens（只在分片中的图片按分片中的尺寸估算）"""
+    with Image.open(image_source(image_path, shard_image_bytes(image_path))) as img:
+        return profile.tokens(profile.plan(img.size))
+
+
+def image_available(image_path: str) -> bool:
+    """图片是否可用：已打包进默认分片，或本地文件存在"""
+    reader = get_default_shard_reader()
+    if reader is not None and image_path in reader:
+        return True
+    return os.path.exists(image_path)
+
+
+def can_passthrough(img: Image.Image, nbytes: int, max_size: tuple = DEFAULT_MAX_SIZE,
+                    max_bytes: int = DEFAULT_PASSTHROUGH_MAX_BYTES) -> bool:
+    """
+    仅凭文件头判断能否跳过重编码：RGB 基线 JPEG、尺寸不超过 max_size、
+    字节数不超过 max_bytes，且没有需要旋转的 EXIF 方向标记（重编码会丢弃该标记）。
+    """
+    if img.format != "JPEG" or img.mode != "RGB":
+        return False
+    if "progressive" in img.info or "progression" in img.info:
+        return False
+    if img.size[0] > max_size[0] or img.size[1] > max_size[1] or nbytes > max_bytes:
+        return False
+    return img.getexif().get(EXIF_ORIENTATION, 1) == 1
+
+
+def encode_image_bytes(data: bytes, max_size: tuple = DEFAULT_MAX_SIZE, quality: int = DEFAULT_QUALITY,
+                       cache: Optional[ImageCache] = None, fast_resize: bool = False,
+                       passthrough: bool = False, passthrough_max_bytes: int = DEFAULT_PASSTHROUGH_MAX_BYTES,
+                       profile: Optional[ImageProfile] = None) -> str:
+    """对内存中的图片字节做压缩与 Base64 编码（如远程下载的图片）"""
+    if profile is not None:
+        with Image.open(io.BytesIO(data)) as img:
+            max_size = profile.plan(img.size)
+
+    if passthrough:
+        with Image.open(io.BytesIO(data)) as img:
+            if can_passthrough(img, len(data), max_size, passthrough_max_bytes):
+                ENCODE_PATHS["passthrough"] += 1
+                return base64.b64encode(data).decode("utf-8")
+
+    key = None
+    if cache is not None:
+        key = make_cache_key(hashlib.sha1(data).hexdigest(), max_size, quality, fast_resize)
+        cached = cache.get(key)
+        if cached is not None:
+            ENCODE_PATHS["cache_hit"] += 1
+            return cached
+
+    with Image.open(io.BytesIO(data)) as img:
+        encoded = base64.b64encode(encode_pil_image(img, max_size, quality, fast_resize)).decode("utf-8")
+
+    if cache is not None:
+        cache.put(key, encoded)  # type: ignore
+    ENCODE_PATHS["reencode"] += 1
+    return encoded
+
+
+def _encode_image(image_path: str, max_size: tuple = DEFAULT_MAX_SIZE, quality: int = DEFAULT_QUALITY,
+                  use_cache: bool = True, cache: Optional[ImageCache] = None, fast_resize: bool = False,
+                  passthrough: bool = False, passthrough_max_bytes: int = DEFAULT_PASSTHROUGH_MAX_BYTES,
+                  profile: Optional[ImageProfile] = None) -> Tuple[str, str]:
+    """返回 (base64, 编码路径)"""
+    data = None
+    if profile is None:
+        # 分片中已有相同编码参数的结果时直接从 mmap 读取，不访问原图
+        reader = get_default_shard_reader()
+        if reader is not None and image_path in reader and reader.variant == encode_variant(max_size, quality, fast_resize):
+            return reader.get_base64(image_path), "shard"  # type: ignore
+    else:
+        # 按 profile 选出的尺寸作为本次的 max_size，缓存键与透传判断随之变化；
+        # 只在分片中的图片以分片中的 JPEG 作为原图重新缩放
+        data = shard_image_bytes(image_path)
+        with Image.open(image_source(image_path, data)) as img:
+            max_size = profile.plan(img.size)
+
+    if passthrough:
+        # Image.open 只解析文件头，不解码像素
+        with Image.open(image_source(image_path, data)) as img:
+            nbytes = len(data) if data is not None else os.path.getsize(image_path)
+            eligible = can_passthrough(img, nbytes, max_size, passthrough_max_bytes)
+        if eligible:
+            if data is not None:
+                return base64.b64encode(data).decode("utf-8"), "passthrough"
+            with open(image_path, "rb") as f:
+                return base64.b64encode(f.read()).decode("utf-8"), "passthrough"
+
+    key = None
+    if use_cache:
+        cache = cache or get_default_cache()
+        digest = hashlib.sha1(data).hexdigest() if data is not None else cache.file_digest(image_path)
+        key = make_cache_key(digest, max_size, quality, fast_resize)
+        cached = cache.get(key)
+        if cached is not None:
+            logger.debug(f"图像缓存命中: {image_path}")
+            return cached, "cache_hit"
+
+    with Image.open(image_source(image_path, data)) as img:
+        encoded = base64.b64encode(encode_pil_image(img, max_size, quality, fast_resize)).decode("utf-8")
+
+    if use_cache:
+        cache.put(key, encoded)  # type: ignore
+    return encoded, "reencode"
+
+
+def encode_image(image_path: str, max_size: tuple = DEFAULT_MAX_SIZE, quality: int = DEFAULT_QUALITY,
+                 use_cache: bool = True, cache: Optional[ImageCache] = None, fast_resize: bool = False,
+                 passthrough: bool = False, passthrough_max_bytes: int = DEFAULT_PASSTHROUGH_MAX_BYTES,
+                 profile: Optional[ImageProfile] = None) -> str:
+    """
+    更接近 GPT-4o 网页端的图像编码器：压缩图像并转为 Base64，结果按内容哈希缓存。
+    passthrough=True 时，已满足尺寸与字节预算的基线 JPEG 直接编码原始字节，不再重编码。
+    profile 给定时按模型瓦片计费选择输出尺寸，取代 max_size。
+    """
+    try:
+        encoded, path = _encode_image(image_path, max_size, quality, use_cache, cache, fast_resize,
+                                      passthrough, passthrough_max_bytes, profile)
+        ENCODE_PATHS[path] += 1
+        logger.debug(f"图像编码完成（{path}），base64 长度：{len(encoded)} 字符")
+        return encoded
+
+    except Exception as e:
+        logger.error(f"图片处理失败: {e}")
+        raise
+
+
+# ===== 进程池预编码 =====
+def _encode_worker(image_path: str, encode_kwargs: dict) -> Tuple[str, str]:
+    """进程池中执行的编码任务（模块级函数，便于 pickle），编码路径一并返回给主进程计数"""
+    return _encode_image(image_path, **encode_kwargs)
+
+
+async def pull_next(rows: Iterator, default=None):
+    """在线程中取同步迭代器的下一项，上游的文件读取与计算不阻塞事件循环"""
+    return await asyncio.to_thread(next, rows, default)
+
+
+class PreEncoder:
+    """
+    在 HTTP 阶段之前用进程池并行编码图片。
+
+    map() 以生产者/消费者方式工作：最多提前提交 lookahead 条编码任务，
+    按输入顺序逐条产出 (row, base64)，让 CPU 编码与网络请求重叠，且不阻塞事件循环。
+    上游 rows 是同步迭代器（分块读取 jsonl、断点续跑过滤、近重复哈希等），在线程中逐条拉取。
+    """
+    def __init__(self, workers: Optional[int] = None, lookahead: int = 16, **encode_kwargs):
+        self.workers = workers or os.cpu_count() or 1
+        self.lookahead = max(1, lookahead)
+        self.encode_kwargs = encode_kwargs  # 透传给 encode_image，如 max_size、quality、fast_resize
+        self.pool = ProcessPoolExecutor(max_workers=self.workers)
+
+    async def map(self, rows: Iterable[dict], image_key: str = "image_path") -> AsyncIterator[Tuple[dict, Optional[str]]]:
+        """按顺序产出 (row, base64)；路径无效或编码失败时 base64 为 None"""
+        loop = asyncio.get_running_loop()
+        pending = deque()
+        rows = iter(rows)
+        end = object()
+
+        def submit(row: dict):
+            image_path = row.get(image_key) or ""
+            future = None
+            if image_path and image_available(image_path):
+                future = loop.run_in_executor(self.pool, _encode_worker, image_path, self.encode_kwargs)
+            pending.append((row, future))
+
+        while len(pending) < self.lookahead:
+            row = await pull_next(rows, end)
+            if row is end:
+                break
+            submit(row)
+
+        while pending:
+            row, future = pending.popleft()
+            next_row = await pull_next(rows, end)
+            if next_row is not end:
+                submit(next_row)
+
+            encoded = None
+            if future is not None:
+                try:
+                    encoded, path = await future
+                    ENCODE_PATHS[path] += 1
+                except Exception as e:
+                    logger.error(f"预编码失败 {row.get(image_key)}: {e}")
+            yield row, encoded
+
+    def close(self):
+        self.pool.shutdown(wait=True)
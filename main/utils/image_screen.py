@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+本地图片预筛
+对一批图片的小尺寸缩略图做向量化统计（亮度直方图、过曝比例、拉普拉斯方差、色度），
+在调用模型前：
+- 标记过暗、过曝、模糊等不可用的帧（对应标注中的 是否抛弃=抛弃），不再发送请求；
+- 可选（night_prior=True）给出高置信度的黑夜/白天先验，可从 prompt 中去掉 是否为黑夜 一项。
+"""
+import os
+import time
+import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+import numpy as np
+from PIL import Image
+
+from image_codec import apply_draft
+
+logger = logging.getLogger(__name__)
+
+
+def load_thumbnail(image_path: str, size: int) -> Optional[np.ndarray]:
+    """读取为 size x size 的 RGB 缩略图（JPEG 先 draft 解码），失败返回 None"""
+    try:
+        with Image.open(image_path) as img:
+            apply_draft(img, (size, size))
+            thumb = img.convert("RGB").resize((size, size), Image.Resampling.BILINEAR)
+            return np.asarray(thumb, dtype=np.uint8)
+    except (OSError, ValueError) as e:
+        logger.warning(f"预筛读取失败 {image_path}: {e}")
+        return None
+
+
+class ImageScreener:
+    """
+    按批预筛图片。阈值基于 size x size 缩略图上的 0-255 亮度：
+    - 平均亮度低于 dark_luma 且暗像素占比超过 dark_ratio → 过暗；
+    - 亮度 ≥250 的像素占比超过 clip_ratio → 过曝；
+    - 拉普拉斯方差低于 blur_var → 模糊；
+    - 色度低于 gray_chroma（红外补光的灰度画面）且平均亮度低于 night_luma → 黑夜；
+      色度高于 color_chroma 且平均亮度高于 day_luma → 白天；其余交给模型判断。
+    昼夜先验默认关闭（night_prior=False，是否为黑夜 恒为 None）：偏暗的灰色内饰在白天也可能同时满足两个条件，
+    阈值在标注数据上校准前只作为可选项。
+    """
+    def __init__(self, size: int = 256, dark_luma: float = 12.0, dark_ratio: float = 0.95,
+                 clip_ratio: float = 0.6, blur_var: float = 15.0, gray_chroma: float = 3.0,
+                 night_luma: float = 35.0, color_chroma: float = 12.0, day_luma: float = 90.0,
+                 night_prior: bool = False, workers: int = 4):
+        self.size = size
+        self.dark_luma = dark_luma
+        self.dark_ratio = dark_ratio
+        self.clip_ratio = clip_ratio
+        self.blur_var = blur_var
+        self.gray_chroma = gray_chroma
+        self.night_luma = night_luma
+        self.color_chroma = color_chroma
+        self.day_luma = day_luma
+        self.night_prior = night_prior
+        self.pool = ThreadPoolExecutor(max_workers=workers)  # PIL 解码释放 GIL
+        self.stats = Counter()
+
+    def screen_batch(self, image_paths: List[str]) -> List[Optional[dict]]:
+        """
+        返回与 image_paths 等长的列表，每项为
+        {"可用": bool, "原因": str, "是否为黑夜": "是"/"否"/None, 及各项统计量}；
+        图片不在本地（如仅存在于分片中）或读取失败时为 None。
+        """
+        start = time.perf_counter()
+        thumbs = list(self.pool.map(
+            lambda p: load_thumbnail(p, self.size) if p and os.path.exists(p) else None, image_paths))
+        valid = [i for i, t in enumerate(thumbs) if t is not None]
+        results: List[Optional[dict]] = [None] * len(image_paths)
+        if valid:
+            rgb = np.stack([thumbs[i] for i in valid]).astype(np.float32)  # (N, S, S, 3)
+            r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+            luma = 0.299 * r + 0.587 * g + 0.114 * b
+
+            mean_luma = luma.mean(axis=(1, 2))
+            dark = (luma < 40).mean(axis=(1, 2))
+            clipped = (luma >= 250).mean(axis=(1, 2))
+            lap = (luma[:, :-2, 1:-1] + luma[:, 2:, 1:-1] + luma[:, 1:-1, :-2] + luma[:, 1:-1, 2:]
+                   - 4 * luma[:, 1:-1, 1:-1])
+            blur = lap.var(axis=(1, 2))
+            chroma = (np.abs(r - g) + np.abs(g - b)).mean(axis=(1, 2)) / 2
+
+            too_dark = (mean_luma < self.dark_luma) & (dark > self.dark_ratio)
+            over = clipped > self.clip_ratio
+            blurry = blur < self.blur_var
+            night = (chroma < self.gray_chroma) & (mean_luma < self.night_luma) & self.night_prior
+            day = (chroma > self.color_chroma) & (mean_luma > self.day_luma) & self.night_prior
+
+            for k, i in enumerate(valid):
+                reason = "过暗" if too_dark[k] else "过曝" if over[k] else "模糊" if blurry[k] else ""
+                results[i] = {
+                    "可用": not reason,
+                    "原因": reason,
+                    "是否为黑夜": "是" if night[k] else "否" if day[k] else None,
+                    "平均亮度": round(float(mean_luma[k]), 1),
+                    "暗像素占比": round(float(dark[k]), 3),
+                    "过曝占比": round(float(clipped[k]), 3),
+                    "拉普拉斯方差": round(float(blur[k]), 1),
+                    "色度": round(float(chroma[k]), 1),
+                }
+
+        elapsed = time.perf_counter() - start
+        skipped = sum(1 for res in results if res is not None and not res["可用"])
+        priors = sum(1 for res in results if res is not None and res["可用"] and res["是否为黑夜"] is not None)
+        self.stats["images"] += len(image_paths)
+        self.stats["screened"] += len(valid)
+        self.stats["skipped"] += skipped
+        self.stats["night_priors"] += priors
+        self.stats["ms"] += int(elapsed * 1000)
+        logger.info(f"  - 预筛 {len(valid)}/{len(image_paths)} 张,用时 {elapsed * 1000:.0f} ms,"
+                    f"跳过 {skipped} 张,昼夜先验 {priors} 张")
+        return results
+
+    def summary(self) -> str:
+        s = self.stats
+        rate = s["skipped"] / s["images"] if s["images"] else 0.0
+        return (f"预筛 {s['screened']}/{s['images']} 张,跳过 {s['skipped']} 张 ({rate:.1%}),"
+                f"昼夜先验 {s['night_priors']} 张,累计用时 {s['ms']} ms")
+
+    def close(self):
+        self.pool.shutdown()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+图片分片包（shard）格式
+将语料中的图片预先缩放、编码为 Base64 后顺序写入若干 shard-XXXXX.bin 文件，
+index.json 记录 原始 image_path → (分片号, 偏移, 长度)。
+读取时通过 mmap 直接切片，无需对每条记录做 os.path.exists + open。
+"""
+import os
+import json
+import mmap
+import base64
+import logging
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+SHARD_VERSION = 1
+INDEX_NAME = "index.json"
+DEFAULT_SHARD_BYTES = 1024 * 1024 * 1024
+
+
+def encode_variant(max_size: tuple, quality: int, fast_resize: bool = False) -> str:
+    """分片内容对应的编码参数，读取时只有参数一致才会命中"""
+    variant = f"{max_size[0]}x{max_size[1]}:q{quality}"
+    if fast_resize:
+        variant += ":fast"
+    return variant
+
+
+class ShardWriter:
+    """顺序写入分片文件，单个分片超过 shard_bytes 后切换到下一个"""
+    def __init__(self, out_dir: str, variant: str, shard_bytes: int = DEFAULT_SHARD_BYTES):
+        self.out_dir = out_dir
+        self.variant = variant
+        self.shard_bytes = shard_bytes
+        self.shards: List[str] = []
+        self.entries: Dict[str, list] = {}
+        self._file = None
+        self._offset = 0
+        os.makedirs(out_dir, exist_ok=True)
+
+    def _next_shard(self):
+        if self._file is not None:
+            self._file.close()
+        name = f"shard-{len(self.shards):05d}.bin"
+        self.shards.append(name)
+        self._file = open(os.path.join(self.out_dir, name), "wb")
+        self._offset = 0
+
+    def add(self, key: str, data: bytes):
+        if key in self.entries:
+            return
+        if self._file is None or (self._offset and self._offset + len(data) > self.shard_bytes):
+            self._next_shard()
+        self._file.write(data)  # type: ignore
+        self.entries[key] = [len(self.shards) - 1, self._offset, len(data)]
+        self._offset += len(data)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        index = {"version": SHARD_VERSION, "variant": self.variant, "shards": self.shards, "entries": self.entries}
+        # 索引最后写入，写入中断时不会留下指向不完整分片的索引
+        tmp_path = os.path.join(self.out_dir, INDEX_NAME + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(index, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(self.out_dir, INDEX_NAME))
+        logger.info(f"分片写入完成: {len(self.entries)} 张图片, {len(self.shards)} 个分片 → {self.out_dir}")
+
+
+class ShardReader:
+    """通过 mmap 读取分片；get_view() 返回零拷贝的 memoryview"""
+    def __init__(self, shard_dir: str):
+        self.shard_dir = shard_dir
+        with open(os.path.join(shard_dir, INDEX_NAME), "r", encoding="utf-8") as f:
+            index = json.load(f)
+        if index.get("version") != SHARD_VERSION:
+            raise ValueError(f"不支持的分片版本: {index.get('version')}")
+        self.variant = index["variant"]
+        self.shards = index["shards"]
+        self.entries = index["entries"]
+        self._maps: List[Optional[mmap.mmap]] = [None] * len(self.shards)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _map(self, shard: int) -> mmap.mmap:
+        if self._maps[shard] is None:
+            with open(os.path.join(self.shard_dir, self.shards[shard]), "rb") as f:
+                self._maps[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._maps[shard]  # type: ignore
+
+    def get_view(self, key: str) -> Optional[memoryview]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        shard, offset, length = entry
+        return memoryview(self._map(shard))[offset:offset + length]
+
+    def get_base64(self, key: str) -> Optional[str]:
+        """
+        返回 Base64 字符串。构造 str 必然复制一份分片内容，只有 get_view()（流式请求体 --stream-body）是零拷贝的；
+        非流式请求需要拼接完整的 JSON，这份复制无法避免，但仍省去了打开原图、解码与重编码。
+        """
+        view = self.get_view(key)
+        return None if view is None else str(view, "ascii")
+
+    def get_image_bytes(self, key: str) -> Optional[bytes]:
+        """解码出分片中的 JPEG 字节（复制），供需要按其他尺寸重新编码时使用"""
+        view = self.get_view(key)
+        return None if view is None else base64.b64decode(view)
+
+    def close(self):
+        for m in self._maps:
+            if m is not None:
+                m.close()
+        self._maps = [None] * len(self.shards)
+
+
+_default_reader = None
+_default_reader_dir = None
+
+
+def get_default_shard_reader() -> Optional[ShardReader]:
+    """由环境变量 IMAGE_SHARD_DIR 指定的分片目录；未设置时返回 None"""
+    global _default_reader, _default_reader_dir
+    shard_dir = os.getenv("IMAGE_SHARD_DIR", "")
+    if not shard_dir:
+        return None
+    if _default_reader is None or _default_reader_dir != shard_dir:
+        _default_reader = ShardReader(shard_dir)
+        _default_reader_dir = shard_dir
+        logger.info(f"已加载图片分片 {shard_dir}: {len(_default_reader)} 张, 编码参数 {_default_reader.variant}")
+    return _default_reader
@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+"""
+共享的异步 LLM 客户端
+所有评估脚本通过同一个调优过的 TCPConnector 访问 OpenAI 兼容接口（One-API 代理）：
+每主机连接上限、keep-alive、DNS 缓存 TTL 均可通过环境变量调整，
+并借助 aiohttp TraceConfig 统计连接池饱和（等待空闲连接）与连接复用情况，用于确定连接池大小。
+
+环境变量:
+    LLM_POOL_LIMIT       连接池总上限（默认 100）
+    LLM_POOL_PER_HOST    每主机连接上限（默认 32）
+    LLM_KEEPALIVE        空闲连接保活秒数（默认 60）
+    LLM_DNS_TTL          DNS 缓存秒数（默认 300）
+    LLM_MAX_RETRIES      暂时性错误（超时、连接错误、408/429/5xx）的最大重试次数（默认 4）
+    LLM_BREAKER_FAILURES 连续多少次暂时性失败后熔断、暂停所有请求（默认 5，0 表示不熔断）
+    LLM_BREAKER_RESET    熔断后首次探测前的暂停秒数（默认 30）
+    LLM_STREAM_RETRIES   流式输出被增量校验判定无效而中止后的最大重新请求次数（默认 2）
+    LLM_BACKENDS         多后端列表（json 字符串或文件路径，见 backend_pool.py），未配置时只使用 base_url 一个后端
+    LLM_METRICS_DIR      每次调用的指标与运行结束时的汇总写入的目录（见 metrics.py），未配置时只记录在内存中
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import Counter
+from typing import Callable, List, Optional, Tuple, Union
+
+import aiohttp
+
+from rate_limiter import CONGESTION_STATUS, parse_retry_after
+from resilience import RETRYABLE_STATUS, backoff_delay
+from hedging import Hedger, LatencyTracker, format_percentiles
+from stream_validator import StreamAbortedError
+from backend_pool import Backend, BackendPool, load_backends
+from metrics import MetricsRecorder
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASE_URL = "https://one-api.modelbest.co/v1"
+DEFAULT_POOL_LIMIT = int(os.getenv("LLM_POOL_LIMIT", "100"))
+DEFAULT_POOL_PER_HOST = int(os.getenv("LLM_POOL_PER_HOST", "32"))
+DEFAULT_KEEPALIVE = float(os.getenv("LLM_KEEPALIVE", "60"))
+DEFAULT_DNS_TTL = int(os.getenv("LLM_DNS_TTL", "300"))
+DEFAULT_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+DEFAULT_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+DEFAULT_BREAKER_RESET = float(os.getenv("LLM_BREAKER_RESET", "30"))
+DEFAULT_STREAM_RETRIES = int(os.getenv("LLM_STREAM_RETRIES", "2"))
+
+
+class LLMClient:
+    """
+    持有一个 ClientSession 与其专用连接器，可在多个评估器之间共享（同一事件循环内）。
+    post_chat() 返回 (status, body)：status 为 200 时 body 为解析后的 json，否则为响应文本；
+    超时与网络异常向上抛出，由调用方按各自格式转换为错误结果。
+    rate_limit=True 时每个请求先经过该模型在进程内共享的 AIMD 限速器（见 rate_limiter.py）。
+    暂时性错误按 max_retries 分类重试（指数退避 + 抖动），连续失败时熔断器暂停该端点的所有请求（见 resilience.py）；
+    重试耗尽后最后一次的状态码或异常照常返回 / 抛出。
+    传入 hedger 时每次尝试按实时耗时百分位发出对冲请求（见 hedging.py）。
+    backends 为多个等价后端时，每次尝试（含重试与对冲）选择近期耗时与错误率最低的后端，
+    熔断器、限速器与并发上限均按后端独立（见 backend_pool.py）；省略时读取 LLM_BACKENDS，仍未配置则只用 base_url。
+    stream=True 时按 SSE 读取流式响应并拼装为与非流式相同的 body，同时统计首 token 耗时与得到完整合法 JSON 的耗时；
+    另给出 validator（无参工厂，返回 stream_validator.IncrementalJSONValidator）时边接收边校验，
+    输出已可判定无效即中止该请求并重新请求，至多 stream_retries 次（见 stream_validator.py）。
+    每次 post_chat 向 metrics 记录一条指标：模型、后端、状态码、usage 中的 tokens、含重试的耗时、重试次数、请求体字节数。
+    """
+    def __init__(self, api_key: str, base_url: Optional[str] = None, limit: int = DEFAULT_POOL_LIMIT,
+                 limit_per_host: int = DEFAULT_POOL_PER_HOST, keepalive_timeout: float = DEFAULT_KEEPALIVE,
+                 ttl_dns_cache: int = DEFAULT_DNS_TTL, rate_limit: bool = True,
+                 max_retries: int = DEFAULT_MAX_RETRIES, backoff_base: float = 1.0, backoff_cap: float = 30.0,
+                 breaker_failures: int = DEFAULT_BREAKER_FAILURES, breaker_reset: float = DEFAULT_BREAKER_RESET,
+                 hedger: Optional[Hedger] = None, backends: Optional[List[Backend]] = None,
+                 stream_retries: int = DEFAULT_STREAM_RETRIES, metrics: Optional[MetricsRecorder] = None):
+        self.api_key = api_key
+        self.base_url = base_url or DEFAULT_BASE_URL
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.ttl_dns_cache = ttl_dns_cache
+        self.rate_limit = rate_limit
+        self.max_retries = max(0, max_retries)
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        if backends is None:
+            backends = load_backends(api_key=api_key)
+        self.pool = BackendPool(backends or [Backend("", self.base_url, api_key)], breaker_failures, breaker_reset)
+        self.hedger = hedger
+        self.stream_retries = max(0, stream_retries)
+        self.ttft = LatencyTracker()  # 流式响应首 token 耗时
+        self.time_to_valid_json = LatencyTracker()  # 流式响应得到完整合法 JSON 的耗时
+        self.metrics = metrics or MetricsRecorder()
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.stats = Counter()
+        self.in_flight = 0
+        self._refs = 0
+
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        trace = aiohttp.TraceConfig()
+        stats = self.stats
+
+        async def on_request_start(session, ctx, params):
+            ctx.start = time.perf_counter()
+            self.in_flight += 1
+            stats["requests"] += 1
+            stats["peak_in_flight"] = max(stats["peak_in_flight"], self.in_flight)
+
+        async def on_request_end(session, ctx, params):
+            self.in_flight -= 1
+
+        async def on_request_exception(session, ctx, params):
+            self.in_flight -= 1
+            stats["exceptions"] += 1
+
+        async def on_queued_start(session, ctx, params):
+            ctx.queued_at = time.perf_counter()
+            stats["queued"] += 1
+
+        async def on_queued_end(session, ctx, params):
+            stats["queued_ms"] += int((time.perf_counter() - ctx.queued_at) * 1000)
+
+        async def on_create_end(session, ctx, params):
+            stats["new_connections"] += 1
+
+        async def on_reuseconn(session, ctx, params):
+            stats["reused_connections"] += 1
+
+        async def on_dns_hit(session, ctx, params):
+            stats["dns_cache_hits"] += 1
+
+        async def on_dns_miss(session, ctx, params):
+            stats["dns_cache_misses"] += 1
+
+        trace.on_request_start.append(on_request_start)
+        trace.on_request_end.append(on_request_end)
+        trace.on_request_exception.append(on_request_exception)
+        trace.on_connection_queued_start.append(on_queued_start)
+        trace.on_connection_queued_end.append(on_queued_end)
+        trace.on_connection_create_end.append(on_create_end)
+        trace.on_connection_reuseconn.append(on_reuseconn)
+        trace.on_dns_cache_hit.append(on_dns_hit)
+        trace.on_dns_cache_miss.append(on_dns_miss)
+        return trace
+
+    async def __aenter__(self):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+                                             keepalive_timeout=self.keepalive_timeout,
+                                             ttl_dns_cache=self.ttl_dns_cache, use_dns_cache=True)
+            self.session = aiohttp.ClientSession(connector=connector, trace_configs=[self._trace_config()])
+        self._refs += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self._refs -= 1
+        if self._refs <= 0 and self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def post_chat(self, payload: Optional[dict] = None, data=None, content_length: Optional[int] = None,
+                        timeout: float = 120, model: Optional[str] = None, stream: bool = False,
+                        validator: Optional[Callable] = None) -> Tuple[int, Union[dict, str]]:
+        """
+        POST {base_url}/chat/completions。payload 以 json 发送；
+        data 为预先构造好的请求体，此时需给出 content_length 与 model（用于选择限速器）。
+        流式生成器只能读取一次，需要重试时 data 应传入可调用对象：每次尝试以该后端的模型名调用 data(model)，
+        返回 (请求体, content_length)。直接传入的请求体按原样发送，不替换为后端的模型别名。
+        stream=True 时请求体中须已设置 "stream": true。
+        """
+        call = {"model": model or (payload or {}).get("model", ""), "retries": 0}
+        status, body, error = None, None, None
+        start = time.perf_counter()
+        try:
+            status, body = await self._post_chat(payload, data, content_length, timeout, model, stream, validator,
+                                                 call)
+            return status, body
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            usage = body.get("usage") if status == 200 and isinstance(body, dict) else None
+            extra = {"error": error} if error else {}
+            self.metrics.record(call["model"], status, time.perf_counter() - start, call["retries"],
+                                call.get("payload_bytes"), usage, backend=call.get("backend"), stream=stream, **extra)
+
+    async def _post_chat(self, payload: Optional[dict], data, content_length: Optional[int], timeout: float,
+                         model: Optional[str], stream: bool, validator: Optional[Callable],
+                         call: dict) -> Tuple[int, Union[dict, str]]:
+        """重试循环；call 中记录重试次数，以及最后一次尝试的后端与请求体字节数"""
+        attempt = 0
+        aborts = 0
+        while True:
+            try:
+                status, body, retry_after = await self._attempt(payload, data, content_length, timeout, model,
+                                                                stream, validator, call)
+            except StreamAbortedError as e:
+                # 端点本身正常，只是本次输出无效：不退避，直接重新请求
+                if aborts >= self.stream_retries or not self._replayable(data):
+                    logger.warning(f"流式输出无效且重新请求次数已用尽: {e.reason}")
+                    return 200, {"choices": [{"message": {"role": "assistant", "content": e.content}}]}
+                aborts += 1
+                call["retries"] += 1
+                self.stats["stream_retries"] += 1
+                logger.warning(f"流式输出无效,已中止: {e.reason};第 {aborts}/{self.stream_retries} 次重新请求")
+                continue
+            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                if not self._can_retry(attempt, data):
+                    raise
+                reason = "超时" if isinstance(e, asyncio.TimeoutError) else type(e).__name__
+                await self._backoff(attempt, reason)
+                attempt += 1
+                call["retries"] += 1
+                continue
+
+            if status in RETRYABLE_STATUS and self._can_retry(attempt, data):
+                await self._backoff(attempt, f"HTTP {status}", retry_after)
+                attempt += 1
+                call["retries"] += 1
+                continue
+            if attempt and status == 200:
+                self.stats["recovered"] += 1
+            return status, body
+
+    async def _attempt(self, payload: Optional[dict], data, content_length: Optional[int], timeout: float,
+                       model: Optional[str], stream: bool = False,
+                       validator: Optional[Callable] = None,
+                       call: Optional[dict] = None) -> Tuple[int, Union[dict, str], Optional[float]]:
+        """发出一次请求；启用对冲且请求体可重建时交给 hedger，对冲请求同样重新选择后端"""
+        async def send():
+            backend, is_probe = await self.pool.acquire()
+            target = backend.model or model or (payload or {}).get("model", "")
+            ok, latency = None, None
+            start = time.perf_counter()
+            try:
+                if callable(data):
+                    body, length = data(target)
+                else:
+                    body, length = data, content_length
+                request_payload = dict(payload, model=target) if payload is not None and backend.model else payload
+                if body is None and request_payload is not None:
+                    # 与 aiohttp 的 json= 相同的序列化，顺便得到请求体字节数
+                    body = json.dumps(request_payload).encode("utf-8")
+                    length = len(body)
+                if call is not None:
+                    call["backend"] = backend.label
+                    call["payload_bytes"] = length if length is not None else (
+                        len(body) if isinstance(body, bytes) else None)
+                result = await self._post_limited(backend, request_payload, body, length, timeout, target,
+                                                  model or (payload or {}).get("model"),
+                                                  stream, validator)
+                # 200 与其余 4xx 都说明端点本身可用；4xx 属于请求本身的问题，不重试
+                ok = result[0] not in RETRYABLE_STATUS
+                if result[0] == 200:
+                    latency = time.perf_counter() - start
+                return result
+            except (asyncio.TimeoutError, aiohttp.ClientError):
+                ok = False
+                raise
+            except StreamAbortedError:
+                ok = True
+                raise
+            finally:
+                self._settle(backend, is_probe, ok, latency)
+
+        if self.hedger is None or not self._replayable(data):
+            return await send()
+        return await self.hedger.run(send)
+
+    @staticmethod
+    def _replayable(data) -> bool:
+        # 直接传入的生成器只能消费一次，无法重试或对冲
+        return data is None or callable(data) or isinstance(data, (bytes, str))
+
+    def _can_retry(self, attempt: int, data) -> bool:
+        if attempt >= self.max_retries:
+            if attempt:
+                self.stats["retries_exhausted"] += 1
+            return False
+        return self._replayable(data)
+
+    def _settle(self, backend: Backend, is_probe: bool, ok: Optional[bool], latency: Optional[float]):
+        """记录一次尝试的结果：更新该后端的熔断器与负载均衡统计；ok 为 None 表示被取消（如对冲落败）"""
+        breaker = backend.breaker
+        if breaker is not None:
+            if ok is None:
+                if is_probe:
+                    breaker.release_probe()
+            elif ok:
+                breaker.record_success()
+            else:
+                breaker.record_failure()
+        self.pool.release(backend, ok, latency)
+
+    async def _backoff(self, attempt: int, reason: str, retry_after: Optional[float] = None):
+        delay = max(backoff_delay(attempt, self.backoff_base, self.backoff_cap), retry_after or 0.0)
+        self.stats["retries"] += 1
+        logger.warning(f"{reason},{delay:.1f} 秒后第 {attempt + 1}/{self.max_retries} 次重试")
+        await asyncio.sleep(delay)
+
+    async def _post_limited(self, backend: Backend, payload: Optional[dict], data, content_length: Optional[int],
+                            timeout: float, model: str, requested: Optional[str] = None, stream: bool = False,
+                            validator: Optional[Callable] = None) -> Tuple[int, Union[dict, str], Optional[float]]:
+        """model 为该后端实际使用的模型名，requested 为请求中的模型名（命令行限速参数以它为准）"""
+        if not self.rate_limit:
+            return await self._post(backend, payload, data, content_length, timeout, stream, validator)
+
+        limiter = backend.rate_limiter(model, requested)
+        async with limiter.slot():
+            try:
+                status, body, retry_after = await self._post(backend, payload, data, content_length, timeout,
+                                                             stream, validator)
+            except (asyncio.TimeoutError, aiohttp.ClientError):
+                limiter.on_congestion()
+                raise
+        if status in CONGESTION_STATUS:
+            limiter.on_congestion(status, retry_after)
+        elif status == 200:
+            limiter.on_success()
+        return status, body, retry_after
+
+    async def _post(self, backend: Backend, payload: Optional[dict], data, content_length: Optional[int],
+                    timeout: float, stream: bool = False,
+                    validator: Optional[Callable] = None) -> Tuple[int, Union[dict, str], Optional[float]]:
+        headers = backend.headers()
+        if data is not None:
+            if content_length is not None:
+                headers["Content-Length"] = str(content_length)
+            request_kwargs = {"data": data}
+        else:
+            request_kwargs = {"json": payload}
+        start = time.perf_counter()
+        async with self.session.post(f"{backend.base_url}/chat/completions", headers=headers,  # type: ignore
+                                     timeout=aiohttp.ClientTimeout(total=timeout), **request_kwargs) as response:
+            if response.status == 200:
+                if stream:
+                    return response.status, await self._read_stream(response, start, validator), None
+                return response.status, await response.json(), None
+            return response.status, await response.text(), parse_retry_after(response.headers.get("Retry-After"))
+
+    async def _read_stream(self, response: aiohttp.ClientResponse, start: float,
+                           validator: Optional[Callable] = None) -> dict:
+        """
+        逐行读取 SSE（data: {...} / data: [DONE]），拼装为非流式格式的 body。
+        校验判定无效时抛出 StreamAbortedError，退出 async with 时连接随之关闭，服务端停止生成。
+        """
+        check = validator() if validator is not None else None
+        parts, usage, finish_reason, model = [], None, None, None
+        first_token = False
+        async for raw in response.content:
+            line = raw.decode("utf-8", errors="replace").strip()
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            try:
+                chunk = json.loads(data)
+            except json.JSONDecodeError:
+                continue
+            usage = chunk.get("usage") or usage
+            model = chunk.get("model") or model
+            for choice in chunk.get("choices") or []:
+                finish_reason = choice.get("finish_reason") or finish_reason
+                text = (choice.get("delta") or {}).get("content")
+                if not text:
+                    continue
+                if not first_token:
+                    first_token = True
+                    self.ttft.add(time.perf_counter() - start)
+                parts.append(text)
+                if check is None or check.complete:
+                    continue
+                check.feed(text)
+                if check.error is not None:
+                    self.stats["stream_aborts"] += 1
+                    raise StreamAbortedError(check.error, "".join(parts))
+                if check.complete:
+                    self.time_to_valid_json.add(time.perf_counter() - start)
+        body = {"choices": [{"message": {"role": "assistant", "content": "".join(parts)},
+                             "finish_reason": finish_reason}]}
+        if model:
+            body["model"] = model
+        if usage:
+            body["usage"] = usage
+        return body
+
+    def pool_stats(self) -> dict:
+        """连接池统计：复用率、需排队等待连接的请求占比与平均等待时间、峰值在途请求数"""
+        s = self.stats
+        connections = s["new_connections"] + s["reused_connections"]
+        return {
+            "requests": s["requests"],
+            "new_connections": s["new_connections"],
+            "reused_connections": s["reused_connections"],
+            "reuse_rate": round(s["reused_connections"] / connections, 3) if connections else 0.0,
+            "queued": s["queued"],
+            "saturation": round(s["queued"] / s["requests"], 3) if s["requests"] else 0.0,
+            "avg_queue_wait_ms": round(s["queued_ms"] / s["queued"], 1) if s["queued"] else 0.0,
+            "peak_in_flight": s["peak_in_flight"],
+            "limit_per_host": self.limit_per_host,
+            "dns_cache_hits": s["dns_cache_hits"],
+            "dns_cache_misses": s["dns_cache_misses"],
+            "exceptions": s["exceptions"],
+            "retries": s["retries"],
+            "recovered": s["recovered"],
+            "retries_exhausted": s["retries_exhausted"],
+            "breaker_opens": self.pool.breaker_opens,
+            "stream_aborts": s["stream_aborts"],
+            "stream_retries": s["stream_retries"],
+        }
+
+    def describe_rates(self, model: str) -> str:
+        """各后端限速器的当前速率，用于进度日志；尚未发出请求的后端不列出，不会因此创建限速器"""
+        parts = []
+        for backend in self.pool.backends:
+            limiter = backend._limiters.get(backend.model or model)
+            if limiter is not None:
+                rate = f"{limiter.rps:.2f} rps"
+                parts.append(f"{backend.label} {rate}" if backend.name else rate)
+        return " / ".join(parts) or "-"
+
+    def log_pool_stats(self):
+        logger.info(f"连接池统计: {self.pool_stats()}")
+        if self.metrics.overall.requests:
+            logger.info(self.metrics.describe())
+        if self.ttft.count:
+            logger.info(f"流式响应: 首 token 耗时 {format_percentiles(self.ttft)};"
+                        f"得到合法 JSON 耗时 {format_percentiles(self.time_to_valid_json)}")
+        if len(self.pool.backends) > 1:
+            for line in self.pool.describe():
+                logger.info(line)
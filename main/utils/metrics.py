@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+模型调用指标
+每次模型调用（aiohttp 的 LLMClient.post_chat 与 LangGraph 节点中的 ChatOpenAI.invoke）记录一条：
+模型、后端、状态码 / 异常、prompt / completion / 图像 tokens（取接口返回的 usage）、端到端耗时（含重试与退避）、
+重试次数、请求体字节数（单次尝试）。缓存命中与合并的请求不经过接口，不计入。
+
+MetricsRecorder(out_dir) 给出目录时逐条追加写入 out_dir/requests.jsonl，
+运行结束调用 write_summary() 写出 out_dir/summary.json 与 Prometheus 文本格式的 out_dir/metrics.prom：
+按模型汇总调用次数、各状态码次数、tokens / 重试 / 字节数合计，以及耗时、tokens、字节数的 p50/p95/p99。
+命令行脚本通过 --metrics-dir 指定目录，LangGraph 脚本读取环境变量 LLM_METRICS_DIR。
+
+LangGraph 中 ChatOpenAI 的重试在 openai SDK 内部完成，通过 http_client 的事件钩子统计每次调用实际发出的 HTTP 请求：
+    llm = ChatOpenAI(..., http_client=httpx.Client(event_hooks=http_event_hooks()))
+"""
+import os
+import json
+import time
+import logging
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from hedging import LatencyTracker
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_METRICS_DIR = os.getenv("LLM_METRICS_DIR")
+# 累加的字段与取百分位的字段
+TOTAL_FIELDS = ("prompt_tokens", "completion_tokens", "total_tokens", "image_tokens", "retries", "payload_bytes")
+PERCENTILE_FIELDS = ("latency", "prompt_tokens", "completion_tokens", "payload_bytes")
+QUANTILES = (50, 95, 99)
+
+# LangGraph 节点中当前这次 invoke 的 HTTP 请求统计
+_current_call: ContextVar[Optional[dict]] = ContextVar("llm_metrics_call", default=None)
+
+
+def usage_fields(usage: Optional[dict]) -> dict:
+    """从 OpenAI 格式的 usage 中取 tokens；图像 tokens 仅在接口给出 prompt_tokens_details.image_tokens 时有值"""
+    usage = usage or {}
+    details = usage.get("prompt_tokens_details") or {}
+    return {
+        "prompt_tokens": usage.get("prompt_tokens"),
+        "completion_tokens": usage.get("completion_tokens"),
+        "total_tokens": usage.get("total_tokens"),
+        "image_tokens": details.get("image_tokens"),
+    }
+
+
+class _ModelStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.status = Counter()
+        self.totals = Counter()
+        self.samples = {field: LatencyTracker(window=None) for field in PERCENTILE_FIELDS}
+
+    def add(self, record: dict):
+        self.requests += 1
+        status = record.get("status")
+        self.status[str(status) if status is not None else record.get("error", "error")] += 1
+        if status != 200:
+            self.errors += 1
+        for field in TOTAL_FIELDS:
+            if record.get(field) is not None:
+                self.totals[field] += record[field]
+        for field in PERCENTILE_FIELDS:
+            if record.get(field) is not None:
+                self.samples[field].add(record[field])
+
+    def summary(self) -> dict:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "status": dict(self.status),
+            "totals": {field: self.totals[field] for field in TOTAL_FIELDS},
+            **{field: self.samples[field].percentiles() for field in PERCENTILE_FIELDS},
+        }
+
+
+class MetricsRecorder:
+    def __init__(self, out_dir: Optional[str] = DEFAULT_METRICS_DIR):
+        self.out_dir = out_dir
+        self.overall = _ModelStats()
+        self.by_model: Dict[str, _ModelStats] = defaultdict(_ModelStats)
+        self.started = time.time()
+        self._file = None
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+            self._file = open(os.path.join(out_dir, "requests.jsonl"), "a", encoding="utf-8")
+
+    def record(self, model: str, status: Optional[int], latency: float, retries: int = 0,
+               payload_bytes: Optional[int] = None, usage: Optional[dict] = None, **extra):
+        """记录一次模型调用；status 为 None 表示以异常结束，异常类型放在 extra 的 error 中"""
+        record = {"ts": round(time.time(), 3), "model": model or "", "status": status,
+                  "latency": round(latency, 4), "retries": retries, "payload_bytes": payload_bytes,
+                  **usage_fields(usage), **extra}
+        self.overall.add(record)
+        self.by_model[record["model"]].add(record)
+        if self._file is not None:
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._file.flush()
+
+    def summary(self) -> dict:
+        return {
+            "started": self.started,
+            "elapsed": time.time() - self.started,
+            **self.overall.summary(),
+            "by_model": {model: stats.summary() for model, stats in sorted(self.by_model.items())},
+        }
+
+    def prometheus_text(self) -> str:
+        lines = []
+
+        def metric(name: str, kind: str, help_text: str, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(samples)
+
+        def labels(**values) -> str:
+            inner = ",".join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                             for k, v in values.items())
+            return "{" + inner + "}"
+
+        models = sorted(self.by_model.items())
+        metric("llm_requests_total", "counter", "模型调用次数（按状态码，异常时为异常类型）",
+               [f"llm_requests_total{labels(model=m, status=s)} {n}"
+                for m, stats in models for s, n in sorted(stats.status.items())])
+        metric("llm_tokens_total", "counter", "接口返回的 tokens 合计",
+               [f"llm_tokens_total{labels(model=m, type=t)} {stats.totals[f'{t}_tokens']}"
+                for m, stats in models for t in ("prompt", "completion", "image")])
+        metric("llm_retries_total", "counter", "重试次数合计",
+               [f"llm_retries_total{labels(model=m)} {stats.totals['retries']}" for m, stats in models])
+        metric("llm_payload_bytes_total", "counter", "请求体字节数合计",
+               [f"llm_payload_bytes_total{labels(model=m)} {stats.totals['payload_bytes']}" for m, stats in models])
+        for field, name, help_text in (("latency", "llm_request_latency_seconds", "单次调用端到端耗时（含重试）"),
+                                       ("prompt_tokens", "llm_prompt_tokens", "单次调用的 prompt tokens"),
+                                       ("completion_tokens", "llm_completion_tokens", "单次调用的 completion tokens"),
+                                       ("payload_bytes", "llm_payload_bytes", "单次调用的请求体字节数")):
+            samples = []
+            for m, stats in models:
+                tracker = stats.samples[field]
+                if not tracker.count:
+                    continue
+                for q in QUANTILES:
+                    samples.append(f"{name}{labels(model=m, quantile=q / 100)} {tracker.percentile(q)}")
+                samples.append(f"{name}_sum{labels(model=m)} {round(sum(tracker.samples), 4)}")
+                samples.append(f"{name}_count{labels(model=m)} {tracker.count}")
+            metric(name, "summary", help_text, samples)
+        return "\n".join(lines) + "\n"
+
+    def write_summary(self):
+        """写出 summary.json 与 metrics.prom（未指定目录时只记录在内存中）"""
+        if not self.out_dir:
+            return
+        with open(os.path.join(self.out_dir, "summary.json"), "w", encoding="utf-8") as f:
+            json.dump(self.summary(), f, ensure_ascii=False, indent=2)
+        with open(os.path.join(self.out_dir, "metrics.prom"), "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text())
+        logger.info(f"调用指标已写出: {self.out_dir}")
+
+    def describe(self) -> str:
+        s = self.overall.summary()
+        latency = " / ".join(f"{k} {v:.2f}s" if v is not None else f"{k} -" for k, v in s["latency"].items())
+        totals = s["totals"]
+        return (f"模型调用 {s['requests']} 次(失败 {s['errors']} 次,重试 {totals['retries']} 次);"
+                f"prompt tokens {totals['prompt_tokens']},completion tokens {totals['completion_tokens']},"
+                f"图像 tokens {totals['image_tokens']},请求体 {totals['payload_bytes'] / 1024 / 1024:.1f} MB;耗时 {latency}")
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+
+
+def http_event_hooks() -> dict:
+    """httpx 事件钩子：invoke_with_metrics 期间每次实际发出的 HTTP 请求计入当前调用（重试次数与请求体字节数）"""
+    def on_request(request):
+        call = _current_call.get()
+        if call is not None:
+            call["attempts"] += 1
+            call["payload_bytes"] = len(request.content)
+
+    return {"request": [on_request]}
+
+
+def invoke_with_metrics(llm, messages: list, recorder: MetricsRecorder):
+    """调用 llm.invoke(messages) 并记录一条指标；tokens 取 AIMessage.usage_metadata 或 response_metadata.token_usage"""
+    model = getattr(llm, "model_name", "") or getattr(llm, "model", "")
+    call = {"attempts": 0, "payload_bytes": None}
+    token = _current_call.set(call)
+    start = time.perf_counter()
+    try:
+        response = llm.invoke(messages)
+    except Exception as e:
+        recorder.record(model, None, time.perf_counter() - start, max(0, call["attempts"] - 1),
+                        call["payload_bytes"], error=type(e).__name__)
+        raise
+    finally:
+        _current_call.reset(token)
+    usage = (getattr(response, "response_metadata", None) or {}).get("token_usage")
+    metadata = getattr(response, "usage_metadata", None)
+    if not usage and metadata:
+        usage = {"prompt_tokens": metadata.get("input_tokens"), "completion_tokens": metadata.get("output_tokens"),
+                 "total_tokens": metadata.get("total_tokens"),
+                 "prompt_tokens_details": {"image_tokens": (metadata.get("input_token_details") or {}).get("image")}}
+    recorder.record(model, 200, time.perf_counter() - start, max(0, call["attempts"] - 1), call["payload_bytes"],
+                    usage=usage)
+    return response
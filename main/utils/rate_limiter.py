@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+自适应 AIMD 令牌桶限速
+同一进程内按模型共享一个令牌桶：请求前取令牌（并受并发上限约束），
+收到 429 / 5xx 或超时时速率乘性下降（遵守 Retry-After，期间暂停发放令牌），
+响应正常时速率加性上升，直至 max_rps。
+
+每个模型的初始速率与并发上限可通过环境变量 LLM_RATE_LIMITS 配置（json 字符串或 json 文件路径），
+键为模型名中包含的子串，最长匹配优先，例如:
+    LLM_RATE_LIMITS='{"gemini": {"rps": 4, "max_rps": 20, "concurrency": 32}, "gpt-4o": {"rps": 1}}'
+多后端时限速器按 模型@后端 分别创建（见 backend_pool.py），命令行为模型给出的参数作为该模型各后端限速器的默认值。
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LIMITS = {"rps": 5.0, "min_rps": 0.2, "max_rps": 20.0, "concurrency": None}
+# 视为拥塞信号的状态码
+CONGESTION_STATUS = {429, 500, 502, 503, 504}
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After 可以是秒数或 HTTP 日期，解析失败返回 None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AIMDRateLimiter:
+    """
+    rps 为当前速率（令牌/秒），在 [min_rps, max_rps] 之间调整：
+    - 正常响应：rps += increase
+    - 拥塞：rps *= decrease；cooldown 秒内的后续拥塞信号不再重复下降（它们多半是下降前已发出的请求）
+    concurrency 为该模型同时在途请求数上限，None 表示不限。
+    """
+    def __init__(self, name: str = "", rps: float = 5.0, min_rps: float = 0.2, max_rps: float = 20.0,
+                 concurrency: Optional[int] = None, increase: float = 0.05, decrease: float = 0.5,
+                 burst: float = 1.0, cooldown: float = 2.0, log_interval: float = 30.0):
+        self.name = name
+        self.rps = rps
+        self.min_rps = min_rps
+        self.max_rps = max(max_rps, rps)
+        self.concurrency = concurrency
+        self.increase = increase
+        self.decrease = decrease
+        self.burst = burst
+        self.cooldown = cooldown
+        self.log_interval = log_interval
+        self.tokens = burst
+        self.paused_until = 0.0
+        self._last_refill = time.monotonic()
+        self._last_decrease = 0.0
+        self._last_log = 0.0
+        self._lock: Optional[asyncio.Lock] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.throttled = 0  # 收到的拥塞信号次数
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self._last_refill) * self.rps)
+        self._last_refill = now
+
+    async def acquire(self):
+        """等待一个令牌（先到先得）"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rps)
+
+    @asynccontextmanager
+    async def slot(self):
+        """占用一个并发名额并取得令牌"""
+        if self.concurrency and self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        if self._semaphore is not None:
+            async with self._semaphore:
+                await self.acquire()
+                yield
+        else:
+            await self.acquire()
+            yield
+
+    def on_success(self):
+        self.rps = min(self.max_rps, self.rps + self.increase)
+        now = time.monotonic()
+        if now - self._last_log >= self.log_interval:
+            self._last_log = now
+            logger.info(f"[限速 {self.name}] 当前速率 {self.rps:.2f} rps")
+
+    def on_congestion(self, status: Optional[int] = None, retry_after: Optional[float] = None):
+        """429 / 5xx / 超时时调用；status 为 None 表示超时或连接错误"""
+        self.throttled += 1
+        now = time.monotonic()
+        if retry_after:
+            self.paused_until = max(self.paused_until, now + retry_after)
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.rps = max(self.min_rps, self.rps * self.decrease)
+        self.tokens = min(self.tokens, 0.0)
+        reason = f"HTTP {status}" if status else "超时/连接错误"
+        pause = f",暂停 {retry_after:.1f} 秒 (Retry-After)" if retry_after else ""
+        logger.warning(f"[限速 {self.name}] {reason},速率降至 {self.rps:.2f} rps{pause}")
+
+    def describe(self) -> str:
+        limit = f",并发上限 {self.concurrency}" if self.concurrency else ""
+        return f"[限速 {self.name}] 当前速率 {self.rps:.2f} rps{limit},累计拥塞信号 {self.throttled} 次"
+
+
+def load_rate_limits() -> Dict[str, dict]:
+    raw = os.getenv("LLM_RATE_LIMITS", "")
+    if not raw:
+        return {}
+    try:
+        if os.path.exists(raw):
+            with open(raw, "r", encoding="utf-8") as f:
+                return json.load(f)
+        return json.loads(raw)
+    except (OSError, json.JSONDecodeError) as e:
+        logger.error(f"LLM_RATE_LIMITS 解析失败,使用默认限速: {e}")
+        return {}
+
+
+_limiters: Dict[str, AIMDRateLimiter] = {}
+_overrides: Dict[str, dict] = {}
+
+
+def configure_rate_limit(model: str, **limits):
+    """命令行等处为指定模型覆盖限速参数（rps、max_rps、concurrency 等），须在首次 get_rate_limiter 之前调用"""
+    _overrides[model] = {k: v for k, v in limits.items() if v is not None}
+
+
+def get_rate_limiter(model: str, parent: Optional[str] = None) -> AIMDRateLimiter:
+    """
+    按模型返回进程内共享的限速器。
+    parent 为上层模型名（如 模型@后端 的限速器对应的请求模型），其 configure_rate_limit 参数作为默认值，
+    省略时取 model 中 @ 之前的部分。参数优先级：model 自身的覆盖 > parent 的覆盖 > LLM_RATE_LIMITS > 默认值。
+    """
+    limiter = _limiters.get(model)
+    if limiter is None:
+        config = dict(DEFAULT_LIMITS)
+        table = load_rate_limits()
+        matches = sorted((key for key in table if key in model), key=len)
+        for key in matches:
+            config.update(table[key])
+        parent = parent or model.split("@", 1)[0]
+        if parent != model:
+            config.update(_overrides.get(parent, {}))
+        config.update(_overrides.get(model, {}))
+        limiter = AIMDRateLimiter(name=model, **config)
+        _limiters[model] = limiter
+        logger.info(limiter.describe())
+    return limiter
+
+
+def all_rate_limiters() -> Dict[str, AIMDRateLimiter]:
+    return dict(_limiters)
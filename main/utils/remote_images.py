@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+远程图片预取与本地镜像
+- 复用 keep-alive 连接池并发下载后续 N 张图片
+- 按 URL 建立本地内容镜像，记录 ETag / Last-Modified，重跑时只做条件请求（304 不再下载正文）
+"""
+import os
+import json
+import asyncio
+import hashlib
+import logging
+import queue
+import threading
+import time
+from collections import Counter, deque
+from typing import AsyncIterator, Iterable, Iterator, Optional, Tuple
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MIRROR_DIR = os.getenv("IMAGE_MIRROR_DIR", ".cache/image_mirror")
+
+
+class ImageMirror:
+    """URL → 本地文件的内容镜像，每个 URL 对应 <sha1>.bin 与 <sha1>.json（响应头元数据）"""
+    def __init__(self, mirror_dir: str = DEFAULT_MIRROR_DIR):
+        self.mirror_dir = mirror_dir
+        os.makedirs(mirror_dir, exist_ok=True)
+
+    def _paths(self, url: str) -> Tuple[str, str]:
+        name = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.mirror_dir, name + ".bin"), os.path.join(self.mirror_dir, name + ".json")
+
+    def lookup(self, url: str) -> Optional[dict]:
+        data_path, meta_path = self._paths(url)
+        if not (os.path.exists(data_path) and os.path.exists(meta_path)):
+            return None
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        meta["data_path"] = data_path
+        return meta
+
+    def read(self, url: str) -> bytes:
+        data_path, _ = self._paths(url)
+        with open(data_path, "rb") as f:
+            return f.read()
+
+    def store(self, url: str, data: bytes, etag: Optional[str], last_modified: Optional[str]):
+        data_path, meta_path = self._paths(url)
+        # 先写临时文件再替换，避免中断时留下半个文件
+        tmp_path = data_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, data_path)
+        self.touch(url, etag, last_modified)
+
+    def touch(self, url: str, etag: Optional[str], last_modified: Optional[str]):
+        _, meta_path = self._paths(url)
+        meta = {"url": url, "etag": etag, "last_modified": last_modified, "validated_at": time.time()}
+        tmp_path = meta_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp_path, meta_path)
+
+
+class RemoteImagePrefetcher:
+    """
+    基于 aiohttp 连接池的图片预取器。
+    map() 最多领先 lookahead 张图片、以 concurrency 为并发上限下载，并按输入顺序产出结果。
+    max_age 秒内验证过的镜像直接使用，不再发起条件请求。
+    """
+    def __init__(self, mirror: Optional[ImageMirror] = None, concurrency: int = 8, lookahead: int = 16,
+                 timeout: float = 10, max_age: float = 0):
+        self.mirror = mirror or ImageMirror()
+        self.concurrency = concurrency
+        self.lookahead = max(1, lookahead)
+        self.timeout = timeout
+        self.max_age = max_age
+        self.stats = Counter()  # downloaded / not_modified / fresh / failed
+
+    async def fetch(self, session: aiohttp.ClientSession, url: str) -> Optional[bytes]:
+        meta = self.mirror.lookup(url)
+        if meta and self.max_age and time.time() - meta.get("validated_at", 0) < self.max_age:
+            self.stats["fresh"] += 1
+            return self.mirror.read(url)
+
+        headers = {}
+        if meta:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        try:
+            async with session.get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=self.timeout)) as response:
+                if response.status == 304 and meta:
+                    self.mirror.touch(url, meta.get("etag"), meta.get("last_modified"))
+                    self.stats["not_modified"] += 1
+                    return self.mirror.read(url)
+                response.raise_for_status()
+                data = await response.read()
+                self.mirror.store(url, data, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+                self.stats["downloaded"] += 1
+                return data
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # 网络失败时若有旧镜像则退回使用
+            if meta:
+                logger.warning(f"图片重新验证失败，使用本地镜像: {url} ({e})")
+                self.stats["stale"] += 1
+                return self.mirror.read(url)
+            logger.error(f"图片下载失败: {url} ({e})")
+            self.stats["failed"] += 1
+            return None
+
+    async def map(self, urls: Iterable[str]) -> AsyncIterator[Tuple[str, Optional[bytes]]]:
+        """按输入顺序产出 (url, 图片字节)，下载失败时字节为 None"""
+        connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60, ttl_dns_cache=300)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def bounded_fetch(url: str) -> Optional[bytes]:
+            if not url:
+                return None
+            async with semaphore:
+                return await self.fetch(session, url)
+
+        async with aiohttp.ClientSession(connector=connector) as session:
+            pending = deque()
+            urls = iter(urls)
+            try:
+                for url in urls:
+                    pending.append((url, asyncio.ensure_future(bounded_fetch(url))))
+                    if len(pending) >= self.lookahead:
+                        break
+
+                while pending:
+                    url, task = pending.popleft()
+                    next_url = next(urls, None)
+                    if next_url is not None:
+                        pending.append((next_url, asyncio.ensure_future(bounded_fetch(next_url))))
+                    yield url, await task
+            finally:
+                # 上游异常或调用方提前退出时取消仍在下载的任务
+                for _, task in pending:
+                    task.cancel()
+
+    def iter_sync(self, urls: Iterable[str]) -> Iterator[Tuple[str, Optional[bytes]]]:
+        """
+        供同步脚本使用：在后台线程中运行事件循环，通过有界队列按顺序交付结果，
+        调用方处理当前图片时，后续图片已在并发下载。
+        预取线程异常退出时，已交付的结果之后在调用方重新抛出该异常，不会悄悄提前结束。
+        """
+        results = queue.Queue(maxsize=self.lookahead)
+        done = object()
+        errors = []
+
+        async def produce():
+            async for item in self.map(urls):
+                await asyncio.to_thread(results.put, item)
+
+        def run():
+            try:
+                asyncio.run(produce())
+            except Exception as e:
+                logger.error(f"图片预取线程异常: {e}")
+                errors.append(e)
+            finally:
+                results.put(done)
+
+        worker = threading.Thread(target=run, daemon=True)
+        worker.start()
+        while True:
+            item = results.get()
+            if item is done:
+                break
+            yield item  # type: ignore
+        worker.join()
+        logger.info(f"图片预取统计: {dict(self.stats)}")
+        if errors:
+            raise errors[0]
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+流式构造 chat/completions 请求体
+JSON 信封（模型、参数、文字 prompt）单独序列化，图片部分按块写入 HTTP body：
+原始 JPEG 字节边写边做 Base64，已编码的 Base64（str / mmap 分片）直接切片写出。
+这样每个在途请求不再同时持有 JPEG 字节、Base64 字符串和序列化后的完整 JSON。
+"""
+import os
+import json
+import base64
+import hashlib
+from typing import AsyncIterator, Iterator, Optional, Tuple, Union
+
+from image_codec import (DEFAULT_MAX_SIZE, DEFAULT_QUALITY, DEFAULT_PASSTHROUGH_MAX_BYTES, ENCODE_PATHS,
+                         can_passthrough, encode_pil_image, get_default_cache, image_source, make_cache_key,
+                         shard_image_bytes, ImageCache, ImageProfile)
+from image_shard import encode_variant, get_default_shard_reader
+from PIL import Image
+
+# 占位符：序列化信封后在此处切开，插入图片数据
+IMAGE_PLACEHOLDER = "__IMAGE_DATA_URL_PLACEHOLDER__"
+# 3 的倍数，保证分块 Base64 拼接后与整体编码结果一致
+DEFAULT_CHUNK_SIZE = 48 * 1024
+
+
+class ImagePayload:
+    """
+    请求中的一张图片。
+    raw 为原始 JPEG 字节（写出时分块 Base64）；b64 为已编码的 Base64（str、bytes 或 memoryview）。
+    """
+    def __init__(self, raw: Optional[bytes] = None, b64: Union[str, bytes, memoryview, None] = None,
+                 mime: str = "image/jpeg"):
+        if (raw is None) == (b64 is None):
+            raise ValueError("raw 与 b64 必须且只能提供一个")
+        self.raw = raw
+        self.b64 = b64
+        self.mime = mime
+
+    def b64_length(self) -> int:
+        if self.raw is not None:
+            return 4 * ((len(self.raw) + 2) // 3)
+        return len(self.b64)  # type: ignore
+
+    def iter_b64_chunks(self, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[bytes]:
+        if self.raw is not None:
+            view = memoryview(self.raw)
+            for start in range(0, len(view), chunk_size):
+                yield base64.b64encode(view[start:start + chunk_size])
+        elif isinstance(self.b64, str):
+            for start in range(0, len(self.b64), chunk_size):
+                yield self.b64[start:start + chunk_size].encode("ascii")
+        else:
+            view = memoryview(self.b64)  # type: ignore
+            for start in range(0, len(view), chunk_size):
+                yield bytes(view[start:start + chunk_size])
+
+
+def load_image_payload(image_path: str, max_size: tuple = DEFAULT_MAX_SIZE, quality: int = DEFAULT_QUALITY,
+                       use_cache: bool = True, cache: Optional[ImageCache] = None, fast_resize: bool = False,
+                       passthrough: bool = False, passthrough_max_bytes: int = DEFAULT_PASSTHROUGH_MAX_BYTES,
+                       profile: Optional[ImageProfile] = None) -> ImagePayload:
+    """
+    与 encode_image 参数一致，但尽量避免生成完整的 Base64 字符串：
+    分片命中返回 mmap 切片，透传、重新编码与缓存命中返回原始 JPEG 字节（缓存中按 键:raw 存放），
+    只有命中非流式运行写入的 Base64 缓存时返回该字符串。
+    会读取与解码图片，在事件循环中应通过 asyncio.to_thread 调用。
+    """
+    data = None
+    if profile is None:
+        reader = get_default_shard_reader()
+        if reader is not None and image_path in reader and reader.variant == encode_variant(max_size, quality, fast_resize):
+            ENCODE_PATHS["shard"] += 1
+            return ImagePayload(b64=reader.get_view(image_path))
+    else:
+        # 只在分片中的图片以分片中的 JPEG 作为原图按 profile 重新缩放
+        data = shard_image_bytes(image_path)
+
+    with Image.open(image_source(image_path, data)) as img:
+        if profile is not None:
+            max_size = profile.plan(img.size)
+        nbytes = len(data) if data is not None else os.path.getsize(image_path)
+        if passthrough and can_passthrough(img, nbytes, max_size, passthrough_max_bytes):
+            ENCODE_PATHS["passthrough"] += 1
+            if data is not None:
+                return ImagePayload(raw=data)
+            with open(image_path, "rb") as f:
+                return ImagePayload(raw=f.read())
+
+        key = None
+        if use_cache:
+            cache = cache or get_default_cache()
+            digest = hashlib.sha1(data).hexdigest() if data is not None else cache.file_digest(image_path)
+            key = make_cache_key(digest, max_size, quality, fast_resize)
+            cached = cache.get_first(f"{key}:raw", key)
+            if cached is not None:
+                ENCODE_PATHS["cache_hit"] += 1
+                return ImagePayload(raw=cached) if isinstance(cached, bytes) else ImagePayload(b64=cached)
+
+        raw = encode_pil_image(img, max_size, quality, fast_resize)
+
+    if use_cache:
+        # 缓存原始 JPEG 字节，不生成 Base64 副本
+        cache.put(f"{key}:raw", raw)
+    ENCODE_PATHS["reencode"] += 1
+    return ImagePayload(raw=raw)
+
+
+def build_streaming_body(payload: dict, image: ImagePayload,
+                         chunk_size: int = DEFAULT_CHUNK_SIZE) -> Tuple[AsyncIterator[bytes], int]:
+    """
+    payload 中图片 url 的位置填写 IMAGE_PLACEHOLDER。
+    返回 (异步字节块生成器, Content-Length)，可直接作为 aiohttp 的 data= 使用。
+    """
+    envelope = json.dumps(payload, ensure_ascii=False)
+    before, sep, after = envelope.partition(IMAGE_PLACEHOLDER)
+    if not sep:
+        raise ValueError("payload 中缺少图片占位符")
+    prefix = (before + f"data:{image.mime};base64,").encode("utf-8")
+    suffix = after.encode("utf-8")
+    content_length = len(prefix) + image.b64_length() + len(suffix)
+
+    async def body() -> AsyncIterator[bytes]:
+        yield prefix
+        for chunk in image.iter_b64_chunks(chunk_size):
+            yield chunk
+        yield suffix
+
+    return body(), content_length
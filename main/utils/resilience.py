@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+请求重试与熔断
+- 分类重试：超时、连接错误、408/429/5xx 视为暂时性错误，按带上限的指数退避 + 全抖动重试；
+  其余 4xx（参数校验、鉴权等）不重试，直接返回给调用方。
+- 熔断器：连续 failure_threshold 次暂时性失败后打开，所有请求暂停等待；
+  到期后进入半开状态只放行一个探测请求，成功则关闭，失败则以加倍的等待时间再次打开。
+  单个请求等待熔断超过 max_wait 秒时抛出 CircuitOpenError，避免端点长时间不可用时无限挂起。
+"""
+import time
+import random
+import asyncio
+import logging
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# 可重试的状态码
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """熔断器打开且等待超时"""
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 30.0) -> float:
+    """第 attempt 次重试（从 0 开始）的等待秒数：[0, min(cap, base * 2^attempt)] 内均匀随机"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    def __init__(self, name: str = "", failure_threshold: int = 5, reset_timeout: float = 30.0,
+                 max_reset_timeout: float = 300.0, max_wait: float = 900.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.base_reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.max_wait = max_wait
+        self.state = "closed"
+        self.failures = 0
+        self.open_until = 0.0
+        self.opens = 0
+        self._probe: Optional[asyncio.Future] = None
+
+    async def wait_ready(self) -> bool:
+        """
+        closed 时立即返回；open 时等待到期；half-open 时只有探测请求继续，其余等待探测结果。
+        返回 True 表示调用方是探测请求，结束后须调用 record_success / record_failure / release_probe 之一。
+        """
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            now = time.monotonic()
+            if self.state == "closed":
+                return False
+            if now >= deadline:
+                raise CircuitOpenError(f"熔断器 {self.name} 打开,等待超过 {self.max_wait:.0f} 秒")
+            if self.state == "open":
+                if now < self.open_until:
+                    await asyncio.sleep(min(self.open_until, deadline) - now)
+                    continue
+                self.state = "half_open"
+                self._probe = asyncio.get_running_loop().create_future()
+                logger.info(f"[熔断 {self.name}] 进入半开状态,放行探测请求")
+                return True
+            # half_open:等待探测请求结束
+            probe = self._probe
+            if probe is not None and not probe.done():
+                try:
+                    await asyncio.wait_for(asyncio.shield(probe), max(0.0, deadline - now))
+                except asyncio.TimeoutError:
+                    pass
+
+    def try_acquire(self) -> Optional[bool]:
+        """
+        非阻塞版 wait_ready（多后端选路时使用）：当前不能放行返回 None，
+        closed 时返回 False，open 到期转为半开并由调用方作为探测请求时返回 True。
+        """
+        if self.state == "closed":
+            return False
+        if self.state == "open" and time.monotonic() >= self.open_until:
+            self.state = "half_open"
+            self._probe = asyncio.get_running_loop().create_future()
+            logger.info(f"[熔断 {self.name}] 进入半开状态,放行探测请求")
+            return True
+        return None
+
+    def _finish_probe(self):
+        if self._probe is not None and not self._probe.done():
+            self._probe.set_result(None)
+        self._probe = None
+
+    def release_probe(self):
+        """探测请求未得出结论（如被取消）时调用，让下一个等待者成为探测请求"""
+        if self.state == "half_open":
+            self.state = "open"
+            self.open_until = 0.0
+            self._finish_probe()
+
+    def record_success(self):
+        if self.state != "closed":
+            logger.info(f"[熔断 {self.name}] 探测成功,恢复请求")
+        self.state = "closed"
+        self.failures = 0
+        self.reset_timeout = self.base_reset_timeout
+        self._finish_probe()
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open":
+            self.reset_timeout = min(self.max_reset_timeout, self.reset_timeout * 2)
+            self._open()
+        elif self.state == "closed" and self.failures >= self.failure_threshold:
+            self._open()
+
+    def _open(self):
+        self.state = "open"
+        self.open_until = time.monotonic() + self.reset_timeout
+        self.opens += 1
+        self._finish_probe()
+        logger.warning(f"[熔断 {self.name}] 连续 {self.failures} 次暂时性失败,暂停所有请求 {self.reset_timeout:.0f} 秒")
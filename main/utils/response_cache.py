@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+模型响应的持久化缓存（SQLite）
+键由模型名、规范化后的 prompt 哈希、图片内容哈希与采样参数组成，崩溃后重跑或只改下游处理时不再重复请求接口。
+
+采样正确性：temperature > 0 时同一请求每次出现都视为一次新的采样，键中追加本次运行内的出现序号（sample index），
+例如同一图片在语料中出现三次做多数投票时，三次分别缓存、分别返回三个不同的回答；
+temperature 为 0 时所有出现共用一个键。
+
+模式（mode）：
+    use      读写缓存（默认）
+    refresh  不读缓存，请求后覆盖写入
+    bypass   完全不使用缓存
+
+环境变量:
+    RESPONSE_CACHE         默认模式（use / refresh / bypass）
+    RESPONSE_CACHE_DIR     缓存目录（默认 .cache/responses）
+    RESPONSE_CACHE_MAX_MB  总大小上限，超出时按最近访问时间淘汰（默认 512）
+"""
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+from collections import Counter
+from typing import Iterable, Optional
+
+from metrics import invoke_with_metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_MODE = os.getenv("RESPONSE_CACHE", "use")
+DEFAULT_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR", ".cache/responses")
+DEFAULT_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_MB", "512")) * 1024 * 1024
+CACHE_MODES = ("use", "refresh", "bypass")
+# 参与键计算的采样参数
+SAMPLING_PARAMS = ("temperature", "top_p", "top_k", "frequency_penalty", "presence_penalty", "max_tokens",
+                   "seed", "n", "stop", "response_format")
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """合并连续空白，去掉首尾空白，避免仅缩进或换行不同导致缓存未命中"""
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def image_digest(image) -> str:
+    """
+    图片内容哈希：image 为 data URL 字符串，或带 iter_b64_chunks() 的 ImagePayload（流式请求体），
+    两者对同一张编码结果得到相同的哈希。
+    """
+    h = hashlib.sha1()
+    if isinstance(image, str):
+        h.update(image.encode("utf-8"))
+    else:
+        h.update(f"data:{image.mime};base64,".encode("utf-8"))
+        for chunk in image.iter_b64_chunks():
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def prompt_digest(messages: Iterable[dict], images: Iterable = ()) -> str:
+    """
+    messages 为 OpenAI 格式的消息列表：文本部分规范化后参与哈希，图片部分替换为内容哈希。
+    images 按顺序替换消息中的占位 url（流式请求体中图片不在 payload 里）。
+    """
+    images = iter(images)
+    h = hashlib.sha256()
+    for message in messages:
+        h.update(f"\x00{message.get('role', '')}:".encode("utf-8"))
+        content = message.get("content")
+        parts = [{"type": "text", "text": content}] if isinstance(content, str) else (content or [])
+        for part in parts:
+            if isinstance(part, str):
+                part = {"type": "text", "text": part}
+            if part.get("type") == "image_url":
+                url = part.get("image_url", {}).get("url", "")
+                if not url.startswith("data:"):
+                    url = next(images, url)
+                h.update(f"\x01image:{image_digest(url)}".encode("utf-8"))
+            else:
+                h.update(f"\x01text:{normalize_text(str(part.get('text', '')))}".encode("utf-8"))
+    return h.hexdigest()
+
+
+def sampling_params(params: Optional[dict]) -> dict:
+    params = params or {}
+    return {k: params[k] for k in SAMPLING_PARAMS if params.get(k) is not None}
+
+
+def request_digest(model: str, messages: Iterable[dict], params: Optional[dict] = None, images: Iterable = ()) -> str:
+    """模型名 + 规范化 prompt + 图片内容 + 采样参数的哈希，相同请求得到相同结果"""
+    sampling = json.dumps(sampling_params(params), sort_keys=True)
+    return hashlib.sha256(f"{model}\x00{prompt_digest(messages, images)}\x00{sampling}".encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, mode: str = DEFAULT_CACHE_MODE, cache_dir: str = DEFAULT_CACHE_DIR,
+                 max_bytes: int = DEFAULT_CACHE_MAX_BYTES):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"未知的缓存模式: {mode}，可选 {', '.join(CACHE_MODES)}")
+        self.mode = mode
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.db_path = os.path.join(cache_dir, "responses.sqlite3")
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self._occurrences = Counter()  # 本次运行中各基础键的出现次数，用于采样序号
+        self._conn = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "bypass"
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, model TEXT, data TEXT, nbytes INTEGER, created REAL, last_access REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_access ON responses(last_access)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def make_key(self, model: str, messages: Iterable[dict], params: Optional[dict] = None,
+                 images: Iterable = ()) -> Optional[str]:
+        """
+        计算缓存键；temperature > 0 时追加本次运行内的出现序号。
+        每次请求只应调用一次（调用即计入出现次数），bypass 模式返回 None。
+        """
+        if not self.enabled:
+            return None
+        return self.key_for_digest(request_digest(model, messages, params, images), params)
+
+    def key_for_digest(self, digest: str, params: Optional[dict] = None,
+                       sample_index: Optional[int] = None) -> Optional[str]:
+        """
+        已算好 request_digest 时使用，语义同 make_key。
+        sample_index 为调用方给出的采样序号（如 checkpoint.RunCheckpoint.sample_index，续跑时跳过的记录同样计数），
+        给出时代替本次运行内的出现次数。
+        """
+        if not self.enabled:
+            return None
+        if ((params or {}).get("temperature") or 0) > 0:
+            if sample_index is None:
+                sample_index = self._occurrences[digest]
+                self._occurrences[digest] += 1
+            return f"{digest}:s{sample_index}"
+        return digest
+
+    def get(self, key: Optional[str]) -> Optional[str]:
+        if key is None or self.mode != "use":
+            return None
+        conn = self._connect()
+        row = conn.execute("SELECT data FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+        conn.commit()
+        self.hits += 1
+        return row[0]
+
+    def put(self, key: Optional[str], data: str, model: str = ""):
+        if key is None:
+            return
+        conn = self._connect()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO responses (key, model, data, nbytes, created, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+            (key, model, data, len(data.encode("utf-8")), now, now),
+        )
+        conn.commit()
+        self.writes += 1
+        self._evict(conn)
+
+    def _evict(self, conn: sqlite3.Connection):
+        """总大小超过上限时，按最近访问时间从旧到新淘汰"""
+        total = conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = 0
+        for key, nbytes in conn.execute("SELECT key, nbytes FROM responses ORDER BY last_access ASC").fetchall():
+            if total <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= nbytes
+            evicted += 1
+        conn.commit()
+        logger.debug(f"响应缓存淘汰 {evicted} 条，当前 {total} 字节")
+
+    def stats(self) -> dict:
+        if not self.enabled:
+            return {"mode": self.mode}
+        conn = self._connect()
+        count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM responses").fetchone()
+        return {"mode": self.mode, "hits": self.hits, "misses": self.misses, "writes": self.writes,
+                "entries": count, "bytes": total}
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+        self._conn = None
+
+
+def cached_invoke(llm, messages: list, cache: Optional[ResponseCache], metrics=None):
+    """
+    LangGraph 节点中替代 llm.invoke(messages)：按消息内容与 llm 的模型名、采样参数查缓存，
+    命中时直接构造 AIMessage，未命中时调用接口并写入回答文本。
+    给出 metrics（metrics.MetricsRecorder）时每次实际调用接口记录一条指标，缓存命中不计入。
+    """
+    from langchain_core.messages import AIMessage
+
+    def invoke():
+        if metrics is None:
+            return llm.invoke(messages)
+        return invoke_with_metrics(llm, messages, metrics)
+
+    if cache is None or not cache.enabled:
+        return invoke()
+    model = getattr(llm, "model_name", "") or getattr(llm, "model", "")
+    params = {k: getattr(llm, k, None) for k in SAMPLING_PARAMS}
+    roles = {"human": "user", "ai": "assistant"}
+    openai_messages = [{"role": roles.get(m.type, m.type), "content": m.content} for m in messages]
+    key = cache.make_key(model, openai_messages, params)
+    cached = cache.get(key)
+    if cached is not None:
+        return AIMessage(content=cached)
+    response = invoke()
+    if isinstance(response.content, str) and response.content:
+        cache.put(key, response.content, model)
+    return response
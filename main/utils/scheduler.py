@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+滑动窗口并发调度
+始终保持最多 N 个请求在途：任一请求完成即启动下一条记录，不再等待整批中最慢的请求，也没有批间空闲。
+结果按输入顺序产出（已完成但排在前面请求之后的结果暂存在重排缓冲中，缓冲上限为 max_buffer）。
+同时统计有效吞吐与窗口占用率（按时间加权的平均在途数 / N）。
+"""
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import AsyncIterable, AsyncIterator, Awaitable, Callable, Iterable, Optional, Tuple, TypeVar, Union
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class SlidingWindow:
+    def __init__(self, concurrency: int, max_buffer: Optional[int] = None):
+        self.concurrency = max(1, concurrency)
+        self.max_buffer = max_buffer or self.concurrency * 4
+        self.in_flight = 0
+        self.completed = 0
+        self._busy_area = 0.0  # 在途数对时间的积分
+        self._last_change = None
+        self._started = None
+        self._elapsed = 0.0
+
+    def _mark(self):
+        now = time.perf_counter()
+        if self._last_change is not None:
+            self._busy_area += self.in_flight * (now - self._last_change)
+        self._last_change = now
+
+    async def _run(self, func: Callable[[T], Awaitable[R]], item: T) -> R:
+        self._mark()
+        self.in_flight += 1
+        try:
+            return await func(item)
+        finally:
+            self._mark()
+            self.in_flight -= 1
+            self.completed += 1
+
+    async def map(self, items: Union[Iterable[T], AsyncIterable[T]],
+                  func: Callable[[T], Awaitable[R]]) -> AsyncIterator[Tuple[T, R]]:
+        """按输入顺序产出 (item, result)；func 抛出的异常原样向上抛出"""
+        if hasattr(items, "__aiter__"):
+            source = items.__aiter__()  # type: ignore
+
+            async def next_item():
+                return await source.__anext__()
+        else:
+            source = iter(items)  # type: ignore
+
+            async def next_item():
+                try:
+                    return next(source)
+                except StopIteration:
+                    raise StopAsyncIteration
+
+        if self._started is None:
+            self._started = time.perf_counter()
+        start = time.perf_counter()
+        pending = deque()
+        exhausted = False
+        try:
+            while True:
+                running = sum(1 for _, task in pending if not task.done())
+                while not exhausted and running < self.concurrency and len(pending) < self.max_buffer:
+                    try:
+                        item = await next_item()
+                    except StopAsyncIteration:
+                        exhausted = True
+                        break
+                    pending.append((item, asyncio.ensure_future(self._run(func, item))))
+                    running += 1
+
+                if not pending:
+                    break
+                item, task = pending[0]
+                if task.done():
+                    pending.popleft()
+                    yield item, task.result()
+                    continue
+                await asyncio.wait([t for _, t in pending if not t.done()], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for _, task in pending:
+                task.cancel()
+            self._elapsed += time.perf_counter() - start
+
+    def occupancy(self) -> float:
+        """窗口占用率:平均在途数 / concurrency"""
+        if self._elapsed <= 0:
+            return 0.0
+        return self._busy_area / (self._elapsed * self.concurrency)
+
+    def summary(self, unit: str = "条") -> str:
+        rate = self.completed / self._elapsed if self._elapsed > 0 else 0.0
+        return (f"滑动窗口: 并发 {self.concurrency},完成 {self.completed} {unit},用时 {self._elapsed:.2f} 秒,"
+                f"有效吞吐 {rate:.2f} {unit}/秒,窗口占用率 {self.occupancy():.1%}")
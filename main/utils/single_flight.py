@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+在途请求合并（single-flight）
+同一进程内内容哈希相同（模型 + prompt + 图片 + 采样参数，见 response_cache.request_digest）的请求同时在途时，
+只发出第一个，其余等待并共享同一个结果。
+只适用于确定性请求：temperature 不为 0（或未指定，接口默认采样）时每次调用本应得到独立的采样结果，不合并。
+跨进程的重复由响应缓存（response_cache.py）在请求完成后复用。
+"""
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+R = TypeVar("R")
+
+
+def is_deterministic(params: Optional[dict]) -> bool:
+    """temperature 为 0 且只要一个候选时视为确定性请求"""
+    params = params or {}
+    return params.get("temperature") == 0 and (params.get("n") or 1) == 1
+
+
+class SingleFlight:
+    def __init__(self):
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self.calls = 0  # 实际发出的请求数
+        self.suppressed = 0  # 被合并的重复请求数
+
+    async def do(self, key: str, func: Callable[[], Awaitable[R]]) -> Tuple[R, bool]:
+        """
+        返回 (结果, 是否共享了其他调用的结果)。
+        实际请求在独立任务中执行，某个等待方被取消不会影响其他等待方。
+        """
+        task = self._in_flight.get(key)
+        shared = task is not None
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+            self.calls += 1
+        else:
+            self.suppressed += 1
+        return await asyncio.shield(task), shared
+
+    def summary(self) -> str:
+        total = self.calls + self.suppressed
+        rate = self.suppressed / total if total else 0.0
+        return f"请求合并: 发出 {self.calls} 次请求,合并重复请求 {self.suppressed} 次({rate:.1%})"
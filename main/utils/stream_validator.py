@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+流式响应（SSE）的增量 JSON 校验
+模型按 token 流式输出时逐字符检查：
+- 根节点之前只允许空白与 ```json 代码块标记，出现其他文字（模型开始写解释）立即判为无效；
+- 括号、引号、逗号、冒号的结构错误立即判为无效；
+- 每个字符串 / 数字取值结束时，若其键在备选项表中，检查取值是否为备选项之一（"unknown" 总是允许）。
+根节点闭合后 complete 为 True，之后的内容不再检查。
+
+备选项表由 enum_schema() 从 prompt 中的模版提取：形如 "键":"选项1，选项2" 的片段，同名键的选项取并集；
+选项带全角括号注释时（如 中排左（若有））括号前的部分同样允许。
+"""
+import re
+import json
+from typing import Dict, Iterable, List, Optional, Set
+
+# 模版中的 "键":"选项1，选项2,..."（至少含一个分隔符才视为备选项）
+_ENUM_PATTERN = re.compile(r'"([^"\n]+)"\s*:\s*"([^"\n]*[，,][^"\n]*)"')
+_OPTION_SEPARATORS = re.compile(r"[，,、]")
+_FENCE = "```json"
+_LITERAL_CHARS = set("0123456789+-.eEtrufalsn")
+
+
+def enum_schema(prompt: str) -> Dict[str, Set[str]]:
+    """从 prompt 的 json 模版中提取 键 -> 备选项集合"""
+    schema: Dict[str, Set[str]] = {}
+    for key, options in _ENUM_PATTERN.findall(prompt):
+        values = schema.setdefault(key, {"unknown"})
+        for option in _OPTION_SEPARATORS.split(options):
+            option = option.strip()
+            if option:
+                values.add(option)
+                if "（" in option:
+                    values.add(option.split("（", 1)[0])
+    return schema
+
+
+class IncrementalJSONValidator:
+    """
+    feed() 逐块输入模型输出；error 不为 None 表示输出已可判定无效，complete 为 True 表示根节点已完整闭合。
+    multi_value_keys 中的键允许以逗号分隔给出多个备选项（如颜色）。
+    """
+    def __init__(self, enums: Optional[Dict[str, Set[str]]] = None, multi_value_keys: Iterable[str] = ()):
+        self.enums = enums or {}
+        self.multi_value_keys = set(multi_value_keys)
+        self.error: Optional[str] = None
+        self.complete = False
+        self.chars = 0
+        self._prefix = ""
+        self._started = False
+        # 每层容器: [类型 "{" / "[", 期望的下一个元素, 当前键]
+        self._stack: List[list] = []
+        self._in_string = False
+        self._escape = False
+        self._token = ""
+        self._literal = ""
+
+    def feed(self, text: str):
+        for ch in text:
+            if self.error is not None or self.complete:
+                return
+            self.chars += 1
+            if not self._started:
+                self._before_root(ch)
+            elif self._in_string:
+                self._string_char(ch)
+            else:
+                self._structural_char(ch)
+
+    def _fail(self, reason: str):
+        self.error = f"{reason}(第 {self.chars} 个字符)"
+
+    def _before_root(self, ch: str):
+        if ch.isspace():
+            return
+        if ch in "{[" and self._prefix.lower() in ("", "```", _FENCE):
+            self._started = True
+            self._open(ch)
+            return
+        self._prefix += ch
+        if not _FENCE.startswith(self._prefix.lower()):
+            self._fail("JSON 之前出现多余文本")
+
+    def _open(self, ch: str):
+        self._stack.append([ch, "key_or_end" if ch == "{" else "value_or_end", None])
+
+    def _string_char(self, ch: str):
+        self._token += ch
+        if self._escape:
+            self._escape = False
+        elif ch == "\\":
+            self._escape = True
+        elif ch == '"':
+            self._in_string = False
+            try:
+                value = json.loads(self._token)
+            except json.JSONDecodeError:
+                self._fail("字符串转义错误")
+                return
+            self._token = ""
+            frame = self._stack[-1]
+            if frame[1] in ("key_or_end", "key"):
+                frame[2] = value
+                frame[1] = "colon"
+            else:
+                self._value_done(value)
+
+    def _structural_char(self, ch: str):
+        if self._literal:
+            if ch in _LITERAL_CHARS:
+                self._literal += ch
+                return
+            if not self._finish_literal():
+                return
+        if ch.isspace():
+            return
+        frame = self._stack[-1]
+        expect = frame[1]
+        if expect == "colon":
+            if ch != ":":
+                self._fail("缺少冒号")
+            else:
+                frame[1] = "value"
+        elif expect in ("key_or_end", "key"):
+            if ch == '"':
+                self._in_string, self._token = True, ch
+            elif ch == "}" and expect == "key_or_end":
+                self._close()
+            else:
+                self._fail("对象中缺少键")
+        elif expect == "comma_or_end":
+            if ch == ",":
+                frame[1] = "key" if frame[0] == "{" else "value"
+            elif (ch == "}" and frame[0] == "{") or (ch == "]" and frame[0] == "["):
+                self._close()
+            else:
+                self._fail("缺少逗号或括号不匹配")
+        else:  # value / value_or_end
+            if ch == '"':
+                self._in_string, self._token = True, ch
+            elif ch in "{[":
+                self._open(ch)
+            elif ch == "]" and expect == "value_or_end":
+                self._close()
+            elif ch in _LITERAL_CHARS:
+                self._literal = ch
+            else:
+                self._fail("非法的取值")
+
+    def _finish_literal(self) -> bool:
+        literal, self._literal = self._literal, ""
+        try:
+            value = json.loads(literal)
+        except json.JSONDecodeError:
+            self._fail(f"非法的取值 {literal!r}")
+            return False
+        self._value_done(value)
+        return self.error is None
+
+    def _close(self):
+        self._stack.pop()
+        if not self._stack:
+            self.complete = True
+        else:
+            self._value_done(None)
+
+    def _value_done(self, value):
+        """一个取值结束：检查备选项（容器取值传入 None 不检查），并切换到等待逗号或闭合括号"""
+        key = self._current_key()
+        if value is not None and not isinstance(value, bool) and key in self.enums:
+            self._check_enum(key, str(value))
+        self._stack[-1][1] = "comma_or_end"
+
+    def _current_key(self) -> Optional[str]:
+        """最近一层对象的当前键（数组中的标量按所在数组的键检查）"""
+        for frame in reversed(self._stack):
+            if frame[0] == "{":
+                return frame[2]
+        return None
+
+    def _check_enum(self, key: str, value: str):
+        allowed = self.enums[key]
+        parts = [p.strip() for p in _OPTION_SEPARATORS.split(value)] if key in self.multi_value_keys else [value.strip()]
+        for part in parts:
+            if part not in allowed:
+                self._fail(f"{key} 的取值 {part!r} 不在备选项中")
+                return
+
+
+class StreamAbortedError(Exception):
+    """流式输出已可判定无效，请求被提前中止；content 为中止前收到的输出"""
+    def __init__(self, reason: str, content: str):
+        super().__init__(reason)
+        self.reason = reason
+        self.content = content
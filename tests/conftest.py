@@ -0,0 +1,9 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 与各脚本相同，直接以模块名导入 main/utils、main/agent 与 main/bench 下的文件
+for sub in ("utils", "agent", "bench"):
+    path = os.path.join(ROOT, "main", sub)
+    if path not in sys.path:
+        sys.path.insert(0, path)
@@ -0,0 +1,48 @@
+"""多图打包基准的冒烟测试：load_items 构造的条目与 evaluate_packed 的参数结构保持一致"""
+import json
+import asyncio
+import argparse
+
+from aiohttp import web
+from PIL import Image
+
+import gene_answer
+from bench_pack_size import load_items, run_pack
+from mock_llm_server import build_app, build_parser
+
+NUM_IMAGES = 5
+
+
+async def start_mock():
+    args = build_parser().parse_args(["--latency-median", "0.01", "--latency-sigma", "0", "--tail-prob", "0"])
+    runner = web.AppRunner(build_app(args))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, f"http://127.0.0.1:{runner.addresses[0][1]}/v1"
+
+
+def test_run_pack_against_mock(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # 图片编码缓存写在工作目录下
+    corpus = tmp_path / "corpus.jsonl"
+    with open(corpus, "w", encoding="utf-8") as f:
+        for i in range(NUM_IMAGES):
+            image_path = tmp_path / f"img{i}.jpg"
+            Image.new("RGB", (64, 48), (40 * i, 80, 120)).save(image_path)
+            f.write(json.dumps({"source_text": f"第 {i} 张", "image_path": str(image_path)}, ensure_ascii=False) + "\n")
+    items = load_items(str(corpus), NUM_IMAGES)
+
+    async def scenario():
+        runner, base_url = await start_mock()
+        try:
+            args = argparse.Namespace(api_key="test", base_url=base_url, model="mock", concurrency=2)
+            return [await run_pack(gene_answer, args, items, pack_size) for pack_size in (1, 2, 3)]
+        finally:
+            await runner.cleanup()
+
+    rows = asyncio.run(scenario())
+    for row in rows:
+        assert row["errors"] == 0, row
+        # 每组一次打包请求，解析失败的槽位各自回退一次
+        assert row["requests"] == -(-NUM_IMAGES // row["K"]) + row["fallbacks"]
+        assert row["prompt_tokens_per_image"] > 0
@@ -0,0 +1,106 @@
+"""续跑时多次采样保持各自独立（响应缓存键使用检查点给出的采样序号）"""
+import json
+import asyncio
+
+import pytest
+
+from aiohttp import web
+from PIL import Image
+
+from gene_answer import GeminiEvaluator, process_file
+from llm_client import LLMClient
+from response_cache import ResponseCache
+
+SAMPLES = 3
+
+
+async def start_server():
+    """
+    每次请求返回带递增序号的回答，不同请求的回答必然不同；
+    两阶段的第一阶段请求（prompt 中含 座位排数）一律返回 400，使其回退为单次请求。
+    """
+    state = {"requests": 0, "coarse": 0}
+
+    async def chat(request):
+        body = await request.json()
+        if "座位排数" in json.dumps(body["messages"], ensure_ascii=False):
+            state["coarse"] += 1
+            return web.Response(status=400, text="coarse rejected")
+        state["requests"] += 1
+        content = json.dumps({"请求序号": state["requests"]})
+        return web.json_response({"choices": [{"message": {"role": "assistant", "content": content}}]})
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", chat)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://127.0.0.1:{port}/v1", state
+
+
+async def run(input_path, output_path, base_url, cache_dir, mode, two_pass=False):
+    # 每次运行使用新的缓存实例，与重新启动脚本相同
+    cache = ResponseCache("use", cache_dir=str(cache_dir))
+    client = LLMClient("test", base_url, rate_limit=False, max_retries=0)
+    async with GeminiEvaluator("test", base_url, client=client, response_cache=cache, temperature=0.3,
+                               two_pass=two_pass) as evaluator:
+        await process_file(evaluator, input_path, output_path, batch_size=SAMPLES, checkpoint_mode=mode)
+    stats = cache.stats()
+    cache.close()
+    return stats
+
+
+def read_answers(output_path):
+    answers = {}
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            row = json.loads(line)
+            answers.setdefault(row["image_path"], []).append(row["gemini_response"]["请求序号"])
+    return answers
+
+
+@pytest.mark.parametrize("two_pass", [False, True], ids=["single", "two_pass_fallback"])
+def test_resume_keeps_samples_distinct(tmp_path, monkeypatch, two_pass):
+    monkeypatch.chdir(tmp_path)  # 图片编码缓存写在工作目录下
+    input_dir = tmp_path / "in"
+    input_dir.mkdir()
+    input_path = input_dir / "corpus.jsonl"
+    with open(input_path, "w", encoding="utf-8") as f:
+        for i in range(2):
+            image_path = tmp_path / f"img{i}.jpg"
+            Image.new("RGB", (64, 48), (40 * i, 80, 120)).save(image_path)
+            row = {"source_text": f"第 {i} 张", "image_path": str(image_path)}
+            for _ in range(SAMPLES):
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    output_path = tmp_path / "out.jsonl"
+    cache_dir = tmp_path / "responses"
+
+    async def scenario():
+        runner, base_url, state = await start_server()
+        try:
+            await run(input_path, output_path, base_url, cache_dir, "fresh", two_pass)
+            full = read_answers(output_path)
+            # 只保留第一行，模拟中途崩溃后续跑
+            with open(output_path, "r", encoding="utf-8") as f:
+                first = f.readline()
+            with open(output_path, "w", encoding="utf-8") as f:
+                f.write(first)
+            requests_before = state["requests"]
+            stats = await run(input_path, output_path, base_url, cache_dir, "resume", two_pass)
+            assert not two_pass or state["coarse"] > 0
+            return full, read_answers(output_path), stats, state["requests"] - requests_before
+        finally:
+            await runner.cleanup()
+
+    full, resumed, stats, new_requests = asyncio.run(scenario())
+
+    assert all(len(set(answers)) == SAMPLES for answers in full.values())
+    for image_path, answers in resumed.items():
+        assert len(answers) == SAMPLES
+        assert len(set(answers)) == SAMPLES, f"{image_path} 的采样在续跑后重复: {answers}"
+        assert sorted(answers) == sorted(full[image_path])
+    # 续跑的 5 行全部命中缓存，且命中的是各自序号的回答
+    assert new_requests == 0
+    assert stats["hits"] == 2 * SAMPLES - 1
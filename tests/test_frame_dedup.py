@@ -0,0 +1,87 @@
+"""连续帧近重复抑制：阈值边界、簇成员取回，以及同一图片的重复行从不合并"""
+import pytest
+from PIL import Image, ImageDraw
+
+from frame_dedup import FrameDeduplicator, hamming, image_phash
+
+THRESHOLD = 6
+
+
+def make_deduper(hashes):
+    """hashes 为 路径 → pHash，直接给定哈希以精确控制汉明距离"""
+    deduper = FrameDeduplicator(threshold=THRESHOLD, chunk=2)
+    deduper._hash_row = lambda row: hashes.get(row["image_path"])
+    return deduper
+
+
+def cluster(deduper, rows):
+    reps = list(deduper.representatives(rows))
+    return [[rep["image_path"]] + [m["image_path"] for m in deduper.pop_members(rep)] for rep in reps]
+
+
+def bits(n):
+    return (1 << n) - 1  # 与 0 的汉明距离为 n
+
+
+def test_threshold_boundary():
+    hashes = {"a": 0, "at": bits(THRESHOLD), "over": bits(THRESHOLD + 1), "b": bits(THRESHOLD + 1) | 1 << 40}
+    deduper = make_deduper(hashes)
+    rows = [{"image_path": p} for p in ("a", "at", "over", "b")]
+    # 与代表帧的距离恰为阈值时归入同簇，超过阈值另起一簇
+    assert cluster(deduper, rows) == [["a", "at"], ["over", "b"]]
+    assert deduper.stats["images"] == 4 and deduper.stats["clusters"] == 2
+    deduper.close()
+
+
+def test_repeated_paths_never_merged():
+    deduper = make_deduper({"a": 0, "b": 0})
+    rows = [{"image_path": p} for p in ("a", "a", "a", "b", "b")]
+    groups = cluster(deduper, rows)
+    assert all(len(set(group)) == len(group) for group in groups)
+    assert [p for group in groups for p in group] == ["a", "a", "a", "b", "b"]
+    # 每次重复都单独请求，近重复帧 b 归入前一个簇
+    assert groups == [["a"], ["a"], ["a", "b"], ["b"]]
+    deduper.close()
+
+
+def test_unhashable_rows_stay_alone():
+    deduper = make_deduper({"a": 0, "c": 0})
+    rows = [{"image_path": p} for p in ("a", "missing", "c")]
+    assert cluster(deduper, rows) == [["a"], ["missing"], ["c"]]
+    deduper.close()
+
+
+def test_pop_members_returns_each_cluster_once():
+    deduper = make_deduper({"a": 0, "b": 1})
+    rows = [{"image_path": "a"}, {"image_path": "b"}]
+    rep = next(iter(deduper.representatives(rows)))
+    assert deduper.pop_members(rep) == [rows[1]]
+    assert deduper.pop_members(rep) == []
+    assert deduper.pop_members({"image_path": "a"}) == []
+    deduper.close()
+
+
+@pytest.fixture
+def frames(tmp_path):
+    def draw(name, box, shade):
+        img = Image.new("RGB", (320, 240), (90, 90, 100))
+        ImageDraw.Draw(img).rectangle(box, fill=(shade, shade, shade))
+        path = tmp_path / name
+        img.save(path, quality=95)
+        return str(path)
+
+    return {
+        "frame0": draw("frame0.jpg", (40, 40, 160, 200), 220),
+        "frame1": draw("frame1.jpg", (42, 40, 162, 200), 218),  # 轻微平移
+        "other": draw("other.jpg", (180, 20, 300, 120), 20),
+    }
+
+
+def test_real_images_cluster_consecutive_near_duplicates(frames):
+    h0, h1, h2 = (image_phash(frames[k]) for k in ("frame0", "frame1", "other"))
+    assert hamming(h0, h1) <= THRESHOLD < hamming(h0, h2)
+
+    deduper = FrameDeduplicator(threshold=THRESHOLD)
+    rows = [{"image_path": frames[k]} for k in ("frame0", "frame1", "other", "frame0")]
+    assert cluster(deduper, rows) == [[frames["frame0"], frames["frame1"]], [frames["other"]], [frames["frame0"]]]
+    deduper.close()
@@ -0,0 +1,74 @@
+"""远程图片预取：本地 HTTP 服务提供图片，覆盖 ETag / 304 复用、下载失败与预取线程异常"""
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from remote_images import ImageMirror, RemoteImagePrefetcher
+
+IMAGE = b"\xff\xd8\xff\xe0fake-jpeg-bytes"
+ETAG = '"v1"'
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    requests = []  # (路径, If-None-Match)
+
+    def do_GET(self):
+        FixtureHandler.requests.append((self.path, self.headers.get("If-None-Match")))
+        if self.path != "/cabin.jpg":
+            self.send_error(404)
+            return
+        if self.headers.get("If-None-Match") == ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", ETAG)
+        self.send_header("Content-Length", str(len(IMAGE)))
+        self.end_headers()
+        self.wfile.write(IMAGE)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    FixtureHandler.requests = []
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), FixtureHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_etag_revalidation_and_failed_fetch(server, tmp_path):
+    urls = [f"{server}/cabin.jpg", f"{server}/missing.jpg", ""]
+    mirror = ImageMirror(str(tmp_path / "mirror"))
+
+    first = RemoteImagePrefetcher(mirror, concurrency=2, lookahead=2)
+    assert list(first.iter_sync(urls)) == [(urls[0], IMAGE), (urls[1], None), ("", None)]
+    assert first.stats["downloaded"] == 1
+    assert first.stats["failed"] == 1
+
+    # 重跑：带 If-None-Match 的条件请求得到 304，正文取自本地镜像
+    second = RemoteImagePrefetcher(mirror, concurrency=2, lookahead=2)
+    assert list(second.iter_sync(urls[:1])) == [(urls[0], IMAGE)]
+    assert second.stats["not_modified"] == 1
+    assert second.stats["downloaded"] == 0
+    assert FixtureHandler.requests[-1] == ("/cabin.jpg", ETAG)
+
+
+def test_producer_failure_is_raised(server, tmp_path):
+    def urls():
+        yield f"{server}/cabin.jpg"
+        yield f"{server}/missing.jpg"
+        raise RuntimeError("标注单读取失败")
+
+    prefetcher = RemoteImagePrefetcher(ImageMirror(str(tmp_path / "mirror")), lookahead=1)
+    delivered = []
+    with pytest.raises(RuntimeError, match="标注单读取失败"):
+        for item in prefetcher.iter_sync(urls()):
+            delivered.append(item)
+    assert delivered == [(f"{server}/cabin.jpg", IMAGE)]
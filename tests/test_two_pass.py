@@ -0,0 +1,106 @@
+"""两阶段识别的框换算、区域筛选与结果合并"""
+import os
+import json
+
+import pytest
+
+from two_pass import coarse_regions, crop_box, merge_results
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SIZE = (2000, 1000)
+
+COARSE = {
+    "是否为黑夜": "否",
+    "是否有中央扶手箱": "是",
+    "座位排数": "2",
+    "区域": [
+        {"位置": "后排右", "人数": "1", "物品数": "0", "框": [500, 500, 1000, 1000]},
+        {"位置": "中央扶手箱", "人数": "0", "物品数": "2", "框": [400, 450, 600, 550]},
+        {"位置": "前排左", "人数": "1", "物品数": "1", "框": [0, 0, 500, 500]},
+        {"位置": "后排左", "人数": "0", "物品数": "0", "框": [500, 0, 1000, 500]},
+        {"位置": "中排左（若有）", "人数": "1", "物品数": "0", "框": [300, 0, 700, 400]},
+    ],
+    "宠物": [{"种类": "狗", "位置": "后排右"}],
+}
+PERSON = {"性别": "男", "年龄": "成年", "上衣颜色": "黑色，白色", "上衣样式": "T恤", "下装颜色": "蓝色", "下装样式": "牛仔长裤"}
+
+
+def test_crop_box_converts_normalized_box_with_padding():
+    # 框 [ymin, xmin, ymax, xmax] = [100, 200, 300, 400]，四周外扩 10%
+    assert crop_box([100, 200, 300, 400], SIZE) == (360, 80, 840, 320)
+    assert crop_box([100, 200, 300, 400], SIZE, pad=0) == (400, 100, 800, 300)
+    assert crop_box(["100", "200", "300", "400"], SIZE, pad=0) == (400, 100, 800, 300)
+
+
+def test_crop_box_clamps_to_image():
+    assert crop_box([0, 0, 1000, 1000], SIZE) == (0, 0, 2000, 1000)
+
+
+@pytest.mark.parametrize("box", [
+    None, [], [1, 2, 3], ["a", 0, 1, 1],
+    [300, 200, 100, 400],  # ymax < ymin
+    [100, 400, 300, 400],  # 宽度为 0
+    [100, 100, 102, 102],  # 外扩后仍不足 8 像素
+])
+def test_crop_box_rejects_invalid_boxes(box):
+    assert crop_box(box, SIZE) is None
+
+
+def test_coarse_regions_filters_empty_and_sorts():
+    regions = coarse_regions(COARSE)
+    assert [r["位置"] for r in regions] == ["前排左", "中排左", "后排右", "中央扶手箱"]
+    assert coarse_regions({"区域": None}) == []
+    assert coarse_regions({"区域": ["前排左", {"位置": "车顶", "人数": "1"}]})[0]["位置"] == "unknown"
+
+
+def merged_example():
+    regions = {r["位置"]: r for r in coarse_regions(COARSE)}
+    fine = [
+        (regions["后排右"], {"人": [PERSON], "物品": [{"种类": "背包", "位置": "前排左"}]}),
+        (regions["中央扶手箱"], {"人": [], "物品": [{"种类": "水杯", "位置": "中央扶手箱-杯槽"},
+                                                 {"种类": "手机", "位置": "中央扶手箱"}]}),
+        (regions["前排左"], {"人": [{"性别": "女"}], "物品": [{"种类": "挎包（单肩包）", "位置": "前排左"}]}),
+    ]
+    return merge_results(COARSE, fine)
+
+
+def test_merge_results_matches_single_pass_schema():
+    merged = merged_example()
+    assert list(merged) == ["是否为黑夜", "是否有中央扶手箱", "人", "物品", "宠物"]
+    assert merged["是否为黑夜"] == "否" and merged["是否有中央扶手箱"] == "是"
+
+    persons = merged["人"]
+    assert persons["人数"] == "2"
+    assert [p["位置"] for p in persons["具体信息"]] == ["前排左", "后排右"]
+    assert list(persons["具体信息"][1]) == ["性别", "年龄", "位置", "上衣颜色", "上衣样式", "下装颜色", "下装样式"]
+    # 第二阶段缺失的字段补为 unknown
+    assert persons["具体信息"][0]["上衣样式"] == "unknown"
+
+    items = merged["物品"]
+    assert items["物品数"] == "4"
+    # 位置以第一阶段区域为准，只有扶手箱的物品可细分到杯槽
+    assert [(i["种类"], i["位置"]) for i in items["具体信息"]] == [
+        ("挎包（单肩包）", "前排左"), ("背包", "后排右"), ("手机", "中央扶手箱"), ("水杯", "中央扶手箱-杯槽")]
+    assert merged["宠物"] == {"宠物数": "1", "具体信息": [{"种类": "狗", "位置": "后排右"}]}
+
+
+def test_merged_result_fills_standard_input():
+    # inCabinAgentForWebPIc 依赖 langchain / langgraph，未安装时跳过
+    for module in ("langchain_openai", "langchain_core", "langgraph", "dotenv", "httpx", "requests"):
+        pytest.importorskip(module)
+    from inCabinAgentForWebPIc import fill_standard_input
+
+    with open(os.path.join(ROOT, "outputs", "standardInput.json"), "r", encoding="utf-8") as f:
+        template = json.load(f)
+    filled = fill_standard_input(merged_example(), template)
+    tags = {tag["tag_key"]: tag["value"] for tag in filled["label_result"]["global"]["100000"][0]["tag_list"]}
+
+    assert tags["是否抛弃"] == "可用"
+    assert (tags["车内人数"], tags["车内物品数"], tags["车内宠物数"]) == ("2", "4", "1")
+    assert tags["晚上"] == "否"
+    assert tags["摄像头位置"] == "一排"
+    assert tags["person1-性别"] == "女性" and tags["person1-位置"] == ["副驾"]
+    assert tags["person2-性别"] == "男性" and tags["person2-位置"] == ["三排左"]
+    assert tags["person2-衣裤-着装1类型"] == ["T恤"]
+    assert tags["good3-位置"] == ["前排扶手箱"] and tags["good4-位置"] == ["前排扶手箱-杯槽"]
+    assert tags["pet1-种类"] == "狗" and tags["pet1-位置"] == ["三排左"]